@@ -0,0 +1,60 @@
+# coding: utf-8
+"""
+Measures how long ``import cielo`` takes in fresh interpreters, and which
+heavy modules it pulls in. To compare two versions, point ``--path`` to
+checkouts of each:
+
+    python benchmarks/import_time.py --path /tmp/before --path .
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ('requests', 'xmltodict', 'multiprocessing', 'decimal', 'sqlite3')
+
+MEASURE = """
+import json, sys, time
+started_at = time.time()
+import %(module)s
+elapsed = time.time() - started_at
+loaded = sorted(name for name in %(heavy)r if name in sys.modules)
+sys.stdout.write(json.dumps({'elapsed': elapsed, 'loaded': loaded}))
+"""
+
+
+def measure(python, path, module, runs):
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(path))
+    code = MEASURE % {'module': module, 'heavy': HEAVY_MODULES}
+    timings = []
+    loaded = None
+    for i in range(runs):
+        output = subprocess.check_output([python, '-c', code], cwd=os.path.abspath(path), env=env)
+        result = json.loads(output.decode('utf-8'))
+        timings.append(result['elapsed'])
+        loaded = result['loaded']
+    timings.sort()
+    return timings, loaded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time the import of python-cielo')
+    parser.add_argument('--path', action='append', help='directory containing the cielo package (repeatable)')
+    parser.add_argument('--python', action='append', help='interpreter to run (repeatable)')
+    parser.add_argument('--module', default='cielo')
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args(argv)
+
+    paths = args.path or [os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)]
+    for python in args.python or [sys.executable]:
+        for path in paths:
+            timings, loaded = measure(python, path, args.module, args.runs)
+            sys.stdout.write('{0} {1}\n  import {2}: min {3:.1f} ms, median {4:.1f} ms\n  loaded: {5}\n'.format(
+                python, os.path.abspath(path), args.module, timings[0] * 1000, timings[len(timings) // 2] * 1000,
+                ', '.join(loaded) or '-'
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+# coding: utf-8
+"""
+Compares the CPU cost of each operation (payload rendering, response
+parsing and handling, without the network) across interpreters:
+
+    python benchmarks/interpreters.py --python python2.7 --python python3.12
+
+Every interpreter needs requests and xmltodict installed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+OPERATIONS = ('authorize', 'authorize_token', 'capture', 'cancel', 'refresh', 'tokenize')
+
+
+class _CannedResponse(object):
+    status_code = 200
+    elapsed = timedelta(0)
+
+    def __init__(self, content):
+        self.content = content
+
+
+class _CannedTransport(object):
+    """
+    Stands for the RequestScheduler, answering every request at once.
+    """
+
+    def __init__(self):
+        from cielo.loadtest import TRANSACTION, TOKEN
+        fields = {'tid': '10069930690000000001', 'order_id': '7DSD163AHBLP12', 'total': '100',
+                  'now': datetime(2009, 12, 14, 12, 0, 1).strftime('%Y-%m-%dT%H:%M:%S')}
+        self.transaction = TRANSACTION.format(status='6', **fields).encode('latin-1')
+        self.token = TOKEN.format(**fields).encode('latin-1')
+
+    def post(self, url, operation, priority=None, **kwargs):
+        if '<requisicao-token' in kwargs['data']['mensagem']:
+            return _CannedResponse(self.token)
+        return _CannedResponse(self.transaction)
+
+
+def _operations():
+    from cielo import PaymentAttempt, TokenPaymentAttempt, CieloToken, Transaction
+    from cielo.constants import VISA, CASH
+
+    kwargs = {
+        'affiliation_id': '1006993069',
+        'api_key': '25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+        'scheduler': _CannedTransport(),
+    }
+    order = dict(kwargs, order_id='7DSD163AHBLP12', total=Decimal('1.00'), transaction=CASH, installments=1)
+    card = {'card_type': VISA, 'card_number': '4012001037141112', 'cvc2': 423, 'exp_month': 1,
+            'exp_year': datetime.now().year + 1, 'card_holders_name': 'JOAO DA SILVA'}
+    tid = '10069930690000000001'
+
+    return {
+        'authorize': lambda: PaymentAttempt(**dict(order, **card)).get_authorized(),
+        'authorize_token': lambda: TokenPaymentAttempt(token='TOKEN', card_type=VISA, **order).get_authorized(),
+        'capture': lambda: Transaction(**kwargs).capture(transaction_id=tid),
+        'cancel': lambda: Transaction(**kwargs).cancel(transaction_id=tid, amount=Decimal('1.00')),
+        'refresh': lambda: Transaction(**kwargs).refresh(transaction_id=tid),
+        'tokenize': lambda: CieloToken(**dict(kwargs, **card)).create_token(),
+    }
+
+
+def measure(iterations):
+    """
+    CPU microseconds per call of each operation, in this interpreter.
+    """
+    from cielo.loadtest import _cpu_time
+
+    operations = _operations()
+    results = {}
+    for name in OPERATIONS:
+        operation = operations[name]
+        for i in range(min(iterations // 10, 100)):
+            operation()
+        started_at = _cpu_time()
+        for i in range(iterations):
+            operation()
+        results[name] = (_cpu_time() - started_at) / iterations * 1000000
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the CPU cost of python-cielo operations across interpreters')
+    parser.add_argument('--python', action='append', help='interpreter to run (repeatable)')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        sys.path.insert(0, ROOT)
+        sys.stdout.write(json.dumps(measure(args.iterations)))
+        return
+
+    pythons = args.python or [sys.executable]
+    results = []
+    for python in pythons:
+        output = subprocess.check_output([python, os.path.abspath(__file__), '--child',
+                                          '--iterations', str(args.iterations)])
+        results.append(json.loads(output.decode('utf-8')))
+
+    width = max(len(python) for python in pythons)
+    sys.stdout.write('CPU us/op'.ljust(16) + ''.join(python.rjust(width + 2) for python in pythons) + '\n')
+    for name in OPERATIONS:
+        sys.stdout.write(name.ljust(16) + ''.join(
+            '{0:.1f}'.format(result[name]).rjust(width + 2) for result in results
+        ) + '\n')
+
+
+if __name__ == '__main__':
+    main()
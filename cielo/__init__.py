@@ -1,3 +1,3 @@
 # -*- coding: utf-8 -*-
 
-from main import *
+from .main import *
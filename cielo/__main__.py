@@ -0,0 +1,194 @@
+# coding: utf-8
+"""
+Batch operations from the command line:
+
+    python -m cielo capture tids.csv --affiliation-id 1006993069 --api-key ... --concurrency 16 --rate 20
+    cat cards.jsonl | python -m cielo tokenize --output tokens.jsonl
+
+Reads JSON lines or CSV (with a header line) from a file or stdin and
+writes a JSON line per input line to stdout (or ``--output``) as each
+operation completes. Every result carries its input ``line`` number; with
+``--resume`` the lines already in ``--output`` are skipped, so an
+interrupted run can be restarted with the same command.
+
+Input fields: ``tid`` (or ``order_id``) for capture and refresh, plus
+``amount`` for cancel; ``card_type``, ``card_number``, ``exp_month``,
+``exp_year`` and ``card_holders_name`` for tokenize. Tokenize results only
+carry the truncated card number.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter
+from decimal import Decimal
+
+from .bulk import run_batch
+from .main import CieloToken, Transaction
+from .ratelimit import RateLimiter
+
+OPERATIONS = ('capture', 'cancel', 'refresh', 'tokenize')
+
+
+def read_rows(f, skip=()):
+    """
+    Yields ``(line, row)`` for the JSON lines or CSV rows of ``f``, the
+    format being guessed from the first line. Lines are numbered from 1,
+    without the CSV header; those in ``skip`` aren't yielded. JSON lines
+    are yielded as read, see decode_row.
+    """
+    first = f.readline()
+    if not first:
+        return
+
+    if first.lstrip().startswith('{'):
+        rows = (line for line in _chain(first, f) if line.strip())
+    else:
+        rows = csv.DictReader(_chain(first, f))
+
+    for line, row in enumerate(rows, 1):
+        if line not in skip:
+            yield line, row
+
+
+def decode_row(row):
+    """
+    The fields of a row from read_rows. JSON lines are decoded here, by the
+    operation's thread, so a malformed line fails alone.
+    """
+    if isinstance(row, dict):
+        return row
+    try:
+        row = json.loads(row)
+    except ValueError as e:
+        # Reported as ValueError on every Python, not JSONDecodeError
+        raise ValueError(str(e))
+    if not isinstance(row, dict):
+        raise ValueError('expected a JSON object')
+    return row
+
+
+def _chain(first, f):
+    yield first
+    for line in f:
+        yield line
+
+
+def processed_lines(path):
+    """
+    Input line numbers already in a results file. A torn last line, left by
+    an interrupted run, is cut off so new results can be appended.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r+b') as f:
+        data = f.read()
+        f.truncate(data.rfind(b'\n') + 1)
+    return set(json.loads(line.decode('utf-8'))['line'] for line in data.splitlines(True) if line.endswith(b'\n'))
+
+
+def _run(operation, row, request_kwargs):
+    if operation == 'tokenize':
+        token = CieloToken(
+            card_type=row['card_type'],
+            card_number=str(row['card_number']).strip(),
+            exp_month=int(row['exp_month']),
+            exp_year=int(row['exp_year']),
+            card_holders_name=row['card_holders_name'],
+            **request_kwargs
+        )
+        token.create_token()
+        return {'token': token.token, 'card': token.card, 'status': token.status}
+
+    transaction = Transaction(order_id=row.get('order_id') or '', **request_kwargs)
+    transaction_id = row.get('tid') or row.get('transaction_id')
+    if operation == 'capture':
+        transaction.capture(transaction_id=transaction_id)
+    elif operation == 'cancel':
+        transaction.cancel(transaction_id=transaction_id, amount=Decimal(str(row['amount'])))
+    else:
+        transaction.refresh(transaction_id=transaction_id)
+    return {'tid': transaction.transaction_id, 'status': transaction.status}
+
+
+def run_operations(operation, rows, concurrency=8, **request_kwargs):
+    """
+    Runs ``operation`` for every ``(line, row)`` on ``concurrency`` threads,
+    yielding a result dict per row as they complete. Failures are results
+    too, with the Cielo error code or the exception name in ``error``.
+    """
+    def run(item):
+        line, row = item
+        return _run(operation, decode_row(row), request_kwargs)
+
+    for (line, row), result, error in run_batch(run, rows, concurrency):
+        if error is not None:
+            result = {'error': getattr(error, 'id', None) or error.__class__.__name__}
+            if operation != 'tokenize' and isinstance(row, dict):
+                result['tid'] = row.get('tid') or row.get('transaction_id')
+        result.update(line=line, operation=operation)
+        yield result
+
+
+def main(argv=None, stdout=None, stderr=None):
+    """
+    Runs the command, returning its exit status. The results go to
+    ``stdout`` without ``--output`` and the summary to ``stderr``, the
+    process' own streams by default.
+    """
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+
+    parser = argparse.ArgumentParser(prog='python -m cielo', description='Run Cielo operations in batch')
+    parser.add_argument('operation', choices=OPERATIONS)
+    parser.add_argument('input', nargs='?', help='JSON lines or CSV file, stdin if omitted')
+    parser.add_argument('--affiliation-id', default=os.environ.get('CIELO_AFFILIATION_ID'))
+    parser.add_argument('--api-key', default=os.environ.get('CIELO_API_KEY'))
+    parser.add_argument('--sandbox', action='store_true')
+    parser.add_argument('--url', help='send the requests elsewhere, like a load test stand-in')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--rate', type=float, help='requests per second, unlimited if omitted')
+    parser.add_argument('--output', help='results file, stdout if omitted')
+    parser.add_argument('--resume', action='store_true', help='skip the lines already in --output')
+    args = parser.parse_args(argv)
+
+    if not args.affiliation_id or not args.api_key:
+        parser.error('--affiliation-id and --api-key (or CIELO_AFFILIATION_ID and CIELO_API_KEY) are required')
+    if args.resume and not args.output:
+        parser.error('--resume needs --output')
+
+    request_kwargs = {'affiliation_id': args.affiliation_id, 'api_key': args.api_key, 'sandbox': args.sandbox}
+    if args.url:
+        request_kwargs['url'] = args.url
+    if args.rate:
+        request_kwargs['rate_limiter'] = RateLimiter(args.rate)
+
+    skip = processed_lines(args.output) if args.resume else set()
+    source = open(args.input) if args.input else sys.stdin
+    output = open(args.output, 'a' if args.resume else 'w') if args.output else stdout
+
+    counts = Counter()
+    started_at = time.time()
+    try:
+        rows = read_rows(source, skip)
+        for result in run_operations(args.operation, rows, args.concurrency, **request_kwargs):
+            output.write(json.dumps(result, sort_keys=True) + '\n')
+            output.flush()
+            counts['error:{0}'.format(result['error']) if 'error' in result else 'ok'] += 1
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not stdout:
+            output.close()
+
+    stderr.write('{0} {1} in {2:.1f}s, {3} skipped: {4}\n'.format(
+        sum(counts.values()), args.operation, time.time() - started_at, len(skip),
+        ', '.join('{0}={1}'.format(status, count) for status, count in sorted(counts.items())) or '-'
+    ))
+    return 1 if any(status != 'ok' for status in counts) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
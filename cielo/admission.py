@@ -0,0 +1,115 @@
+# coding: utf-8
+import heapq
+import itertools
+import threading
+
+from . import forksafe
+from .constants import OPERATION_PRIORITIES, BACKGROUND
+from .exceptions import RequestRejectedException
+
+__all__ = ['AdmissionController', 'REJECT', 'WAIT', 'SHED']
+
+# Policies for requests arriving while every slot is taken
+REJECT, WAIT, SHED = 'reject', 'wait', 'shed'
+
+
+class _Waiter(object):
+
+    def __init__(self, priority, order):
+        self.priority = priority
+        self.order = order
+        self.event = threading.Event()
+        self.outcome = None
+
+    def __lt__(self, other):
+        return (self.priority, self.order) < (other.priority, other.order)
+
+
+class AdmissionController(object):
+    """
+    Bounds the requests in flight (``max_in_flight``) and waiting for a slot
+    (``max_queue``), passed to the requests as ``admission``. When no slot
+    is free the ``policy`` decides:
+
+    REJECT: fail right away.
+    WAIT: queue for up to ``timeout`` seconds; fail if the queue is full.
+    SHED: like WAIT, but a full queue drops its lowest priority request
+        (failing it) to make room for a more important one.
+
+    Free slots go to the queued request with the highest priority. Failures
+    raise RequestRejectedException, without contacting Cielo.
+    """
+
+    def __init__(self, max_in_flight=32, max_queue=64, policy=WAIT, timeout=1.0):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.policy = policy
+        self.timeout = timeout
+
+        self.in_flight = 0
+        self.rejected = 0
+        self._queue = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        # The parent's requests, running or queued, don't exist in the child
+        self.in_flight = 0
+        self._queue = []
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def _reject(self, reason, priority):
+        self.rejected += 1
+        raise RequestRejectedException(reason, priority)
+
+    def acquire(self, operation=None, priority=None):
+        if priority is None:
+            priority = OPERATION_PRIORITIES.get(operation, BACKGROUND)
+
+        with self._lock:
+            if self.in_flight < self.max_in_flight and not self._queue:
+                self.in_flight += 1
+                return
+
+            if self.policy == REJECT:
+                self._reject('in_flight', priority)
+
+            if len(self._queue) >= self.max_queue:
+                shed = max(self._queue) if self._queue and self.policy == SHED else None
+                if shed is None or shed.priority <= priority:
+                    self._reject('queue_full', priority)
+
+                self._queue.remove(shed)
+                heapq.heapify(self._queue)
+                shed.outcome = 'shed'
+                shed.event.set()
+
+            waiter = _Waiter(priority, next(self._order))
+            heapq.heappush(self._queue, waiter)
+
+        waiter.event.wait(self.timeout)
+
+        with self._lock:
+            if waiter.outcome is None:
+                # Timed out, the slot may still be granted while the lock was being taken
+                waiter.outcome = 'deadline'
+                self._queue.remove(waiter)
+                heapq.heapify(self._queue)
+
+            if waiter.outcome != 'granted':
+                self._reject(waiter.outcome, priority)
+
+    def release(self):
+        with self._lock:
+            if self._queue:
+                # The slot goes straight to the next request
+                waiter = heapq.heappop(self._queue)
+                waiter.outcome = 'granted'
+                waiter.event.set()
+            else:
+                self.in_flight -= 1
@@ -0,0 +1,55 @@
+# coding: utf-8
+import threading
+import time
+
+from . import forksafe
+from .exceptions import CircuitOpenException
+
+__all__ = ['CircuitBreaker', 'CLOSED', 'OPEN', 'HALF_OPEN']
+
+CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+
+class CircuitBreaker(object):
+    """
+    Stops sending requests after ``failure_threshold`` consecutive failures
+    (transport errors, unparseable answers and OVERLOAD_ERRORS; Cielo
+    refusing a transaction isn't a failure), passed to the requests as
+    ``circuit_breaker``. While open, requests raise CircuitOpenException
+    without contacting Cielo. After ``reset_timeout`` seconds a single
+    request is let through, closing the circuit if it succeeds.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                # This request probes whether Cielo is back, the others keep failing fast
+                self.state = HALF_OPEN
+                return
+        raise CircuitOpenException(self.state, self.opened_at)
+
+    def record(self, failed):
+        with self._lock:
+            if not failed:
+                self.state = CLOSED
+                self.failures = 0
+                return
+
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.time()
@@ -0,0 +1,311 @@
+# coding: utf-8
+import csv
+import json
+import os
+import sys
+import threading
+from collections import Counter
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+from .exceptions import CieloException
+from .cache import card_fingerprint
+from .main import CieloToken, Transaction
+from .ratelimit import TokenBucket
+from .util import luhn_valid, truncate_card
+
+__all__ = [
+    'read_cards', 'tokenize_cards', 'BulkTokenizationResult',
+    'run_batch', 'capture_transactions', 'cancel_transactions', 'refresh_transactions',
+]
+
+RESULT_FIELDS = ('source_id', 'token', 'card', 'status')
+
+
+def _open_csv(path, mode='r'):
+    # The csv module wants binary files on Python 2 and untranslated text on Python 3
+    if sys.version_info[0] < 3:
+        return open(path, mode + 'b')
+    return open(path, mode, newline='')
+
+
+def read_cards(path):
+    """
+    Iterates over the cards stored in a CSV (with a header line) or JSON lines
+    file. Each card is a dict containing ``source_id`` and the CieloToken
+    card arguments.
+    """
+    with _open_csv(path) as f:
+        if path.endswith(('.jsonl', '.json')):
+            rows = (json.loads(line) for line in f if line.strip())
+        else:
+            rows = csv.DictReader(f)
+
+        for row in rows:
+            yield row
+
+
+class BulkTokenizationResult(object):
+    """
+    Counters for a tokenization run. ``statuses`` is keyed by the status
+    written to the output (``ok``, ``invalid:<reason>`` or ``error:<code>``).
+    """
+
+    def __init__(self):
+        self.statuses = Counter()
+        self.read = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.requests = 0
+
+    def __repr__(self):
+        return '<BulkTokenizationResult read={0} requests={1} duplicates={2} skipped={3} {4}>'.format(
+            self.read, self.requests, self.duplicates, self.skipped, dict(self.statuses)
+        )
+
+
+class _Pipeline(object):
+
+    def __init__(self, output, result, concurrency, rate, token_kwargs):
+        # Fingerprints only live during the run, so a random key is enough
+        self.secret = os.urandom(16)
+        self.output = output
+        self.result = result
+        self.token_kwargs = token_kwargs
+        self.rate_limiter = TokenBucket(rate) if rate else None
+
+        # fingerprint -> source ids waiting for the token / (token, card, status)
+        self.pending = {}
+        self.done = {}
+
+        self.work = Queue(maxsize=concurrency * 4)
+        self.results = Queue()
+        self.workers = [threading.Thread(target=self._worker) for i in range(concurrency)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def _worker(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+
+            fingerprint, token = item
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            try:
+                token.create_token()
+            except CieloException as e:
+                outcome = ('', truncate_card(token.card_number), 'error:{0}'.format(e.id))
+            except Exception as e:
+                outcome = ('', truncate_card(token.card_number), 'error:{0}'.format(e.__class__.__name__))
+            else:
+                outcome = (token.token, token.card, 'ok')
+            self.results.put((fingerprint, outcome))
+
+    def write(self, source_id, token, card, status):
+        self.output.writerow((source_id, token, card, status))
+        self.result.statuses[status] += 1
+
+    def drain(self, block=False):
+        while True:
+            try:
+                fingerprint, outcome = self.results.get(block=block and bool(self.pending))
+            except Empty:
+                return
+
+            self.done[fingerprint] = outcome
+            for source_id in self.pending.pop(fingerprint):
+                self.write(source_id, *outcome)
+
+            if block and not self.pending:
+                return
+
+    def submit(self, card):
+        source_id = card['source_id']
+        card_number = str(card['card_number']).strip()
+
+        if not luhn_valid(card_number):
+            self.write(source_id, '', '', 'invalid:luhn')
+            return
+
+        try:
+            token = CieloToken(
+                card_type=card['card_type'],
+                card_number=card_number,
+                exp_month=int(card['exp_month']),
+                exp_year=int(card['exp_year']),
+                card_holders_name=card['card_holders_name'],
+                **self.token_kwargs
+            )
+        except (ValueError, TypeError, KeyError) as e:
+            reason = 'expired' if 'expired' in u'{0}'.format(e) else 'card_data'
+            self.write(source_id, '', truncate_card(card_number), 'invalid:{0}'.format(reason))
+            return
+
+        fingerprint = card_fingerprint(self.secret, card_number, token.expiration)
+        if fingerprint in self.done:
+            self.result.duplicates += 1
+            self.write(source_id, *self.done[fingerprint])
+        elif fingerprint in self.pending:
+            self.result.duplicates += 1
+            self.pending[fingerprint].append(source_id)
+        else:
+            self.result.requests += 1
+            self.pending[fingerprint] = [source_id]
+            self.work.put((fingerprint, token))
+
+    def close(self):
+        self.drain(block=True)
+        for worker in self.workers:
+            self.work.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+def _processed_source_ids(output_path):
+    with _open_csv(output_path) as f:
+        reader = csv.reader(f)
+        return set(row[0] for row in reader if row and row[0] != RESULT_FIELDS[0])
+
+
+def tokenize_cards(cards, output_path, affiliation_id, api_key, concurrency=8, rate=None,
+                   resume=True, **kwargs):
+    """
+    Tokenizes every card in ``cards`` (an iterable of dicts, see read_cards),
+    writing ``source_id, token, card, status`` CSV lines to ``output_path`` as
+    results arrive.
+
+    Cards are checked locally (Luhn and expiration) before being sent,
+    identical cards are only tokenized once per run, and at most ``rate``
+    requests per second are made by ``concurrency`` threads. With ``resume``
+    the source ids already present in ``output_path`` are skipped.
+    Any other keyword argument (sandbox, token_cache...) goes to CieloToken.
+    """
+    result = BulkTokenizationResult()
+
+    done_ids = set()
+    new_file = True
+    if resume and os.path.exists(output_path) and os.path.getsize(output_path):
+        done_ids = _processed_source_ids(output_path)
+        new_file = False
+
+    with _open_csv(output_path, 'a' if resume else 'w') as f:
+        output = csv.writer(f)
+        if new_file:
+            output.writerow(RESULT_FIELDS)
+
+        kwargs.update(affiliation_id=affiliation_id, api_key=api_key)
+        pipeline = _Pipeline(output, result, concurrency, rate, kwargs)
+        try:
+            for card in cards:
+                result.read += 1
+                if str(card['source_id']) in done_ids:
+                    result.skipped += 1
+                    continue
+
+                pipeline.submit(card)
+                pipeline.drain()
+                f.flush()
+        finally:
+            pipeline.close()
+
+    return result
+
+
+def run_batch(func, items, concurrency=8):
+    """
+    Calls ``func(item)`` for every item on ``concurrency`` threads, yielding
+    ``(item, result, exception)`` tuples as they complete. An exception
+    raised by ``items`` itself stops the batch: it is re-raised once the
+    items already taken are done.
+    """
+    items = iter(items)
+    results = Queue()
+    lock = threading.Lock()
+    failures = []
+
+    def worker():
+        try:
+            while True:
+                with lock:
+                    if failures:
+                        return
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                    except Exception as e:
+                        failures.append(e)
+                        return
+                try:
+                    results.put((item, func(item), None))
+                except Exception as e:
+                    results.put((item, None, e))
+        finally:
+            results.put(None)
+
+    for i in range(concurrency):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    running = concurrency
+    while running:
+        result = results.get()
+        if result is None:
+            running -= 1
+        else:
+            yield result
+
+    if failures:
+        raise failures[0]
+
+
+def _transaction_batch(method, items, affiliation_id, api_key, concurrency, concurrency_limiter, kwargs,
+                       arguments=lambda transaction_id: (transaction_id, {})):
+    # With an adaptive limiter the threads are only an upper bound, the limiter picks the concurrency
+    if concurrency_limiter is not None:
+        concurrency = concurrency_limiter.max_limit
+
+    def run(item):
+        transaction_id, method_kwargs = arguments(item)
+        transaction = Transaction(
+            affiliation_id=affiliation_id, api_key=api_key, concurrency_limiter=concurrency_limiter, **kwargs
+        )
+        getattr(transaction, method)(transaction_id=transaction_id, **method_kwargs)
+        return transaction
+
+    return run_batch(run, items, concurrency)
+
+
+def capture_transactions(transaction_ids, affiliation_id, api_key, concurrency=8, concurrency_limiter=None, **kwargs):
+    """
+    Captures the given TIDs, yielding ``(tid, Transaction, exception)`` as
+    they complete. Any other keyword argument goes to Transaction.
+    """
+    return _transaction_batch('capture', transaction_ids, affiliation_id, api_key, concurrency, concurrency_limiter, kwargs)
+
+
+def cancel_transactions(cancelations, affiliation_id, api_key, concurrency=8, concurrency_limiter=None, **kwargs):
+    """
+    Cancels ``(tid, amount)`` pairs, yielding ``((tid, amount), Transaction,
+    exception)`` as they complete.
+    """
+    return _transaction_batch(
+        'cancel', cancelations, affiliation_id, api_key, concurrency, concurrency_limiter, kwargs,
+        arguments=lambda cancelation: (cancelation[0], {'amount': cancelation[1]})
+    )
+
+
+def refresh_transactions(transaction_ids, affiliation_id, api_key, concurrency=8, concurrency_limiter=None, **kwargs):
+    """
+    Refreshes the status of the given TIDs, yielding ``(tid, Transaction,
+    exception)`` as they complete.
+    """
+    return _transaction_batch('refresh', transaction_ids, affiliation_id, api_key, concurrency, concurrency_limiter, kwargs)
@@ -0,0 +1,218 @@
+# coding: utf-8
+import hashlib
+import hmac
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from . import forksafe
+
+__all__ = ['TokenCache', 'MemoryTokenStore', 'SQLiteTokenStore', 'card_fingerprint']
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return u'{0}'.format(value).encode('utf-8')
+
+
+def card_fingerprint(secret, card_number, expiration):
+    """
+    Keyed hash (HMAC-SHA256) identifying a card by its number and expiration.
+    The card number can't be recovered from it without the secret.
+    """
+    message = _to_bytes(card_number) + b'|' + _to_bytes(expiration)
+    return hmac.new(_to_bytes(secret), message, hashlib.sha256).hexdigest()
+
+
+class MemoryTokenStore(object):
+    """
+    Thread safe LRU mapping with per entry expiration.
+    """
+
+    def __init__(self, max_size=1024, ttl=86400):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key):
+        """
+        Returns a ``(value, expires_at)`` tuple or None.
+        """
+        with self._lock:
+            try:
+                expires_at, value = self._entries.pop(key)
+            except KeyError:
+                return None
+            if expires_at < time.time():
+                return None
+            # Re-insert to mark as the most recently used entry
+            self._entries[key] = (expires_at, value)
+            return value, expires_at
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires_at, value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteTokenStore(object):
+    """
+    Token storage shared by every process on the host, backed by a SQLite
+    database in WAL mode. Connections are kept per thread and per process.
+    """
+    prune_every = 100
+
+    def __init__(self, path, ttl=86400, max_entries=1000000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS tokens ('
+            'key TEXT PRIMARY KEY, token TEXT, status TEXT, card TEXT, expires_at REAL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS tokens_expires_at ON tokens (expires_at)')
+        connection.commit()
+
+    def _connection(self):
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.connection = sqlite3.connect(self.path, timeout=30)
+            self._local.pid = pid
+        return self._local.connection
+
+    def get(self, key):
+        entry = self.get_entry(key)
+        return entry[0] if entry is not None else None
+
+    def get_entry(self, key):
+        """
+        Returns a ``(value, expires_at)`` tuple or None.
+        """
+        row = self._connection().execute(
+            'SELECT token, status, card, expires_at FROM tokens WHERE key = ? AND expires_at >= ?',
+            (key, time.time())
+        ).fetchone()
+        return (tuple(row[:3]), row[3]) if row else None
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        connection = self._connection()
+        with connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO tokens (key, token, status, card, expires_at) VALUES (?, ?, ?, ?, ?)',
+                (key,) + tuple(value) + (expires_at,)
+            )
+
+        self._writes += 1
+        if self._writes % self.prune_every == 0:
+            self.prune()
+
+    def delete(self, key):
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM tokens WHERE key = ?', (key,))
+
+    def prune(self):
+        """
+        Removes expired entries and, when over ``max_entries``, the ones closest to expiring.
+        """
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM tokens WHERE expires_at < ?', (time.time(),))
+            excess = connection.execute('SELECT COUNT(*) FROM tokens').fetchone()[0] - self.max_entries
+            if excess > 0:
+                connection.execute(
+                    'DELETE FROM tokens WHERE key IN '
+                    '(SELECT key FROM tokens ORDER BY expires_at LIMIT ?)', (excess,)
+                )
+
+    def clear(self):
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM tokens')
+
+
+class TokenCache(object):
+    """
+    Two tier cache for the tokens created by CieloToken: an in-memory LRU
+    and an optional shared store (see SQLiteTokenStore). Entries found in
+    the store are kept in memory until they expire in the store.
+
+    Entries are keyed by the affiliation id and a card fingerprint, so the
+    card number itself is never kept.
+    """
+
+    def __init__(self, secret, max_size=1024, ttl=86400, store=None):
+        self.secret = secret
+        self.ttl = ttl
+        self.memory = MemoryTokenStore(max_size=max_size, ttl=ttl)
+        self.store = store
+
+    def key(self, affiliation_id, card_number, expiration):
+        return u'{0}:{1}'.format(affiliation_id, card_fingerprint(self.secret, card_number, expiration))
+
+    def get(self, affiliation_id, card_number, expiration):
+        """
+        Returns a ``(token, status, truncated card)`` tuple or None.
+        """
+        key = self.key(affiliation_id, card_number, expiration)
+
+        value = self.memory.get(key)
+        if value is None and self.store is not None:
+            entry = self.store.get_entry(key)
+            if entry is not None:
+                # Only for as long as the stored entry lives
+                value, expires_at = entry
+                self.memory.set(key, value, min(expires_at - time.time(), self.ttl))
+        return value
+
+    def set(self, affiliation_id, card_number, expiration, token, status, card):
+        key = self.key(affiliation_id, card_number, expiration)
+        value = (token, status, card)
+
+        self.memory.set(key, value, self.ttl)
+        if self.store is not None:
+            self.store.set(key, value, self.ttl)
+
+    def invalidate(self, affiliation_id, card_number, expiration):
+        key = self.key(affiliation_id, card_number, expiration)
+
+        self.memory.delete(key)
+        if self.store is not None:
+            self.store.delete(key)
+
+    def clear(self):
+        self.memory.clear()
+        if self.store is not None:
+            self.store.clear()
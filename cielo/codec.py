@@ -0,0 +1,243 @@
+# coding: utf-8
+"""
+Compact binary serialization of request specs and transaction results, to
+hand them between processes (web workers, celery tasks, stores) instead of
+pickling whole attempts.
+
+Every record starts with a version byte, currently 1. Integers are little
+endian and strings UTF-8, preceded in the header by their length (0xffff
+for None). Amounts are in cents, as sent to Cielo (-1 for None).
+
+A RequestSpec is::
+
+    B version, B operation, B flags (1: capture, 2: tokenize), B installments,
+    B transaction type, q amount, 5 x H lengths of
+    affiliation_id, order_id, transaction_id, token, card_type
+
+followed by the strings. Specs never carry card data: authorizations are
+token payments. A TransactionResult is::
+
+    B version, B operation, q amount, 5 x H lengths of
+    affiliation_id, transaction_id, order_id, status, error
+
+followed by the strings. A batch is ``B version, I count`` followed by its
+records back to back.
+"""
+import struct
+from collections import namedtuple
+from decimal import Decimal
+
+from .constants import AUTHORIZATION, CAPTURE, CANCELATION, STATUS, TOKENIZATION, CASH
+from .exceptions import CieloException
+from .lean import LeanTokenPaymentAttempt, LeanTransaction
+
+__all__ = [
+    'RequestSpec', 'TransactionResult', 'encode_spec', 'decode_spec', 'encode_specs', 'decode_specs',
+    'encode_result', 'decode_result', 'encode_results', 'decode_results', 'result_from', 'execute',
+]
+
+VERSION = 1
+
+OPERATIONS = (AUTHORIZATION, CAPTURE, CANCELATION, STATUS, TOKENIZATION)
+_OPERATION_CODES = dict((operation, code) for code, operation in enumerate(OPERATIONS))
+
+SPEC = struct.Struct('<BBBBBq5H')
+RESULT = struct.Struct('<BBq5H')
+BATCH = struct.Struct('<BI')
+
+CAPTURE_FLAG, TOKENIZE_FLAG = 1, 2
+NONE = 0xffff
+
+RequestSpec = namedtuple(
+    'RequestSpec',
+    'operation affiliation_id order_id transaction_id amount token card_type transaction_type installments '
+    'capture tokenize'
+)
+RequestSpec.__new__.__defaults__ = (None, None, None, None, None, CASH, 1, False, False)
+
+TransactionResult = namedtuple('TransactionResult', 'operation affiliation_id transaction_id order_id status error amount')
+TransactionResult.__new__.__defaults__ = (None, None, None, None)
+
+
+def _cents(amount):
+    # Rounded like moneyfmt, which formats the totals sent to Cielo
+    return -1 if amount is None else int(Decimal(amount).scaleb(2).to_integral_value())
+
+
+def _amount(cents):
+    return None if cents == -1 else Decimal(cents).scaleb(-2)
+
+
+def _encode_strings(values):
+    lengths = []
+    encoded = []
+    for value in values:
+        if value is None:
+            lengths.append(NONE)
+        else:
+            value = value if isinstance(value, bytes) else u'{0}'.format(value).encode('utf-8')
+            lengths.append(len(value))
+            encoded.append(value)
+    return lengths, encoded
+
+
+# Records of a batch mostly share their string lengths, so their layouts are cached
+_string_layouts = {}
+
+
+def _string_layout(lengths):
+    try:
+        return _string_layouts[lengths]
+    except KeyError:
+        if len(_string_layouts) >= 4096:
+            _string_layouts.clear()
+        layout = struct.Struct('<' + ''.join('{0}s'.format(length) for length in lengths if length != NONE))
+        _string_layouts[lengths] = layout
+        return layout
+
+
+def _decode_strings(data, offset, lengths):
+    layout = _string_layout(lengths)
+    values = [value.decode('utf-8') for value in layout.unpack_from(data, offset)]
+    if NONE in lengths:
+        values = iter(values)
+        values = [None if length == NONE else next(values) for length in lengths]
+    return values, offset + layout.size
+
+
+def _check_version(version):
+    if version != VERSION:
+        raise ValueError('unsupported serialization version {0}'.format(version))
+
+
+def encode_spec(spec):
+    lengths, strings = _encode_strings(
+        (spec.affiliation_id, spec.order_id, spec.transaction_id, spec.token, spec.card_type)
+    )
+    flags = (CAPTURE_FLAG if spec.capture else 0) | (TOKENIZE_FLAG if spec.tokenize else 0)
+    header = SPEC.pack(VERSION, _OPERATION_CODES[spec.operation], flags, spec.installments or 0,
+                       spec.transaction_type or 0, _cents(spec.amount), *lengths)
+    return header + b''.join(strings)
+
+
+def _decode_spec_from(data, offset):
+    fields = SPEC.unpack_from(data, offset)
+    _check_version(fields[0])
+    (affiliation_id, order_id, transaction_id, token, card_type), offset = _decode_strings(
+        data, offset + SPEC.size, fields[6:]
+    )
+    flags = fields[2]
+    spec = RequestSpec(OPERATIONS[fields[1]], affiliation_id, order_id, transaction_id, _amount(fields[5]),
+                       token, card_type, fields[4] or None, fields[3] or None,
+                       bool(flags & CAPTURE_FLAG), bool(flags & TOKENIZE_FLAG))
+    return spec, offset
+
+
+def decode_spec(data):
+    return _decode_spec_from(data, 0)[0]
+
+
+def encode_result(result):
+    lengths, strings = _encode_strings(
+        (result.affiliation_id, result.transaction_id, result.order_id, result.status, result.error)
+    )
+    header = RESULT.pack(VERSION, _OPERATION_CODES[result.operation], _cents(result.amount), *lengths)
+    return header + b''.join(strings)
+
+
+def _decode_result_from(data, offset):
+    fields = RESULT.unpack_from(data, offset)
+    _check_version(fields[0])
+    (affiliation_id, transaction_id, order_id, status, error), offset = _decode_strings(
+        data, offset + RESULT.size, fields[3:]
+    )
+    result = TransactionResult(OPERATIONS[fields[1]], affiliation_id, transaction_id, order_id, status, error,
+                               _amount(fields[2]))
+    return result, offset
+
+
+def decode_result(data):
+    return _decode_result_from(data, 0)[0]
+
+
+def _encode_batch(encode, records):
+    encoded = [encode(record) for record in records]
+    return BATCH.pack(VERSION, len(encoded)) + b''.join(encoded)
+
+
+def _decode_batch(decode_from, data):
+    version, count = BATCH.unpack_from(data, 0)
+    _check_version(version)
+    offset = BATCH.size
+    records = []
+    for i in range(count):
+        record, offset = decode_from(data, offset)
+        records.append(record)
+    return records
+
+
+def encode_specs(specs):
+    return _encode_batch(encode_spec, specs)
+
+
+def decode_specs(data):
+    return _decode_batch(_decode_spec_from, data)
+
+
+def encode_results(results):
+    return _encode_batch(encode_result, results)
+
+
+def decode_results(data):
+    return _decode_batch(_decode_result_from, data)
+
+
+def result_from(request, operation, error=None):
+    """
+    The TransactionResult of a request (an attempt or Transaction, lean or
+    not) after ``operation``. ``error`` is the Cielo error code, taken from
+    the request when not given.
+    """
+    total = getattr(request, 'total', None)
+    return TransactionResult(
+        operation, request.affiliation_id, getattr(request, 'transaction_id', None),
+        getattr(request, 'order_id', None) or None, getattr(request, 'status', None),
+        error or getattr(request, 'error_id', None),
+        Decimal(total).scaleb(-2) if total else None,
+    )
+
+
+def execute(spec, **request_kwargs):
+    """
+    Runs a RequestSpec with a lean request, returning its TransactionResult.
+    Cielo errors are results too; other exceptions are raised. The keyword
+    arguments (api_key, scheduler, merchant...) go to the request.
+    """
+    kwargs = dict(request_kwargs, affiliation_id=spec.affiliation_id)
+    if spec.order_id is not None:
+        kwargs['order_id'] = spec.order_id
+    if spec.amount is not None:
+        kwargs['total'] = spec.amount
+
+    if spec.operation == AUTHORIZATION:
+        request = LeanTokenPaymentAttempt(
+            token=spec.token, card_type=spec.card_type, transaction=spec.transaction_type,
+            installments=spec.installments, capture=spec.capture, tokenize=spec.tokenize, **kwargs
+        )
+        run = request.get_authorized
+    else:
+        request = LeanTransaction(**kwargs)
+        if spec.operation == CAPTURE:
+            run = lambda: request.capture(transaction_id=spec.transaction_id)
+        elif spec.operation == CANCELATION:
+            run = lambda: request.cancel(transaction_id=spec.transaction_id, amount=spec.amount)
+        elif spec.operation == STATUS:
+            run = lambda: request.refresh(transaction_id=spec.transaction_id)
+        else:
+            raise ValueError('{0} specs are not supported'.format(spec.operation))
+
+    try:
+        run()
+    except CieloException as e:
+        return result_from(request, spec.operation, error=e.id)
+    return result_from(request, spec.operation)
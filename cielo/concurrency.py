@@ -0,0 +1,110 @@
+# coding: utf-8
+import threading
+import time
+from collections import deque
+
+from . import forksafe
+
+__all__ = ['AdaptiveConcurrencyLimiter']
+
+
+class AdaptiveConcurrencyLimiter(object):
+    """
+    AIMD concurrency limit for batch jobs, passed to the requests as
+    ``concurrency_limiter``.
+
+    Every request holds a slot while it runs. Requests completing within the
+    latency target while the limit is in use raise it by about one per round
+    trip; a request slower than the target, failing with one of the
+    OVERLOAD_ERRORS or not getting a parseable answer cuts it by ``backoff``
+    (at most once per round trip). Without ``latency_target`` the target is
+    ``tolerance`` times the fastest latency seen so far.
+
+    Limit changes are kept in ``changes`` as ``(time, old, new, reason)``
+    tuples and reported to ``on_change(old, new, reason)``.
+    """
+
+    def __init__(self, initial=4, min_limit=1, max_limit=64, latency_target=None, tolerance=2.0,
+                 backoff=0.5, on_change=None):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.on_change = on_change
+
+        self.changes = deque(maxlen=1000)
+        self.samples = 0
+        self.overloads = 0
+        self.min_latency = None
+
+        self._in_flight = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        # The parent's requests don't run in the child
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def acquire(self):
+        """
+        Waits for a free slot, returning the time it was taken.
+        """
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight += 1
+        return time.time()
+
+    def release(self, started_at, error=False):
+        now = time.time()
+        latency = now - started_at
+
+        with self._condition:
+            busy = self._in_flight >= int(self.limit)
+            self._in_flight -= 1
+            self.samples += 1
+
+            if not error:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                target = self.latency_target or self.min_latency * self.tolerance
+                overloaded = latency > target
+                reason = 'latency'
+            else:
+                overloaded = True
+                reason = 'error'
+
+            if overloaded:
+                self.overloads += 1
+                # Requests started before the last decrease don't reflect it yet
+                if started_at >= self._last_decrease:
+                    self._last_decrease = now
+                    self._set_limit(max(self.min_limit, self.limit * self.backoff), reason)
+            elif busy:
+                self._set_limit(min(self.max_limit, self.limit + 1.0 / self.limit), 'increase')
+
+            self._condition.notify_all()
+
+    def _set_limit(self, limit, reason):
+        old, self.limit = self.limit, limit
+        if int(old) != int(limit):
+            self.changes.append((time.time(), int(old), int(limit), reason))
+            if self.on_change is not None:
+                self.on_change(int(old), int(limit), reason)
+
+    def metrics(self):
+        return {
+            'limit': int(self.limit),
+            'in_flight': self._in_flight,
+            'samples': self.samples,
+            'overloads': self.overloads,
+            'min_latency': self.min_latency,
+        }
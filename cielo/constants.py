@@ -14,6 +14,25 @@ CARD_TYPE_C = (
     (JCB, u'JCB')
 )
 
+# Valid lengths and BIN ranges (first digits, inclusive) for each card type
+CARD_NUMBER_RULES = {
+    VISA: ((13, 16, 19), (('4', '4'),)),
+    MASTERCARD: ((16,), (('51', '55'), ('2221', '2720'))),
+    AMEX: ((15,), (('34', '34'), ('37', '37'))),
+    DINERS: ((14, 16), (('300', '305'), ('36', '36'), ('38', '39'))),
+    AURA: ((16, 19), (('50', '50'),)),
+    DISCOVER: ((16, 19), (('6011', '6011'), ('622126', '622925'), ('644', '649'), ('65', '65'))),
+    ELO: ((16,), (
+        ('401178', '401179'), ('431274', '431274'), ('438935', '438935'), ('451416', '451416'),
+        ('457393', '457393'), ('457631', '457632'), ('504175', '504175'), ('506699', '506778'),
+        ('509000', '509999'), ('627780', '627780'), ('636297', '636297'), ('636368', '636368'),
+        ('650031', '650033'), ('650035', '650051'), ('650405', '650439'), ('650485', '650538'),
+        ('650541', '650598'), ('650700', '650718'), ('650720', '650727'), ('650901', '650920'),
+        ('651652', '651679'), ('655000', '655019'), ('655021', '655058'),
+    )),
+    JCB: ((16,), (('3528', '3589'),)),
+}
+
 CASH, INSTALLMENT_STORE, INSTALLMENT_CIELO = 1, 2, 3
 TRANSACTION_TYPE_C = (
     (CASH, u'À vista'),
@@ -34,6 +53,39 @@ TRANSACTION_STATUS = {
     '12': u'Cancelamento em andamento',
 }
 
+# Statuses which won't change anymore
+TERMINAL_STATUSES = ('3', '5', '6', '9')
+
+# Statuses of transactions waiting for the customer to authenticate
+AUTHENTICATION_PENDING_STATUSES = ('0', '1', '2', '10')
+
+# Days an authorized transaction can wait for its capture (031-Prazo de captura vencido)
+CAPTURE_DEADLINE_DAYS = 5
+
+AUTHORIZATION, CAPTURE, CANCELATION, STATUS, TOKENIZATION = (
+    'authorization', 'capture', 'cancelation', 'status', 'tokenization'
+)
+TEMPLATE_OPERATIONS = {
+    'authorize.xml': AUTHORIZATION,
+    'authorize_buypagecielo.xml': AUTHORIZATION,
+    'authorize_token.xml': AUTHORIZATION,
+    'capture.xml': CAPTURE,
+    'cancel.xml': CANCELATION,
+    'status_using_order_id.xml': STATUS,
+    'status_using_tid.xml': STATUS,
+    'token.xml': TOKENIZATION,
+}
+
+# Request priorities, from customer facing to background work
+INTERACTIVE, TRANSACTIONAL, BACKGROUND = 0, 1, 2
+OPERATION_PRIORITIES = {
+    AUTHORIZATION: INTERACTIVE,
+    TOKENIZATION: INTERACTIVE,
+    CAPTURE: TRANSACTIONAL,
+    CANCELATION: TRANSACTIONAL,
+    STATUS: BACKGROUND,
+}
+
 SANDBOX_URL = 'https://qasecommerce.cielo.com.br/servicos/ecommwsec.do'
 PRODUCTION_URL = 'https://ecommerce.cbmp.com.br/servicos/ecommwsec.do'
 CIELO_MSG_ERRORS = {
@@ -57,4 +109,5 @@ CIELO_MSG_ERRORS = {
     '099': u'Falha no sistema.(099-Erro inesperado)',
 }
 
-
+# Errors meaning Cielo is struggling, used as back-pressure signals
+OVERLOAD_ERRORS = ('099',)
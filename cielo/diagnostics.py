@@ -0,0 +1,113 @@
+# coding: utf-8
+import heapq
+import itertools
+import json
+import re
+import threading
+import time
+from collections import deque
+
+from . import forksafe
+from .util import redact_payload
+
+__all__ = ['SlowRequestLog', 'PHASES']
+
+# Phases timed for every request, in the order they happen. Connecting and
+# the TLS handshake aren't reported apart by requests, they are in ttfb.
+PHASES = ('admission', 'rate_limit', 'pool_wait', 'ttfb', 'read', 'parse')
+
+_BETWEEN_TAGS = re.compile(r'>\s+<')
+
+
+class SlowRequestLog(object):
+    """
+    Keeps the ``slowest`` slowest requests taking at least ``threshold``
+    seconds and the ``failed`` latest failures (exceptions and Cielo
+    errors), passed to the requests as ``request_log``. Entries are dicts
+    with the phase timings (see PHASES), the operation, the redacted
+    payload, the HTTP status and Cielo's error code.
+
+    Memory is bounded and requests faster than the threshold only cost a
+    comparison, so it can stay enabled in production.
+    """
+
+    def __init__(self, slowest=50, failed=50, threshold=1.0, payload_size=512):
+        self.threshold = threshold
+        self.payload_size = payload_size
+        self.size = slowest
+        self._slowest = []
+        self._failed = deque(maxlen=failed)
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def record(self, request, operation, payload, started_at, response_dict=None, exception=None):
+        duration = time.time() - started_at
+        error = response_dict.get('erro') if response_dict is not None else None
+        failed = exception is not None or error is not None
+        if not failed and duration < self.threshold:
+            return
+
+        response = getattr(request, 'cielo_response', None)
+        entry = {
+            'started_at': started_at,
+            'duration': duration,
+            'phases': dict(getattr(request, 'timings', {})),
+            'operation': operation,
+            'affiliation_id': request.affiliation_id,
+            'order_id': getattr(request, 'order_id', None),
+            'transaction_id': getattr(request, 'transaction_id', None),
+            'payload': _BETWEEN_TAGS.sub('><', redact_payload(payload))[:self.payload_size],
+            'http_status': getattr(response, 'status_code', None),
+            'error': error['codigo'] if error is not None else None,
+            'exception': repr(exception) if exception is not None else None,
+        }
+
+        with self._lock:
+            if failed:
+                self._failed.append(entry)
+            if duration >= self.threshold:
+                item = (duration, next(self._order), entry)
+                if len(self._slowest) < self.size:
+                    heapq.heappush(self._slowest, item)
+                elif item > self._slowest[0]:
+                    heapq.heapreplace(self._slowest, item)
+
+    def slowest(self, operation=None):
+        """
+        Slowest requests, slowest first.
+        """
+        with self._lock:
+            items = sorted(self._slowest, reverse=True)
+        return [entry for duration, order, entry in items if operation is None or entry['operation'] == operation]
+
+    def failures(self, operation=None):
+        """
+        Failed requests, latest first.
+        """
+        with self._lock:
+            entries = list(reversed(self._failed))
+        return [entry for entry in entries if operation is None or entry['operation'] == operation]
+
+    def dump(self, fp=None):
+        """
+        Writes the entries as JSON, one per line, returning them as a string
+        when no file is given.
+        """
+        lines = [
+            json.dumps(dict(entry, kind=kind), sort_keys=True)
+            for kind, entries in (('slow', self.slowest()), ('failed', self.failures()))
+            for entry in entries
+        ]
+        dumped = ''.join(line + '\n' for line in lines)
+        if fp is None:
+            return dumped
+        fp.write(dumped)
+
+    def clear(self):
+        with self._lock:
+            self._slowest = []
+            self._failed.clear()
@@ -1,6 +1,9 @@
 # coding: utf-8
 
-__all__ = ['CieloException', 'GetAuthorizedException', 'CaptureException', 'TokenException']
+__all__ = [
+    'CieloException', 'GetAuthorizedException', 'CaptureException', 'TokenException',
+    'RequestRejectedException', 'CircuitOpenException',
+]
 
 class CieloException(Exception):
     def __init__(self, id, message=None, raw_data=None):
@@ -24,3 +27,25 @@ class CaptureException(Exception):
 
 class TokenException(Exception):
     pass
+
+
+class RequestRejectedException(Exception):
+    """
+    Raised without contacting Cielo when the AdmissionController has no room
+    for the request.
+    """
+    def __init__(self, reason, priority=None):
+        super(RequestRejectedException, self).__init__(reason, priority)
+        self.reason = reason
+        self.priority = priority
+
+
+class CircuitOpenException(Exception):
+    """
+    Raised without contacting Cielo while the CircuitBreaker of the request
+    is open.
+    """
+    def __init__(self, state, opened_at=None):
+        super(CircuitOpenException, self).__init__(state, opened_at)
+        self.state = state
+        self.opened_at = opened_at
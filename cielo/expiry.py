@@ -0,0 +1,140 @@
+# coding: utf-8
+import heapq
+import threading
+from collections import namedtuple, defaultdict
+from datetime import datetime, timedelta
+
+from . import forksafe
+from .bulk import capture_transactions
+from .constants import CAPTURE_DEADLINE_DAYS, TERMINAL_STATUSES
+from .exceptions import CieloException
+
+__all__ = ['CaptureDeadlineTracker', 'PendingCapture']
+
+PendingCapture = namedtuple('PendingCapture', 'deadline transaction_id affiliation_id order_id total')
+
+
+def _authorized_at(attempt):
+    try:
+        return datetime.strptime(attempt.transaction['autorizacao']['data-hora'][:19], '%Y-%m-%dT%H:%M:%S')
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return datetime.now()
+
+
+class CaptureDeadlineTracker(object):
+    """
+    Keeps the authorized but not captured transactions ordered by capture
+    deadline (``window`` after the authorization), to capture them before
+    they expire. Passed to the attempts as ``capture_tracker`` it records
+    every authorization made with ``capture=False`` and forgets
+    transactions once captured, cancelled or denied.
+    """
+
+    def __init__(self, window=timedelta(days=CAPTURE_DEADLINE_DAYS)):
+        self.window = window
+        self._heap = []
+        self._pending = {}
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._pending
+
+    def update(self, attempt):
+        if attempt.status == '4' and attempt.auto_capture == 'false':
+            if attempt.transaction_id not in self._pending:
+                self.add(attempt.transaction_id, attempt.affiliation_id, _authorized_at(attempt) + self.window,
+                         attempt.order_id, attempt.total)
+        elif attempt.status in TERMINAL_STATUSES:
+            self.discard(attempt.transaction_id)
+
+    def add(self, transaction_id, affiliation_id, deadline, order_id='', total=''):
+        pending = PendingCapture(deadline, transaction_id, affiliation_id, order_id, total)
+        with self._lock:
+            self._pending[transaction_id] = pending
+            heapq.heappush(self._heap, pending)
+            self._compact()
+
+    def discard(self, transaction_id):
+        # Removed from the heap lazily, when it reaches the top or the heap is compacted
+        with self._lock:
+            self._pending.pop(transaction_id, None)
+            self._compact()
+
+    def _compact(self):
+        # Rebuilt once stale entries are the majority, so the heap stays
+        # proportional to the pending captures however many were discarded
+        if len(self._heap) > 2 * len(self._pending) + 32:
+            self._heap = list(self._pending.values())
+            heapq.heapify(self._heap)
+
+    def _is_current(self, pending):
+        return self._pending.get(pending.transaction_id) is pending
+
+    def due_within(self, delta, now=None):
+        """
+        Pending captures whose deadline is within ``delta`` (a timedelta)
+        from now, by deadline. Walks the heap best first, without removing
+        them: O(k log k) for k results.
+        """
+        limit = (now or datetime.now()) + delta
+        due = []
+        with self._lock:
+            heap = self._heap
+            candidates = [(heap[0], 0)] if heap else []
+            while candidates:
+                pending, index = heapq.heappop(candidates)
+                if pending.deadline > limit:
+                    break
+                if self._is_current(pending):
+                    due.append(pending)
+                for child in (2 * index + 1, 2 * index + 2):
+                    if child < len(heap):
+                        heapq.heappush(candidates, (heap[child], child))
+        return due
+
+    def pop_due(self, delta, now=None):
+        """
+        Removes and returns the pending captures due within ``delta``, by
+        deadline: O(k log n).
+        """
+        limit = (now or datetime.now()) + delta
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0].deadline <= limit:
+                pending = heapq.heappop(self._heap)
+                if self._is_current(pending):
+                    del self._pending[pending.transaction_id]
+                    due.append(pending)
+        return due
+
+    def expired(self, now=None):
+        return self.due_within(timedelta(0), now)
+
+    def capture_due(self, delta, api_keys, now=None, **kwargs):
+        """
+        Captures the transactions due within ``delta`` using
+        cielo.bulk.capture_transactions, ``api_keys`` mapping affiliation
+        ids to their keys. Yields ``(PendingCapture, Transaction, exception)``;
+        captures which got no answer from Cielo go back to the tracker.
+        """
+        by_affiliation = defaultdict(list)
+        for pending in self.pop_due(delta, now):
+            by_affiliation[pending.affiliation_id].append(pending)
+
+        for affiliation_id, pendings in by_affiliation.items():
+            by_tid = dict((pending.transaction_id, pending) for pending in pendings)
+            results = capture_transactions(list(by_tid), affiliation_id, api_keys[affiliation_id], **kwargs)
+            for transaction_id, transaction, error in results:
+                pending = by_tid[transaction_id]
+                # Cielo's answers are final, only requests which didn't get one are retried
+                if error is not None and not isinstance(error, CieloException):
+                    self.add(pending.transaction_id, pending.affiliation_id, pending.deadline,
+                             pending.order_id, pending.total)
+                yield pending, transaction, error
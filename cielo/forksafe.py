@@ -0,0 +1,114 @@
+# coding: utf-8
+"""
+Fork safety for preforking servers (gunicorn, celery prefork...).
+
+Objects holding connections, locks or threads register themselves and
+get their ``_after_fork()`` called in every child, which recreates those
+(a lock held by another thread at fork time would never be released in
+the child, and pooled sockets must not be shared between processes).
+
+Children are detected with os.register_at_fork when available (Python
+3.7+), in processes started by multiprocessing if it was imported before
+cielo, and otherwise when the next request is created. ``after_fork()``
+may also be called from the server's own post fork hook.
+
+Immutable state is better built in the parent, before forking, so the
+children share it copy-on-write: see ``warmup()``.
+"""
+import gc
+import os
+import sys
+import threading
+import weakref
+
+__all__ = ['register', 'after_fork', 'check', 'warmup']
+
+_objects = weakref.WeakSet()
+_callbacks = []
+_pid = os.getpid()
+_lock = threading.Lock()
+
+
+def register(obj):
+    """
+    Calls ``obj._after_fork()`` in the children, for as long as ``obj`` lives.
+    """
+    with _lock:
+        _objects.add(obj)
+    return obj
+
+
+def register_callback(func):
+    """
+    Calls ``func()`` in the children, before the registered objects.
+    """
+    _callbacks.append(func)
+    return func
+
+
+def after_fork():
+    """
+    Resets the registered objects, once per process.
+    """
+    global _pid, _lock
+    if _pid == os.getpid():
+        return
+    _pid = os.getpid()
+    _lock = threading.Lock()
+
+    for func in _callbacks:
+        func()
+    for obj in list(_objects):
+        obj._after_fork()
+
+
+def check():
+    """
+    Runs ``after_fork()`` if this is a child which wasn't reset yet.
+    """
+    if _pid != os.getpid():
+        after_fork()
+
+
+def warmup(registry=None):
+    """
+    Builds the state shared by every request before forking: reads and
+    splits the templates, renders the credentials of the merchants in
+    ``registry`` (a MerchantRegistry) and imports the modules cielo only
+    imports on first use (requests and the XML parser). Then moves
+    everything alive to the permanent generation of the garbage collector
+    (Python 3.7+), so collections in the children don't write to those
+    pages and break their sharing.
+    """
+    import requests
+    import xmltodict
+    from .constants import TEMPLATE_OPERATIONS
+    from .template import get_template
+
+    for name in TEMPLATE_OPERATIONS:
+        get_template(name)
+
+    if registry is not None:
+        for merchant in registry:
+            for name in TEMPLATE_OPERATIONS:
+                merchant.credentials(name)
+
+    xmltodict.parse('<transacao><tid>0</tid></transacao>')
+
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+
+
+class _ForkMarker(object):
+    pass
+
+
+_marker = _ForkMarker()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=after_fork)
+elif 'multiprocessing' in sys.modules:
+    # Not imported here, it would slow ``import cielo`` down
+    from multiprocessing.util import register_after_fork
+    register_after_fork(_marker, lambda marker: after_fork())
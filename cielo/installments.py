@@ -0,0 +1,163 @@
+# coding: utf-8
+import threading
+from collections import namedtuple, OrderedDict
+from decimal import Decimal
+
+from . import forksafe
+from .constants import CARD_TYPE_C, CASH, INSTALLMENT_STORE, INSTALLMENT_CIELO
+
+__all__ = ['InstallmentRules', 'InstallmentOption', 'InstallmentPlanner']
+
+MAX_INSTALLMENTS = 12
+CENT = Decimal('0.01')
+
+
+class InstallmentOption(namedtuple(
+        'InstallmentOption', 'installments transaction_type installment first_installment total monthly_interest')):
+    """
+    One way of paying: ``first_installment`` differs from ``installment``
+    when the total doesn't split evenly, taking the remaining cents so the
+    installments add up to ``total``, the amount to authorize.
+    """
+    __slots__ = ()
+
+    def attempt_kwargs(self):
+        """
+        The ``total``, ``installments`` and ``transaction`` of an attempt.
+        """
+        return {'total': self.total, 'installments': self.installments, 'transaction': self.transaction_type}
+
+
+class InstallmentRules(object):
+    """
+    A merchant's installment rules: up to ``max_installments`` (at most 12,
+    or the card type's limit in ``card_type_limits``), none below
+    ``min_installment``, interest free up to ``interest_free`` installments
+    and compounding ``monthly_interest`` (a Decimal rate, 0.0199 for 1.99%)
+    beyond that.
+
+    ``transaction_type`` is INSTALLMENT_STORE, the merchant financing the
+    installments, or INSTALLMENT_CIELO, the card issuer financing them and
+    charging its own interest: the installments shown are then interest
+    free, the issuer's interest being unknown here.
+    """
+
+    def __init__(self, max_installments=MAX_INSTALLMENTS, min_installment=Decimal('5.00'), interest_free=None,
+                 monthly_interest=Decimal('0'), transaction_type=INSTALLMENT_STORE, card_type_limits=None):
+        if not 1 <= max_installments <= MAX_INSTALLMENTS:
+            raise ValueError(u'max_installments must be a integer between 1 and 12')
+        if interest_free is not None and not 1 <= interest_free <= max_installments:
+            raise ValueError(u'interest_free must be a integer between 1 and max_installments')
+        if transaction_type not in (INSTALLMENT_STORE, INSTALLMENT_CIELO):
+            raise ValueError(u'transaction_type must be INSTALLMENT_STORE or INSTALLMENT_CIELO')
+
+        self.max_installments = max_installments
+        self.min_installment = Decimal(min_installment)
+        self.interest_free = max_installments if interest_free is None else interest_free
+        self.monthly_interest = Decimal(monthly_interest)
+        self.transaction_type = transaction_type
+        self.card_type_limits = card_type_limits or {}
+
+    def limit(self, card_type):
+        return min(self.max_installments, self.card_type_limits.get(card_type, MAX_INSTALLMENTS))
+
+
+class InstallmentPlanner(object):
+    """
+    Installment options of a merchant (see InstallmentRules) for checkout
+    pages, as InstallmentOptions rounded to the cent like moneyfmt.
+
+    The interest factor of every number of installments is computed once.
+    Plans are cached by amount and installment limit (card types sharing a
+    limit share them), up to ``cache_size``; cached plans are served
+    without taking a lock.
+    """
+
+    def __init__(self, rules=None, card_types=None, cache_size=10000):
+        self.rules = rules or InstallmentRules()
+        self.card_types = card_types or [card_type for card_type, name in CARD_TYPE_C]
+        self.cache_size = cache_size
+
+        # Fixed installment of a financed amount of 1, by number of installments
+        rate = self.rules.monthly_interest
+        self._factors = dict(
+            (installments, rate / (1 - (1 + rate) ** -installments))
+            for installments in range(self.rules.interest_free + 1, MAX_INSTALLMENTS + 1)
+        ) if rate else {}
+
+        self._plans = OrderedDict()
+        self._tables = OrderedDict()
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _cache(self, cache, key, value):
+        with self._lock:
+            cache[key] = value
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return value
+
+    def option(self, amount, installments):
+        """
+        The InstallmentOption for paying ``amount`` in ``installments``,
+        regardless of the minimum installment.
+        """
+        amount = Decimal(amount).quantize(CENT)
+        if installments == 1:
+            return InstallmentOption(1, CASH, amount, amount, amount, Decimal('0'))
+
+        if installments in self._factors and self.rules.transaction_type == INSTALLMENT_STORE:
+            installment = (amount * self._factors[installments]).quantize(CENT)
+            return InstallmentOption(installments, INSTALLMENT_STORE, installment, installment,
+                                     installment * installments, self.rules.monthly_interest)
+
+        installment = (amount / installments).quantize(CENT)
+        return InstallmentOption(installments, self.rules.transaction_type, installment,
+                                 amount - installment * (installments - 1), amount, Decimal('0'))
+
+    def _plan(self, amount, limit):
+        options = []
+        for installments in range(1, limit + 1):
+            option = self.option(amount, installments)
+            if installments > 1 and option.installment < self.rules.min_installment:
+                break
+            options.append(option)
+        return tuple(options)
+
+    def plan(self, amount, card_type):
+        """
+        The InstallmentOptions offered for ``amount`` with ``card_type``,
+        starting with the payment in cash.
+        """
+        amount = Decimal(amount).quantize(CENT)
+        key = (amount, self.rules.limit(card_type))
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = self._cache(self._plans, key, self._plan(*key))
+        return plan
+
+    def table(self, amount):
+        """
+        The plans of every card type, by card type.
+        """
+        amount = Decimal(amount).quantize(CENT)
+        table = self._tables.get(amount)
+        if table is None:
+            table = dict((card_type, self.plan(amount, card_type)) for card_type in self.card_types)
+            table = self._cache(self._tables, amount, table)
+        return table
+
+    def validate(self, amount, card_type, installments, transaction_type=None):
+        """
+        Raises ValueError unless ``installments`` (and ``transaction_type``)
+        is one of the options offered, returning that option.
+        """
+        for option in self.plan(amount, card_type):
+            if option.installments == installments:
+                if transaction_type is not None and transaction_type != option.transaction_type:
+                    break
+                return option
+        raise ValueError(u'{0} installments are not offered for {1} with {2}'.format(installments, amount, card_type))
@@ -0,0 +1,254 @@
+# coding: utf-8
+import itertools
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+from . import forksafe
+from .util import redact_payload
+
+__all__ = ['TransactionJournal', 'JournalEntry', 'scan_journal', 'recover_journal', 'INTENT', 'OUTCOME']
+
+INTENT, OUTCOME = 1, 2
+
+# Every record is this header followed by ``size`` bytes of JSON. The crc
+# covers the kind, the op id and the JSON, so torn writes are detected.
+HEADER = struct.Struct('<IIBQ')
+OP_HEADER = struct.Struct('<BQ')
+
+JournalEntry = namedtuple('JournalEntry', 'op_id record')
+
+
+def _first_op_id():
+    # Microseconds since the epoch in the low 48 bits and the pid above them,
+    # so processes appending to the same journal never share op ids
+    return (os.getpid() & 0xffff) << 48 | int(time.time() * 1000000) & 0xffffffffffff
+
+
+def _checksum(kind, op_id, data):
+    return zlib.crc32(data, zlib.crc32(OP_HEADER.pack(kind, op_id))) & 0xffffffff
+
+
+class TransactionJournal(object):
+    """
+    Write-ahead journal of the requests sent to Cielo, passed to the
+    requests as ``journal``. Before sending, the operation's intent (with
+    the payload redacted by ``redact_payload``) is appended and synced to
+    disk; the outcome is appended once Cielo answers. Operations whose
+    answer never arrived stay in flight, see recover_journal.
+
+    Records are queued and a background thread writes them, syncing every
+    group of records together: requests waiting for their intent to be
+    durable share the same fsync. ``commit_interval`` is how long the thread
+    waits for other records to join a group.
+
+    Every record is appended with a single write, so forked children may
+    keep using the journal created by their parent (see forksafe). A torn
+    record left at the end by a crash is cut off when the journal is
+    opened, so new records aren't appended after it.
+    """
+
+    def __init__(self, path, commit_interval=0.002, sync=True):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.sync = sync
+
+        self._open()
+        self._closed = False
+        self._start()
+        forksafe.register(self)
+
+    def _open(self):
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        length = _intact_length(self.path)
+        if os.fstat(self._fd).st_size > length:
+            os.ftruncate(self._fd, length)
+
+    def _start(self):
+        self._ids = itertools.count(_first_op_id())
+        self._buffer = []
+        self._queued = 0
+        self._durable = 0
+        self._error = None
+        self._condition = threading.Condition()
+
+        self._writer = threading.Thread(target=self._write_groups)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _after_fork(self):
+        # Records still queued are written by the parent, the writer thread
+        # didn't survive the fork
+        if not self._closed:
+            self._start()
+
+    def _append(self, kind, op_id, record, durable):
+        data = json.dumps(record, separators=(',', ':')).encode('utf-8')
+        header = HEADER.pack(len(data), _checksum(kind, op_id, data), kind, op_id)
+
+        with self._condition:
+            if self._closed:
+                raise ValueError('journal is closed')
+            self._buffer.append(header + data)
+            self._queued += 1
+            sequence = self._queued
+            self._condition.notify_all()
+
+        if durable:
+            self._wait(sequence)
+
+    def _wait(self, sequence):
+        with self._condition:
+            while self._durable < sequence and self._error is None:
+                self._condition.wait()
+            if self._error is not None:
+                raise self._error
+
+    def _write_groups(self):
+        while True:
+            with self._condition:
+                while not self._buffer and not self._closed:
+                    self._condition.wait()
+                if not self._buffer:
+                    return
+
+            if self.commit_interval:
+                time.sleep(self.commit_interval)
+
+            with self._condition:
+                records, self._buffer = self._buffer, []
+                sequence = self._queued
+
+            try:
+                os.write(self._fd, b''.join(records))
+                if self.sync:
+                    getattr(os, 'fdatasync', os.fsync)(self._fd)
+            except (OSError, IOError) as e:
+                error = e
+            else:
+                error = None
+
+            with self._condition:
+                if error is not None:
+                    self._error = error
+                else:
+                    self._durable = sequence
+                self._condition.notify_all()
+
+    def intent(self, operation, affiliation_id, payload, **fields):
+        """
+        Records that ``operation`` is about to be sent, returning its op id
+        once the record is durable.
+        """
+        op_id = next(self._ids)
+        record = dict(fields, operation=operation, affiliation_id=affiliation_id,
+                      payload=redact_payload(payload), at=time.time())
+        self._append(INTENT, op_id, record, durable=True)
+        return op_id
+
+    def outcome(self, op_id, durable=False, **fields):
+        """
+        Records Cielo's answer to the operation. Not waiting for it to be
+        durable is safe: a lost outcome only makes the operation look in flight.
+        """
+        record = dict(fields, at=time.time())
+        self._append(OUTCOME, op_id, record, durable)
+
+    def flush(self):
+        with self._condition:
+            sequence = self._queued
+        self._wait(sequence)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+        os.close(self._fd)
+
+    def compact(self):
+        """
+        Rewrites the journal keeping only the operations in flight, so
+        recovery time doesn't grow with the journal's age. Must not run
+        while requests are using the journal.
+        """
+        self.flush()
+        entries = recover_journal(self.path)
+
+        temp_path = self.path + '.compact'
+        with open(temp_path, 'wb') as f:
+            for op_id, record in entries:
+                data = json.dumps(record, separators=(',', ':')).encode('utf-8')
+                f.write(HEADER.pack(len(data), _checksum(INTENT, op_id, data), INTENT, op_id))
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(temp_path, self.path)
+        os.close(self._fd)
+        self._open()
+        return len(entries)
+
+
+def scan_journal(path):
+    """
+    Yields ``(kind, op_id, offset, size)`` for the records of a journal, the
+    JSON being at ``offset``. Stops at the first torn or corrupt record.
+    """
+    with open(path, 'rb') as f:
+        length = os.fstat(f.fileno()).st_size
+        if not length:
+            return
+        data = mmap.mmap(f.fileno(), length, access=mmap.ACCESS_READ)
+
+    try:
+        offset = 0
+        header_size = HEADER.size
+        unpack_from = HEADER.unpack_from
+        while offset + header_size <= length:
+            size, crc, kind, op_id = unpack_from(data, offset)
+            end = offset + header_size + size
+            if kind not in (INTENT, OUTCOME) or end > length:
+                return
+            # Only the last records can be torn, checking every crc would slow the scan down
+            if end + header_size > length and crc != _checksum(kind, op_id, data[offset + header_size:end]):
+                return
+            yield kind, op_id, offset + header_size, size
+            offset = end
+    finally:
+        data.close()
+
+
+def _intact_length(path):
+    # Where the last intact record ends
+    length = 0
+    for kind, op_id, offset, size in scan_journal(path):
+        length = offset + size
+    return length
+
+
+def recover_journal(path):
+    """
+    Lists the operations of a journal which have an intent but no outcome,
+    as JournalEntry tuples in the order they were sent. These may or may not
+    have reached Cielo and need to be reconciled (see Attempt.refresh).
+    """
+    in_flight = {}
+    for kind, op_id, offset, size in scan_journal(path):
+        if kind == INTENT:
+            in_flight[op_id] = (offset, size)
+        else:
+            in_flight.pop(op_id, None)
+
+    entries = []
+    with open(path, 'rb') as f:
+        for op_id, (offset, size) in sorted(in_flight.items(), key=lambda item: item[1]):
+            f.seek(offset)
+            data = f.read(size)
+            entries.append(JournalEntry(op_id, json.loads(data.decode('utf-8'))))
+    return entries
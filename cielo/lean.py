@@ -0,0 +1,108 @@
+# coding: utf-8
+"""
+Lean attempts, for queues holding many of them: their attributes are slots
+instead of a __dict__, the card number, security code and holder's name
+are discarded as soon as the request body is built, and neither Cielo's
+raw response nor the parsed transaction is kept once handled. What is left
+is the compact result: ``status``, ``transaction_id`` and the error, if
+any.
+
+As the card data is gone, a lean attempt's authorization can't be retried;
+capture, cancel and refresh work as usual.
+"""
+from .main import BaseTransaction, BaseTokenPaymentAttempt, BasePaymentAttempt, BaseBuyPageCieloAttempt
+
+__all__ = ['LeanPaymentAttempt', 'LeanTokenPaymentAttempt', 'LeanBuyPageCieloAttempt', 'LeanTransaction']
+
+
+class _SlotContext(object):
+    """
+    Template context reading the attributes of a slotted request.
+    """
+    __slots__ = ('request',)
+
+    def __init__(self, request):
+        self.request = request
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self.request, name)
+        except AttributeError:
+            raise KeyError(name)
+
+
+class Lean(object):
+    """
+    Mixin making an attempt class lean, listed before it. Subclasses add
+    the slots of their own fields and the ``sensitive_fields`` to discard.
+    """
+    __slots__ = (
+        'merchant', 'affiliation_id', 'api_key', 'sandbox', 'url_redirect', 'url',
+        'rate_limiter', 'scheduler', 'priority', 'concurrency_limiter', 'admission', 'journal',
+        'request_log', 'traffic_recorder', 'circuit_breaker',
+        'capture_tracker', 'transaction_store', 'order_index',
+        'order_id', 'total', 'installments', 'transaction_type', 'auto_capture', 'tokenize', 'date',
+        'amount_to_cancel', '_authorized', '_captured', '_cancelled',
+        'timings', 'cielo_response', 'transaction', 'status', 'transaction_id',
+        'error', 'error_id', 'error_message',
+    )
+    sensitive_fields = ()
+
+    def template_context(self):
+        return _SlotContext(self)
+
+    def render_payload(self, template_name):
+        try:
+            payload = super(Lean, self).render_payload(template_name)
+        except KeyError as e:
+            if e.args[0] in self.sensitive_fields:
+                raise ValueError(u"'{0}' was discarded after the first request".format(e.args[0]))
+            raise
+
+        for name in self.sensitive_fields:
+            if hasattr(self, name):
+                delattr(self, name)
+        return payload
+
+    def make_request(self, url, template_name):
+        try:
+            return super(Lean, self).make_request(url, template_name)
+        finally:
+            self.cielo_response = None
+            self.timings = None
+
+    def handle_response(self, response):
+        super(Lean, self).handle_response(response)
+        # The trackers and stores have seen it, only the compact result stays
+        self.transaction = None
+
+
+class LeanTransaction(Lean, BaseTransaction):
+    """
+    Lean Transaction.
+    """
+    __slots__ = ()
+
+
+class LeanTokenPaymentAttempt(Lean, BaseTokenPaymentAttempt):
+    """
+    Lean TokenPaymentAttempt.
+    """
+    __slots__ = ('card_type', 'token')
+
+
+class LeanPaymentAttempt(Lean, BasePaymentAttempt):
+    """
+    Lean PaymentAttempt, keeping only the card's expiration after the
+    authorization request is built.
+    """
+    __slots__ = ('card_type', 'card_number', 'exp_month', 'exp_year', 'card_holders_name', 'cvc2',
+                 'expiration', 'expiration_date')
+    sensitive_fields = ('card_number', 'cvc2', 'card_holders_name')
+
+
+class LeanBuyPageCieloAttempt(Lean, BaseBuyPageCieloAttempt):
+    """
+    Lean BuyPageCieloAttempt.
+    """
+    __slots__ = ('description', 'card_type', 'authentication_url')
@@ -0,0 +1,438 @@
+# coding: utf-8
+"""
+Load generator for the client stack, run against a local stand-in of
+Cielo's webservice:
+
+    python -m cielo.loadtest --rate 200 --duration 30 --mode threaded --concurrency 16
+
+Requests are sent at a fixed rate (open loop) and their latency counted
+from the moment they were due, so a saturated client shows up as growing
+latency instead of a lower rate going unnoticed.
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import deque
+from datetime import date, datetime
+from decimal import Decimal
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .constants import VISA, CASH
+from .main import PaymentAttempt, TokenPaymentAttempt, Transaction
+from .scheduler import RequestScheduler
+
+__all__ = ['StandInServer', 'LoadReport', 'run_load', 'DEFAULT_MIX', 'MODES']
+
+DEFAULT_MIX = {
+    'authorize': 5,
+    'authorize_token': 2,
+    'capture': 2,
+    'cancel': 1,
+    'refresh': 2,
+}
+
+MODES = ('sync', 'threaded')
+
+TRANSACTION = (
+    '<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+    '<transacao versao="1.3.0" id="1" xmlns="http://ecommerce.cbmp.com.br">'
+    '<tid>{tid}</tid>'
+    '<dados-pedido><numero>{order_id}</numero><valor>{total}</valor><moeda>986</moeda>'
+    '<data-hora>{now}</data-hora><idioma>PT</idioma></dados-pedido>'
+    '<forma-pagamento><bandeira>visa</bandeira><produto>1</produto><parcelas>1</parcelas></forma-pagamento>'
+    '<status>{status}</status>'
+    '<autorizacao><codigo>4</codigo><mensagem>Transacao autorizada</mensagem><data-hora>{now}</data-hora>'
+    '<valor>{total}</valor><lr>00</lr><arp>123456</arp><nsu>123456</nsu></autorizacao>'
+    '</transacao>'
+)
+TOKEN = (
+    '<?xml version="1.0" encoding="ISO-8859-1"?>\n'
+    '<retorno-token versao="1.2.1" id="1" xmlns="http://ecommerce.cbmp.com.br"><token><dados-token>'
+    '<codigo-token>{tid}</codigo-token><status>1</status>'
+    '<numero-cartao-truncado>401200******1112</numero-cartao-truncado>'
+    '</dados-token></token></retorno-token>'
+)
+
+_ROOT = re.compile(r'<(requisicao-[a-z-]+)')
+_ORDER = re.compile(r'<dados-pedido>\s*<numero>([^<]*)</numero>\s*<valor>([^<]*)</valor>')
+_TID = re.compile(r'<tid>([^<]*)</tid>')
+_CAPTURE = re.compile(r'<capturar>true</capturar>')
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Answers are written at once, small writes on kept-alive connections stall on Nagle
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    tids = itertools.count(1)
+
+    def do_POST(self):
+        length = int(self.headers.get('content-length', 0))
+        message = parse_qs(self.rfile.read(length).decode('latin-1')).get('mensagem', [''])[0]
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        body = self.answer(message).encode('latin-1')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml; charset=ISO-8859-1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def answer(self, message):
+        root = _ROOT.search(message)
+        root = root.group(1) if root else ''
+        order = _ORDER.search(message)
+        tid = _TID.search(message)
+        fields = {
+            'tid': tid.group(1) if tid else '1006993069{0:010d}'.format(next(self.tids)),
+            'order_id': order.group(1) if order else '',
+            'total': order.group(2) if order else '100',
+            'now': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'),
+        }
+        if root == 'requisicao-token':
+            return TOKEN.format(**fields)
+
+        if root == 'requisicao-transacao':
+            fields['status'] = '6' if _CAPTURE.search(message) else '4'
+        elif root == 'requisicao-captura':
+            fields['status'] = '6'
+        elif root == 'requisicao-cancelamento':
+            fields['status'] = '9'
+        else:
+            fields['status'] = '4'
+        return TRANSACTION.format(**fields)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping their kept-alive connections aren't worth a traceback
+        pass
+
+
+def _serve(port, latency, ready):
+    server = _ThreadingHTTPServer(('127.0.0.1', port), _StandInHandler)
+    server.latency = latency
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StandInServer(object):
+    """
+    Local HTTP endpoint answering Cielo's requests with canned successes,
+    after ``latency`` seconds. With ``in_process`` it runs in a thread of
+    the current process (its CPU then counts in the report), otherwise in
+    a child process.
+    """
+
+    def __init__(self, latency=0, in_process=True, port=0):
+        self.latency = latency
+        self.in_process = in_process
+        self.port = port
+        self._server = None
+        self._process = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}/servicos/ecommwsec.do'.format(self.port)
+
+    def start(self):
+        if self.in_process:
+            self._server = _ThreadingHTTPServer(('127.0.0.1', self.port), _StandInHandler)
+            self._server.latency = self.latency
+            self.port = self._server.server_address[1]
+            thread = threading.Thread(target=self._server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        else:
+            ready = multiprocessing.Queue()
+            self._process = multiprocessing.Process(target=_serve, args=(self.port, self.latency, ready))
+            self._process.daemon = True
+            self._process.start()
+            self.port = ready.get(timeout=10)
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+
+def _max_rss():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class LoadReport(object):
+    """
+    Outcome of a load run. Latencies are in seconds and counted from the
+    moment each request was due, ``service_times`` from when it was sent.
+    Memory growth is the change of the peak resident size, in kilobytes.
+    """
+
+    def __init__(self, mode, rate, concurrency):
+        self.mode = mode
+        self.rate = rate
+        self.concurrency = concurrency
+        self.latencies = []
+        self.service_times = []
+        self.operations = {}
+        self.errors = {}
+        self.elapsed = 0
+        self.cpu_time = 0
+        self.memory_growth = None
+
+    @property
+    def requests(self):
+        return len(self.latencies)
+
+    @property
+    def throughput(self):
+        return self.requests / self.elapsed if self.elapsed else 0
+
+    @property
+    def cpu_per_request(self):
+        return self.cpu_time / self.requests if self.requests else None
+
+    def percentiles(self, values=None):
+        ordered = sorted(self.latencies if values is None else values)
+        return dict((name, _percentile(ordered, fraction)) for name, fraction in (
+            ('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0),
+        ))
+
+    def summary(self):
+        latencies = self.percentiles()
+        lines = [
+            '{0} mode, {1} workers{2}'.format(
+                self.mode, self.concurrency, ', target {0}/s'.format(self.rate) if self.rate else ''),
+            '  requests: {0} in {1:.2f}s, {2:.1f}/s, {3} errors'.format(
+                self.requests, self.elapsed, self.throughput, sum(self.errors.values())),
+        ]
+        if self.requests:
+            lines.append('  latency ms: p50 {p50:.1f}  p90 {p90:.1f}  p99 {p99:.1f}  max {max:.1f}'.format(
+                **dict((name, value * 1000) for name, value in latencies.items())))
+            lines.append('  cpu per request: {0:.3f} ms'.format(self.cpu_per_request * 1000))
+        if self.memory_growth is not None:
+            lines.append('  peak memory growth: {0} kB'.format(self.memory_growth))
+        for operation, count in sorted(self.operations.items()):
+            lines.append('  {0}: {1}'.format(operation, count))
+        for error, count in sorted(self.errors.items()):
+            lines.append('  error {0}: {1}'.format(error, count))
+        return '\n'.join(lines)
+
+
+class _Workload(object):
+    """
+    Builds and runs the requests of the mix, reusing the transaction ids
+    given by previous authorizations for captures, cancelations and refreshes.
+    """
+
+    def __init__(self, url, mix, request_kwargs):
+        self.url = url
+        self.operations = list(mix)
+        self.weights = [mix[operation] for operation in self.operations]
+        self.request_kwargs = request_kwargs
+        self.orders = itertools.count(1)
+        self.transaction_ids = deque(maxlen=10000)
+        self.card = {
+            'card_type': VISA,
+            'card_number': '4012001037141112',
+            'cvc2': 423,
+            'exp_month': 12,
+            'exp_year': date.today().year + 1,
+            'card_holders_name': 'JOAO DA SILVA',
+        }
+
+    def choose(self, random_generator):
+        total = sum(self.weights)
+        point = random_generator.uniform(0, total)
+        for operation, weight in zip(self.operations, self.weights):
+            point -= weight
+            if point <= 0:
+                return operation
+        return self.operations[-1]
+
+    def attempt_kwargs(self):
+        kwargs = dict(self.request_kwargs, url=self.url, affiliation_id='1006993069', api_key='0' * 64)
+        kwargs.update(order_id='LOAD{0}'.format(next(self.orders)), total=Decimal('1.00'), transaction=CASH)
+        return kwargs
+
+    def transaction_id(self):
+        try:
+            return self.transaction_ids[-1]
+        except IndexError:
+            return '10069930690000000000'
+
+    def run(self, operation):
+        if operation == 'authorize':
+            attempt = PaymentAttempt(**dict(self.attempt_kwargs(), **self.card))
+            attempt.get_authorized()
+            self.transaction_ids.append(attempt.transaction_id)
+        elif operation == 'authorize_token':
+            attempt = TokenPaymentAttempt(card_type=VISA, token='TOKEN', **self.attempt_kwargs())
+            attempt.get_authorized()
+            self.transaction_ids.append(attempt.transaction_id)
+        else:
+            transaction = Transaction(**self.attempt_kwargs())
+            if operation == 'capture':
+                transaction.capture(transaction_id=self.transaction_id())
+            elif operation == 'cancel':
+                transaction.cancel(transaction_id=self.transaction_id(), amount=Decimal('1.00'))
+            else:
+                transaction.refresh(transaction_id=self.transaction_id())
+
+
+def run_load(url, rate, duration, mode='threaded', concurrency=8, mix=None, seed=None, **request_kwargs):
+    """
+    Sends ``rate`` requests per second for ``duration`` seconds to ``url``,
+    picking operations by the weights in ``mix``. ``sync`` mode sends them
+    one at a time from the calling thread, ``threaded`` from ``concurrency``
+    threads. Other keyword arguments go to the requests (a scheduler, limiters...).
+    """
+    if mode not in MODES:
+        raise ValueError('mode must be one of {0}'.format(', '.join(MODES)))
+    if mode == 'sync':
+        concurrency = 1
+
+    workload = _Workload(url, mix or DEFAULT_MIX, request_kwargs)
+    report = LoadReport(mode, rate, concurrency)
+    lock = threading.Lock()
+    sequence = itertools.count()
+
+    def work(worker_seed):
+        random_generator = random.Random(worker_seed)
+        while True:
+            due = started_at + next(sequence) / float(rate)
+            if due >= started_at + duration:
+                return
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            operation = workload.choose(random_generator)
+            sent_at = time.time()
+            error = None
+            try:
+                workload.run(operation)
+            except Exception as e:
+                error = getattr(e, 'id', None) or e.__class__.__name__
+            finished_at = time.time()
+
+            with lock:
+                report.latencies.append(finished_at - due)
+                report.service_times.append(finished_at - sent_at)
+                report.operations[operation] = report.operations.get(operation, 0) + 1
+                if error is not None:
+                    report.errors[error] = report.errors.get(error, 0) + 1
+
+    seeds = random.Random(seed)
+    rss_before = _max_rss()
+    cpu_before = _cpu_time()
+    started_at = time.time()
+
+    if mode == 'sync':
+        work(seeds.random())
+    else:
+        threads = [threading.Thread(target=work, args=(seeds.random(),)) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    report.elapsed = time.time() - started_at
+    report.cpu_time = _cpu_time() - cpu_before
+    if rss_before is not None:
+        report.memory_growth = _max_rss() - rss_before
+    return report
+
+
+def _parse_mix(value):
+    mix = {}
+    for item in value.split(','):
+        operation, weight = item.split('=')
+        if operation not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError('unknown operation {0}'.format(operation))
+        mix[operation] = float(weight)
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test python-cielo against a local stand-in of Cielo')
+    parser.add_argument('--rate', type=float, default=100, help='requests per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--mode', choices=MODES + ('all',), default='all')
+    parser.add_argument('--concurrency', type=int, default=8, help='threads in threaded mode')
+    parser.add_argument('--mix', type=_parse_mix, default=DEFAULT_MIX,
+                        help='operation weights, like authorize=5,capture=2,refresh=1')
+    parser.add_argument('--latency', type=float, default=0, help="stand-in's answer delay in seconds")
+    parser.add_argument('--url', help='endpoint to load instead of starting a stand-in')
+    parser.add_argument('--pooled', action='store_true', help='reuse connections through a RequestScheduler')
+    parser.add_argument('--in-process', action='store_true', help='run the stand-in in this process')
+    args = parser.parse_args(argv)
+
+    stand_in = None
+    url = args.url
+    if url is None:
+        stand_in = StandInServer(latency=args.latency, in_process=args.in_process).start()
+        url = stand_in.url
+
+    request_kwargs = {}
+    if args.pooled:
+        request_kwargs['scheduler'] = RequestScheduler(limits=dict.fromkeys(range(3), max(args.concurrency, 1)))
+
+    try:
+        for mode in (MODES if args.mode == 'all' else (args.mode,)):
+            report = run_load(url, args.rate, args.duration, mode, args.concurrency, args.mix, **request_kwargs)
+            sys.stdout.write(report.summary() + '\n\n')
+    finally:
+        if stand_in is not None:
+            stand_in.stop()
+
+
+if __name__ == '__main__':
+    main()
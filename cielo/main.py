@@ -1,23 +1,28 @@
 # coding: utf-8
-import os
+import time
 from datetime import date, datetime
 from decimal import Decimal
-import requests
-import xmltodict
-from xml.parsers.expat import ExpatError
 
-from exceptions import CieloException, GetAuthorizedException, CaptureException, TokenException
-from constants import *
-from util import moneyfmt
+from . import forksafe
+from .exceptions import CieloException, GetAuthorizedException, CaptureException, TokenException
+from .constants import *
+from .template import get_template
+from .util import moneyfmt
 
-__all__ = ['PaymentAttempt', 'TokenPaymentAttempt', 'BuyPageCieloAttempt', 'CieloToken']
+__all__ = ['PaymentAttempt', 'TokenPaymentAttempt', 'BuyPageCieloAttempt', 'CieloToken', 'Transaction']
 
 
 class CieloRequest(object):
     """
     Base class containg the http communication and processing logic
     """
+    # The public classes have a __dict__, the lean ones (see cielo.lean) only slots
+    __slots__ = ()
+
     def __init__(self, **kwargs):
+        # Catches forks not seen by os.register_at_fork (Python < 3.7)
+        forksafe.check()
+
         # Required arguments
         try:
             self.fetch_required_arguments(**kwargs)
@@ -28,50 +33,193 @@ class CieloRequest(object):
         self.sandbox = kwargs.get('sandbox', False)
         self.url_redirect = kwargs.get('url_redirect', '')
 
-        self.url = SANDBOX_URL if self.sandbox else PRODUCTION_URL
+        # An explicit url points the requests elsewhere, like a local stand-in for load tests
+        self.url = kwargs.get('url') or (SANDBOX_URL if self.sandbox else PRODUCTION_URL)
+
+        # Optional cielo.ratelimit.RateLimiter shared by the requests
+        self.rate_limiter = kwargs.get('rate_limiter')
+
+        # Optional cielo.scheduler.RequestScheduler, priority defaults to the operation's
+        self.scheduler = kwargs.get('scheduler')
+        self.priority = kwargs.get('priority')
+
+        # Optional cielo.concurrency.AdaptiveConcurrencyLimiter fed with every request's outcome
+        self.concurrency_limiter = kwargs.get('concurrency_limiter')
+
+        # Optional cielo.admission.AdmissionController bounding in-flight and queued requests
+        self.admission = kwargs.get('admission')
+
+        # Optional cielo.journal.TransactionJournal recording every operation sent
+        self.journal = kwargs.get('journal')
+
+        # Optional cielo.diagnostics.SlowRequestLog keeping the slow and failed requests
+        self.request_log = kwargs.get('request_log')
+
+        # Optional cielo.replay.TrafficRecorder capturing the exchanges for replay
+        self.traffic_recorder = kwargs.get('traffic_recorder')
+
+        # Optional cielo.breaker.CircuitBreaker failing fast while Cielo is down
+        self.circuit_breaker = kwargs.get('circuit_breaker')
 
         self.validate()
 
     def fetch_required_arguments(self, **kwargs):
-        self.affiliation_id = kwargs['affiliation_id']
-        self.api_key = kwargs['api_key']
+        # A cielo.merchants.Merchant provides the credentials, already rendered
+        self.merchant = kwargs.get('merchant')
+        if self.merchant is not None:
+            self.affiliation_id = self.merchant.affiliation_id
+            self.api_key = self.merchant.api_key
+        else:
+            self.affiliation_id = kwargs['affiliation_id']
+            self.api_key = kwargs['api_key']
 
     def validate(self):
         pass
 
+    def template_context(self):
+        return self.__dict__
+
+    def render_payload(self, template_name):
+        template = get_template(template_name)
+        credentials = self.merchant.credentials(template_name) if self.merchant is not None else None
+        return template.render(self.template_context(), credentials)
+
     def make_request(self, url, template_name):
-        template_path = os.path.join(
-            os.path.dirname(os.path.abspath(__file__)), 'templates', template_name
-        )
-        payload = open(template_path).read() % self.__dict__
-
-        self.cielo_response = requests.post(
-            url,
-            data={'mensagem': payload},
-            headers={'user-agent': 'python-cielo'},
-            timeout=30,
-        )
+        payload = self.render_payload(template_name)
+
+        operation = TEMPLATE_OPERATIONS[template_name]
+        self.timings = {}
+        self.cielo_response = None
+        started_at = time.time()
+        try:
+            response_dict, op_id = self.admit(url, operation, payload)
+        except Exception as e:
+            if self.request_log is not None:
+                self.request_log.record(self, operation, payload, started_at, exception=e)
+            raise
+
+        if self.request_log is not None:
+            self.request_log.record(self, operation, payload, started_at, response_dict=response_dict)
+
+        # Without an answer the operation stays in flight in the journal
+        if self.journal is not None:
+            self.journal.outcome(op_id, **self.summarize_response(response_dict))
+
+        if 'erro' in response_dict:
+            self.error = response_dict['erro']
+            self.error_id = self.error['codigo']
+            self.error_message = CIELO_MSG_ERRORS.get(self.error_id, self.error['mensagem'])
+            raise CieloException(self.error_id, self.error_message, self.cielo_response.content)
 
+        return response_dict
+
+    def admit(self, url, operation, payload):
+        """
+        Exchanges the payload once admitted by the admission controller,
+        circuit breaker and rate limiter, recording its intent in the
+        journal: requests turned away were never sent, so they aren't
+        journaled. Returns the response and the journal's op id.
+        """
+        op_id = None
+        waiting_since = time.time()
+        if self.admission is not None:
+            self.admission.acquire(operation, self.priority)
+        self.timings['admission'] = time.time() - waiting_since
+        try:
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.allow()
+
+            waiting_since = time.time()
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(self.affiliation_id, operation)
+            self.timings['rate_limit'] = time.time() - waiting_since
+
+            if self.journal is not None:
+                op_id = self.journal.intent(
+                    operation, self.affiliation_id, payload,
+                    order_id=getattr(self, 'order_id', None),
+                    transaction_id=getattr(self, 'transaction_id', None),
+                )
+            return self.exchange(url, operation, payload), op_id
+        finally:
+            if self.admission is not None:
+                self.admission.release()
+
+    def exchange(self, url, operation, payload):
+        """
+        Sends the payload and parses the answer, going through the optional
+        concurrency limiter and reporting to the circuit breaker.
+        """
+        waiting_since = time.time()
+        if self.concurrency_limiter is not None:
+            started_at = self.concurrency_limiter.acquire()
+        self.timings['pool_wait'] = time.time() - waiting_since
+        overloaded = True
         try:
-            response_dict = xmltodict.parse(self.cielo_response.content, encoding='latin-1')
+            self.cielo_response = self.send(url, operation, payload)
+            parsing_since = time.time()
+            response_dict = self.parse_response(self.cielo_response)
+            self.timings['parse'] = time.time() - parsing_since
+            overloaded = 'erro' in response_dict and response_dict['erro']['codigo'] in OVERLOAD_ERRORS
+        finally:
+            if self.concurrency_limiter is not None:
+                self.concurrency_limiter.release(started_at, error=overloaded)
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record(failed=overloaded)
+
+        return response_dict
+
+    def send(self, url, operation, payload):
+        request_kwargs = {
+            'data': {'mensagem': payload},
+            'headers': {'user-agent': 'python-cielo'},
+            'timeout': 30,
+            'stream': True,
+        }
+        sending_since = time.time()
+        if self.scheduler is not None:
+            response = self.scheduler.post(url, operation, self.priority, **request_kwargs)
+        else:
+            # Imported on first use: requests is most of the cost of importing cielo
+            import requests
+            response = requests.post(url, **request_kwargs)
+
+        # Streamed, so the body is read here and timed apart from the first byte
+        reading_since = time.time()
+        response.content
+        ttfb = response.elapsed.total_seconds()
+        self.timings['ttfb'] = ttfb
+        self.timings['read'] = time.time() - reading_since
+        # Whatever happened before the request went out was waiting for a connection
+        self.timings['pool_wait'] = self.timings.get('pool_wait', 0) + max(reading_since - sending_since - ttfb, 0)
+
+        if self.traffic_recorder is not None:
+            self.traffic_recorder.record(operation, payload, response, sending_since, time.time() - sending_since)
+        return response
+
+    def parse_response(self, cielo_response):
+        import xmltodict
+        from xml.parsers.expat import ExpatError
+
+        try:
+            return xmltodict.parse(cielo_response.content, encoding='latin-1')
         except ExpatError as e:
             self.error = {
                 'type': e.__class__.__name__,
                 'args': repr(e.args),
                 'response': {
-                    'status_code': self.cielo_response.status_code,
-                    'content': self.cielo_response.content,
+                    'status_code': cielo_response.status_code,
+                    'content': cielo_response.content,
                 }
             }
             raise
 
+    def summarize_response(self, response_dict):
         if 'erro' in response_dict:
-            self.error = response_dict['erro']
-            self.error_id = self.error['codigo']
-            self.error_message = CIELO_MSG_ERRORS.get(self.error_id, self.error['mensagem'])
-            raise CieloException(self.error_id, self.error_message, self.cielo_response.content)
-
-        return response_dict
+            return {'error': response_dict['erro']['codigo']}
+        if 'transacao' in response_dict:
+            return {'transaction_id': response_dict['transacao']['tid'], 'status': response_dict['transacao']['status']}
+        return {}
 
     def handle_response(self, response):
         self.transaction = response['transacao']
@@ -83,6 +231,7 @@ class WithCardData(object):
     """
     Mixin which handles the credit card parameters, expects be used in a subclass of CieloRequest
     """
+    __slots__ = ()
 
     def __init__(self, **kwargs):
         super(WithCardData, self).__init__(**kwargs)
@@ -118,6 +267,7 @@ class WithReturnURL(object):
     """
     Mixin which handles payments which need to redirect the customer.
     """
+    __slots__ = ()
 
     def fetch_required_arguments(self, **kwargs):
         super(WithReturnURL, self).fetch_required_arguments(**kwargs)
@@ -130,11 +280,13 @@ class Attempt(CieloRequest):
     Base class implementing the methods for authorizing and capturing a transaction.
     May be used with the credit card data or with a token.
     """
+    __slots__ = ()
 
     authorization_template = None
     capture_template = 'capture.xml'
     cancelation_template = 'cancel.xml'
     status_template = 'status_using_tid.xml'
+    status_by_order_template = 'status_using_order_id.xml'
 
     def __init__(self, **kwargs):
         # Required arguments with default values
@@ -147,6 +299,15 @@ class Attempt(CieloRequest):
         self._captured = False
         self._cancelled = False
 
+        # Optional cielo.expiry.CaptureDeadlineTracker for authorizations without capture
+        self.capture_tracker = kwargs.get('capture_tracker')
+
+        # Optional cielo.store.TransactionStore keeping the last known state of every transaction
+        self.transaction_store = kwargs.get('transaction_store')
+
+        # Optional order id to transaction id lookup (cielo.store.OrderIndex or TransactionStore)
+        self.order_index = kwargs.get('order_index')
+
         super(Attempt, self).__init__(**kwargs)
 
     def fetch_required_arguments(self, **kwargs):
@@ -174,6 +335,13 @@ class Attempt(CieloRequest):
         elif self.status == '9':
             self._cancelled = True
 
+        if self.capture_tracker is not None:
+            self.capture_tracker.update(self)
+        if self.transaction_store is not None:
+            self.transaction_store.update(self)
+        if self.order_index is not None:
+            self.order_index.update(self)
+
     def get_authorized(self):
         self.date = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
 
@@ -188,7 +356,7 @@ class Attempt(CieloRequest):
             if not self._authorized:
                 raise ValueError(u'get_authorized(...) must be called before capture(...)')
         else:
-            self.transaction_id = kwargs['transaction_id']
+            self.transaction_id = kwargs.get('transaction_id') or self.locate()
 
         response_dict = self.make_request(self.url, self.capture_template)
         self.handle_response(response_dict)
@@ -196,7 +364,7 @@ class Attempt(CieloRequest):
 
     def cancel(self, **kwargs):
         if not hasattr(self, 'transaction_id'):
-            self.transaction_id = kwargs['transaction_id']
+            self.transaction_id = kwargs.get('transaction_id') or self.locate()
 
         self.amount_to_cancel = moneyfmt(kwargs.get('amount'), sep='', dp='')
         response_dict = self.make_request(self.url, self.cancelation_template)
@@ -205,57 +373,119 @@ class Attempt(CieloRequest):
 
     def refresh(self, **kwargs):
         if not hasattr(self, 'transaction_id'):
-            self.transaction_id = kwargs['transaction_id']
+            if kwargs.get('transaction_id'):
+                self.transaction_id = kwargs['transaction_id']
+            elif self.lookup_transaction_id() is None:
+                # Asking by the order number already gives the current status
+                return self.refresh_by_order()
 
         response_dict = self.make_request(self.url, self.status_template)
         self.handle_response(response_dict)
         return True
 
+    def refresh_by_order(self):
+        if not self.order_id:
+            raise TypeError(u"'transaction_id' or 'order_id' is required")
 
-class TokenPaymentAttempt(Attempt):
+        response_dict = self.make_request(self.url, self.status_by_order_template)
+        self.handle_response(response_dict)
+        return True
+
+    def lookup_transaction_id(self):
+        """
+        Sets the transaction_id from the order index, when it knows the order.
+        """
+        if self.order_index is not None and self.order_id:
+            transaction_id = self.order_index.lookup(self.affiliation_id, self.order_id)
+            if transaction_id is not None:
+                self.transaction_id = transaction_id
+                return transaction_id
+        return None
+
+    def locate(self):
+        """
+        Finds the transaction_id of the attempt's order, asking Cielo when
+        the order index doesn't know it.
+        """
+        if self.lookup_transaction_id() is None:
+            self.refresh_by_order()
+        return self.transaction_id
+
+
+class BaseTransaction(Attempt):
+    __slots__ = ()
+
+    def fetch_required_arguments(self, **kwargs):
+        CieloRequest.fetch_required_arguments(self, **kwargs)
+
+        self.order_id = kwargs.get('order_id', '')
+        self.total = moneyfmt(kwargs['total'], sep='', dp='') if 'total' in kwargs else ''
+
+    def get_authorized(self):
+        raise TypeError('Transaction can not be authorized, use one of the Attempt classes')
+
+
+class Transaction(BaseTransaction):
     """
-    Interface for creating payments using tokenized credit cards.
+    Interface for capturing, canceling or refreshing an existing transaction
+    by its ``transaction_id``, without the data used to authorize it.
     """
+
+
+class BaseTokenPaymentAttempt(Attempt):
+    __slots__ = ()
     authorization_template = 'authorize_token.xml'
 
     def fetch_required_arguments(self, **kwargs):
-        super(TokenPaymentAttempt, self).fetch_required_arguments(**kwargs)
+        super(BaseTokenPaymentAttempt, self).fetch_required_arguments(**kwargs)
 
         self.card_type = kwargs['card_type']
         self.token = kwargs['token']
 
 
-class PaymentAttempt(WithCardData, Attempt):
+class TokenPaymentAttempt(BaseTokenPaymentAttempt):
     """
-    Interface for creating payments using the credit card data.
+    Interface for creating payments using tokenized credit cards.
     """
+
+
+class BasePaymentAttempt(WithCardData, Attempt):
+    __slots__ = ()
     authorization_template = 'authorize.xml'
 
     def fetch_required_arguments(self, **kwargs):
-        super(PaymentAttempt, self).fetch_required_arguments(**kwargs)
+        super(BasePaymentAttempt, self).fetch_required_arguments(**kwargs)
 
         self.cvc2 = kwargs['cvc2']
 
 
-class BuyPageCieloAttempt(WithReturnURL, Attempt):
+class PaymentAttempt(BasePaymentAttempt):
     """
-    Interface for creating payments with card data collected my cielo
+    Interface for creating payments using the credit card data.
     """
+
+
+class BaseBuyPageCieloAttempt(WithReturnURL, Attempt):
+    __slots__ = ()
     authorization_template = 'authorize_buypagecielo.xml'
 
     def fetch_required_arguments(self, **kwargs):
-        super(BuyPageCieloAttempt, self).fetch_required_arguments(**kwargs)
+        super(BaseBuyPageCieloAttempt, self).fetch_required_arguments(**kwargs)
 
         self.description = kwargs['description']
         self.card_type = kwargs['card_type']
 
-    def get_authorized(self):
-        super(BuyPageCieloAttempt, self).get_authorized()
+    def handle_response(self, response):
+        super(BaseBuyPageCieloAttempt, self).handle_response(response)
 
         if self.status == '0':
             self.authentication_url = self.transaction['url-autenticacao']
 
-        return True
+
+class BuyPageCieloAttempt(BaseBuyPageCieloAttempt):
+    """
+    Interface for creating payments with card data collected my cielo
+    """
 
 
 class CieloToken(WithCardData, CieloRequest):
@@ -264,11 +494,30 @@ class CieloToken(WithCardData, CieloRequest):
     """
     create_token_template = 'token.xml'
 
+    def __init__(self, **kwargs):
+        # Optional cielo.cache.TokenCache, skips the request for known cards
+        self.token_cache = kwargs.get('token_cache')
+
+        super(CieloToken, self).__init__(**kwargs)
+
     def create_token(self):
+        if self.token_cache is not None:
+            cached = self.token_cache.get(self.affiliation_id, self.card_number, self.expiration)
+            if cached is not None:
+                self.token, self.status, self.card = cached
+                return True
+
         response_dict = self.make_request(self.url, self.create_token_template)
 
         dados_token = response_dict['retorno-token']['token']['dados-token']
         self.token = dados_token['codigo-token']
         self.status = dados_token['status']
         self.card = dados_token['numero-cartao-truncado']
+
+        # Only unlocked tokens (status 1) are worth reusing
+        if self.token_cache is not None and self.status == '1':
+            self.token_cache.set(
+                self.affiliation_id, self.card_number, self.expiration,
+                self.token, self.status, self.card,
+            )
         return True
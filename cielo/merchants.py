@@ -0,0 +1,102 @@
+# coding: utf-8
+import threading
+
+from . import forksafe
+from .breaker import CircuitBreaker
+from .main import Transaction
+from .ratelimit import RateLimiter
+from .scheduler import RequestScheduler
+from .template import get_template
+
+__all__ = ['Merchant', 'MerchantRegistry']
+
+
+class Merchant(object):
+    """
+    Client configured for one affiliation: its credentials, the
+    ``<dados-ec>`` block of each template already rendered with them, and
+    its own connection pools (``pool_limits``, see RequestScheduler), rate
+    limit (``rates``, see RateLimiter) and CircuitBreaker.
+
+    Requests are created with ``create``, which passes all of this along:
+
+        merchant.create(PaymentAttempt, order_id='1234', total=Decimal('10.00'), ...)
+    """
+
+    def __init__(self, affiliation_id, api_key, sandbox=False, pool_limits=None, rates=None, burst=None,
+                 failure_threshold=5, reset_timeout=30, **request_kwargs):
+        self.affiliation_id = affiliation_id
+        self.api_key = api_key
+        self.sandbox = sandbox
+
+        self.scheduler = RequestScheduler(pool_limits) if pool_limits is not None else None
+        self.rate_limiter = RateLimiter(rates, burst) if rates is not None else None
+        self.circuit_breaker = CircuitBreaker(failure_threshold, reset_timeout) if failure_threshold else None
+
+        self.request_kwargs = dict(
+            request_kwargs,
+            merchant=self,
+            sandbox=sandbox,
+            scheduler=self.scheduler,
+            rate_limiter=self.rate_limiter,
+            circuit_breaker=self.circuit_breaker,
+        )
+        self._credentials = {}
+
+    def credentials(self, template_name):
+        """
+        The template's ``<dados-ec>`` block with this merchant's credentials.
+        """
+        try:
+            return self._credentials[template_name]
+        except KeyError:
+            rendered = get_template(template_name).render_credentials(self.affiliation_id, self.api_key)
+            self._credentials[template_name] = rendered
+            return rendered
+
+    def create(self, request_class, **kwargs):
+        return request_class(**dict(self.request_kwargs, **kwargs))
+
+    def transaction(self, **kwargs):
+        return self.create(Transaction, **kwargs)
+
+
+class MerchantRegistry(object):
+    """
+    Merchants by affiliation id. ``defaults`` are the Merchant arguments used
+    by ``register`` when not given.
+    """
+
+    def __init__(self, **defaults):
+        self.defaults = defaults
+        self._merchants = {}
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def register(self, affiliation_id, api_key, **kwargs):
+        merchant = Merchant(affiliation_id, api_key, **dict(self.defaults, **kwargs))
+        with self._lock:
+            self._merchants[affiliation_id] = merchant
+        return merchant
+
+    def unregister(self, affiliation_id):
+        with self._lock:
+            self._merchants.pop(affiliation_id, None)
+
+    def get(self, affiliation_id, default=None):
+        return self._merchants.get(affiliation_id, default)
+
+    def __getitem__(self, affiliation_id):
+        return self._merchants[affiliation_id]
+
+    def __contains__(self, affiliation_id):
+        return affiliation_id in self._merchants
+
+    def __len__(self):
+        return len(self._merchants)
+
+    def __iter__(self):
+        return iter(list(self._merchants.values()))
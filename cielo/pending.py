@@ -0,0 +1,124 @@
+# coding: utf-8
+import threading
+import time
+
+from .exceptions import CieloException, RequestRejectedException, CircuitOpenException
+
+__all__ = ['PendingAuthorization', 'authorize_within']
+
+
+class PendingAuthorization(object):
+    """
+    Outcome of an authorization which may still be running in background.
+    ``attempt`` must not be used until ``done()``.
+    """
+
+    def __init__(self, attempt):
+        self.attempt = attempt
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    @property
+    def pending(self):
+        return not self._event.is_set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        Returns True once authorized (the attempt's status tells the
+        outcome), raising the error which prevented it otherwise.
+        """
+        if not self._event.wait(timeout):
+            raise RuntimeError('authorization still pending')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        self._event.wait(timeout)
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """
+        Calls ``callback(pending)`` once resolved, right away if it already is.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _resolve(self, result=None, exception=None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+def _refresh_status(attempt):
+    """
+    Asks Cielo for the transaction status, by order id when the transaction
+    id never arrived. Returns False when the transaction can't be located.
+    """
+    if not hasattr(attempt, 'transaction_id') and not attempt.order_id:
+        return False
+    attempt.refresh()
+    return True
+
+
+def _authorize(pending, poll_interval, max_polls):
+    attempt = pending.attempt
+    try:
+        attempt.get_authorized()
+    except (CieloException, RequestRejectedException, CircuitOpenException) as e:
+        # Cielo's answer, or the request was never sent
+        return pending._resolve(exception=e)
+    except Exception as e:
+        error = e
+    else:
+        return pending._resolve(result=True)
+
+    # The answer was lost, the authorization may or may not have happened
+    for i in range(max_polls):
+        time.sleep(poll_interval)
+        try:
+            if not _refresh_status(attempt):
+                break
+        except CieloException as e:
+            return pending._resolve(exception=e)
+        except Exception as e:
+            error = e
+        else:
+            return pending._resolve(result=True)
+
+    pending._resolve(exception=error)
+
+
+def authorize_within(attempt, budget, callback=None, poll_interval=5, max_polls=6):
+    """
+    Calls ``attempt.get_authorized()`` waiting at most ``budget`` seconds,
+    returning a PendingAuthorization which is ``pending`` when Cielo didn't
+    answer in time. The authorization carries on in background and, if its
+    answer is lost, the transaction status is polled up to ``max_polls``
+    times. Requests rejected before being sent (by the admission controller
+    or an open circuit breaker) resolve right away. ``callback(pending)``
+    is called once the outcome is known.
+    """
+    pending = PendingAuthorization(attempt)
+    if callback is not None:
+        pending.add_done_callback(callback)
+
+    thread = threading.Thread(target=_authorize, args=(pending, poll_interval, max_polls))
+    thread.daemon = True
+    thread.start()
+
+    pending._event.wait(budget)
+    return pending
@@ -0,0 +1,225 @@
+# coding: utf-8
+import heapq
+import itertools
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from . import forksafe
+from .constants import AUTHENTICATION_PENDING_STATUSES
+
+__all__ = ['AuthenticationPoller']
+
+log = logging.getLogger(__name__)
+
+
+class _Tracked(object):
+
+    def __init__(self, attempt, delay, expires_at):
+        self.attempt = attempt
+        self.delay = delay
+        self.expires_at = expires_at
+        self.errors = 0
+        self.removed = False
+
+
+class AuthenticationPoller(object):
+    """
+    Polls the status of BuyPageCieloAttempts while their customers
+    authenticate (statuses 0, 1, 2 and 10).
+
+    Tracked attempts are kept in a heap ordered by their next poll, so each
+    round only touches the ones due, refreshing them on a shared pool of
+    ``concurrency`` threads. The interval between polls of a transaction
+    starts at ``initial_delay`` and grows by ``backoff`` up to ``max_delay``;
+    transactions are dropped once they reach any other status or after
+    ``timeout`` seconds.
+
+    ``on_change(attempt, old_status, new_status)`` is called on every status
+    change (``new_status`` is None when the transaction timed out) and
+    ``on_error(attempt, exception)`` on failed polls. Both are called
+    without holding the poller's lock, so they may track and untrack;
+    exceptions they raise are logged and don't stop the polling.
+
+    The polling thread and pool don't survive a fork: a child keeps the
+    tracked attempts but only polls them once started.
+    """
+
+    def __init__(self, concurrency=8, initial_delay=5, max_delay=60, backoff=1.5, timeout=3600,
+                 on_change=None, on_error=None):
+        self.concurrency = concurrency
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.timeout = timeout
+        self.on_change = on_change
+        self.on_error = on_error
+
+        self._heap = []
+        self._tracked = {}
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pool = None
+        self._thread = None
+        self._stopped = threading.Event()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._pool = None
+        self._thread = None
+
+    def __len__(self):
+        return len(self._tracked)
+
+    def __contains__(self, transaction_id):
+        return transaction_id in self._tracked
+
+    def _schedule(self, tracked, due):
+        heapq.heappush(self._heap, (due, next(self._order), tracked))
+
+    def track(self, attempt, delay=None):
+        """
+        Starts polling an authorized attempt, the first poll happening after
+        ``delay`` (``initial_delay`` by default) seconds.
+        """
+        now = time.time()
+        delay = self.initial_delay if delay is None else delay
+
+        with self._lock:
+            previous = self._tracked.get(attempt.transaction_id)
+            if previous is not None:
+                previous.removed = True
+
+            tracked = _Tracked(attempt, self.initial_delay, now + self.timeout)
+            self._tracked[attempt.transaction_id] = tracked
+            self._schedule(tracked, now + delay)
+            self._compact()
+        self._wakeup.set()
+
+    def untrack(self, transaction_id):
+        with self._lock:
+            tracked = self._tracked.pop(transaction_id, None)
+            if tracked is not None:
+                tracked.removed = True
+                self._compact()
+
+    def _compact(self):
+        # Untracked entries are dropped lazily, when due; the heap is rebuilt
+        # once they are the majority so it stays proportional to the tracked
+        if len(self._heap) > 2 * len(self._tracked) + 32:
+            self._heap = [entry for entry in self._heap if not entry[2].removed]
+            heapq.heapify(self._heap)
+
+    def next_due(self):
+        """
+        Seconds until the next poll, None when nothing is tracked.
+        """
+        with self._lock:
+            while self._heap and self._heap[0][2].removed:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                return None
+            return max(self._heap[0][0] - time.time(), 0)
+
+    def _refresh(self, tracked):
+        attempt = tracked.attempt
+        old_status = getattr(attempt, 'status', None)
+        try:
+            attempt.refresh()
+        except Exception as e:
+            return tracked, old_status, e
+        return tracked, old_status, None
+
+    def poll_due(self, now=None):
+        """
+        Refreshes the transactions due by ``now``, returning how many were polled.
+        """
+        now = time.time() if now is None else now
+
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                tracked = heapq.heappop(self._heap)[2]
+                if not tracked.removed:
+                    due.append(tracked)
+        if not due:
+            return 0
+
+        if self._pool is None:
+            self._pool = ThreadPool(self.concurrency)
+        results = self._pool.map(self._refresh, due)
+
+        # Every entry is rescheduled or dropped before any callback runs, so
+        # a failing callback can't leave the others out of the heap
+        expired = []
+        with self._lock:
+            for tracked, old_status, error in results:
+                attempt = tracked.attempt
+                if tracked.removed:
+                    continue
+                if error is None and attempt.status not in AUTHENTICATION_PENDING_STATUSES:
+                    finished = True
+                elif now >= tracked.expires_at:
+                    finished = True
+                    expired.append(tracked)
+                else:
+                    finished = False
+
+                if finished:
+                    tracked.removed = True
+                    del self._tracked[attempt.transaction_id]
+                else:
+                    tracked.delay = min(tracked.delay * self.backoff, self.max_delay)
+                    self._schedule(tracked, now + tracked.delay)
+
+        for tracked, old_status, error in results:
+            attempt = tracked.attempt
+            if error is not None:
+                tracked.errors += 1
+                self._notify(self.on_error, attempt, error)
+            elif attempt.status != old_status:
+                self._notify(self.on_change, attempt, old_status, attempt.status)
+            if tracked in expired:
+                self._notify(self.on_change, attempt, attempt.status, None)
+
+        return len(due)
+
+    def _notify(self, callback, attempt, *args):
+        if callback is None:
+            return
+        try:
+            callback(attempt, *args)
+        except Exception:
+            log.exception('%s callback failed for transaction %s', callback, attempt.transaction_id)
+
+    def run(self):
+        """
+        Polls until stop() is called, sleeping while nothing is due.
+        """
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            self.poll_due()
+
+            wait = self.next_due()
+            self._wakeup.wait(wait if wait is not None else self.max_delay)
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
@@ -0,0 +1,161 @@
+# coding: utf-8
+import os
+import struct
+import threading
+import time
+
+from . import forksafe
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__all__ = ['TokenBucket', 'FileTokenBucket', 'RateLimiter']
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket: allows ``rate`` acquisitions per second on
+    average, with bursts of up to ``capacity``.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self._tokens = self.capacity
+        self._updated_at = time.time()
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(now - self._updated_at, 0)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def try_acquire(self, tokens=1):
+        """
+        Takes ``tokens`` from the bucket if available. Returns how long to
+        wait before they would be, or 0 when they were taken.
+        """
+        with self._lock:
+            self._refill(time.time())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """
+        Blocks until ``tokens`` are available.
+        """
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    Token bucket whose state lives in a file, so every process on the host
+    using the same path shares the budget. Updates are serialized with flock.
+    """
+    state = struct.Struct('<dd')
+
+    def __init__(self, path, rate, capacity=None):
+        if fcntl is None:
+            raise RuntimeError('FileTokenBucket requires fcntl (POSIX systems only)')
+
+        super(FileTokenBucket, self).__init__(rate, capacity)
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def _file(self):
+        # flock locks are shared by forked children, so each process opens its own
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            fd = self._file()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                os.lseek(fd, 0, os.SEEK_SET)
+                data = os.read(fd, self.state.size)
+                now = time.time()
+                if len(data) == self.state.size:
+                    self._tokens, self._updated_at = self.state.unpack(data)
+                else:
+                    self._tokens, self._updated_at = self.capacity, now
+
+                self._refill(now)
+                wait = 0
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                else:
+                    wait = (tokens - self._tokens) / self.rate
+
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.write(fd, self.state.pack(self._tokens, self._updated_at))
+                return wait
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class RateLimiter(object):
+    """
+    Keeps one token bucket per affiliation id and operation (see
+    TEMPLATE_OPERATIONS), passed to the requests as ``rate_limiter``.
+
+    ``rates`` maps operations to requests per second, ``'*'`` being used for
+    the ones not listed; a number applies to every operation. With
+    ``shared_dir`` the buckets are FileTokenBuckets stored in that directory,
+    shared by all the processes pointing to it.
+    """
+
+    def __init__(self, rates, burst=None, shared_dir=None):
+        self.rates = rates if isinstance(rates, dict) else {'*': rates}
+        self.burst = burst
+        self.shared_dir = shared_dir
+        self._buckets = {}
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def bucket(self, affiliation_id, operation):
+        key = (affiliation_id, operation)
+        try:
+            return self._buckets[key]
+        except KeyError:
+            pass
+
+        rate = self.rates.get(operation, self.rates.get('*'))
+        if rate is None:
+            return None
+
+        with self._lock:
+            if key not in self._buckets:
+                if self.shared_dir is not None:
+                    path = os.path.join(self.shared_dir, '{0}-{1}.bucket'.format(affiliation_id, operation))
+                    self._buckets[key] = FileTokenBucket(path, rate, self.burst)
+                else:
+                    self._buckets[key] = TokenBucket(rate, self.burst)
+            return self._buckets[key]
+
+    def try_acquire(self, affiliation_id, operation):
+        bucket = self.bucket(affiliation_id, operation)
+        return bucket.try_acquire() if bucket is not None else 0
+
+    def acquire(self, affiliation_id, operation):
+        bucket = self.bucket(affiliation_id, operation)
+        if bucket is not None:
+            bucket.acquire()
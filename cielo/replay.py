@@ -0,0 +1,248 @@
+# coding: utf-8
+"""
+Capture of real exchanges with Cielo and their replay through the whole
+client (template rendering, parsing and response handling), to catch CPU
+and memory regressions with production shaped traffic:
+
+    python -m cielo.replay traffic.capture --speed 10
+"""
+import argparse
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import namedtuple
+from datetime import date, timedelta
+from decimal import Decimal
+
+import xmltodict
+
+from . import forksafe
+from .constants import AUTHORIZATION, CAPTURE, CANCELATION, STATUS, TOKENIZATION, CASH
+from .loadtest import LoadReport, _cpu_time, _max_rss
+from .main import PaymentAttempt, TokenPaymentAttempt, BuyPageCieloAttempt, CieloToken, Transaction
+from .util import redact_payload
+
+__all__ = ['TrafficRecorder', 'Exchange', 'read_traffic', 'replay_traffic']
+
+OPERATIONS = (AUTHORIZATION, CAPTURE, CANCELATION, STATUS, TOKENIZATION)
+
+# zlib compressed size, request size, HTTP status, operation index, start time and
+# duration, followed by the compressed request and response
+RECORD = struct.Struct('<IIHBdf')
+
+# Card numbers are redacted, replayed authorizations use this one instead
+REPLAY_CARD_NUMBER = '4012001037141112'
+
+Exchange = namedtuple('Exchange', 'operation started_at duration status_code request response')
+
+
+class TrafficRecorder(object):
+    """
+    Appends every exchange with Cielo to a capture file, passed to the
+    requests as ``traffic_recorder``. The card data, security code, tokens
+    and api key are redacted (see redact_payload).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def record(self, operation, payload, response, started_at, duration):
+        request = redact_payload(payload)
+        if not isinstance(request, bytes):
+            request = request.encode('utf-8')
+        data = zlib.compress(request + redact_payload(response.content))
+        header = RECORD.pack(len(data), len(request), response.status_code, OPERATIONS.index(operation),
+                             started_at, duration)
+        with self._lock:
+            self._file.write(header + data)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def read_traffic(path):
+    """
+    Yields the Exchanges of a capture file, ignoring a truncated last record.
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            size, request_size, status_code, operation, started_at, duration = RECORD.unpack(header)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            data = zlib.decompress(data)
+            yield Exchange(OPERATIONS[operation], started_at, duration, status_code,
+                           data[:request_size].decode('utf-8', 'replace'), data[request_size:])
+
+
+class _RecordedResponse(object):
+
+    def __init__(self, exchange):
+        self.content = exchange.response
+        self.status_code = exchange.status_code
+        self.elapsed = timedelta(seconds=exchange.duration)
+
+
+class _RecordedTransport(object):
+    """
+    Stands for the RequestScheduler of a replayed request, answering with
+    the recorded response instead of going to the network.
+    """
+
+    def __init__(self, exchange):
+        self.exchange = exchange
+
+    def post(self, url, operation, priority=None, **kwargs):
+        return _RecordedResponse(self.exchange)
+
+
+def _card_kwargs(holder):
+    return {
+        'card_number': REPLAY_CARD_NUMBER,
+        'cvc2': 123,
+        'exp_month': 12,
+        'exp_year': date.today().year + 1,
+        'card_holders_name': holder.get('nome-portador') or '',
+    }
+
+
+def _replay(exchange, request_kwargs):
+    """
+    Rebuilds the request of an exchange from its payload and runs it.
+    """
+    root, message = list(xmltodict.parse(exchange.request).items())[0]
+    merchant = message.get('dados-ec') or {}
+    order = message.get('dados-pedido') or {}
+    payment = message.get('forma-pagamento') or {}
+    holder = message.get('dados-portador') or {}
+
+    kwargs = dict(request_kwargs, affiliation_id=merchant.get('numero'), api_key=merchant.get('chave'),
+                  scheduler=_RecordedTransport(exchange))
+    if order.get('numero') is not None:
+        kwargs['order_id'] = order['numero']
+    if order.get('valor') is not None:
+        kwargs['total'] = Decimal(order['valor']) / 100
+
+    if root == 'requisicao-token':
+        return CieloToken(card_type=None, **dict(kwargs, **_card_kwargs(holder))).create_token()
+
+    if root != 'requisicao-transacao':
+        transaction = Transaction(**kwargs)
+        if root == 'requisicao-captura':
+            return transaction.capture(transaction_id=message['tid'])
+        if root == 'requisicao-cancelamento':
+            # The amount to cancel is at the root, there's no dados-pedido
+            return transaction.cancel(transaction_id=message['tid'], amount=Decimal(message['valor']) / 100)
+        if root == 'requisicao-consulta-chsec':
+            transaction.order_id = message['numero-pedido']
+            return transaction.refresh_by_order()
+        return transaction.refresh(transaction_id=message['tid'])
+
+    product = payment.get('produto')
+    kwargs.update(
+        card_type=payment.get('bandeira'),
+        installments=int(payment.get('parcelas') or 1),
+        transaction=int(product) if product and product.isdigit() else product or CASH,
+        capture=message.get('capturar') == 'true',
+        tokenize=message.get('gerar-token') == 'true',
+        url_redirect=message.get('url-retorno') or '',
+    )
+    if 'token' in holder:
+        attempt = TokenPaymentAttempt(token=holder['token'], **kwargs)
+    elif 'numero' in holder:
+        attempt = PaymentAttempt(**dict(kwargs, **_card_kwargs(holder)))
+    else:
+        attempt = BuyPageCieloAttempt(description=order.get('descricao') or '', **kwargs)
+    return attempt.get_authorized()
+
+
+def replay_traffic(path, speed=None, concurrency=1, **request_kwargs):
+    """
+    Replays a capture file through the client, ``speed`` times faster than
+    recorded (as fast as possible when None), from ``concurrency`` threads.
+    Recorded Cielo errors are replayed too and counted in the report's
+    errors. Other keyword arguments go to the requests.
+    """
+    exchanges = list(read_traffic(path))
+    report = LoadReport('replay', None, concurrency)
+    lock = threading.Lock()
+    pending = iter(exchanges)
+    first_at = exchanges[0].started_at if exchanges else 0
+
+    def work():
+        while True:
+            with lock:
+                exchange = next(pending, None)
+            if exchange is None:
+                return
+
+            due = time.time()
+            if speed:
+                due = started_at + (exchange.started_at - first_at) / speed
+                delay = due - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            sent_at = time.time()
+            error = None
+            try:
+                _replay(exchange, request_kwargs)
+            except Exception as e:
+                error = getattr(e, 'id', None) or e.__class__.__name__
+            finished_at = time.time()
+
+            with lock:
+                report.latencies.append(finished_at - due)
+                report.service_times.append(finished_at - sent_at)
+                report.operations[exchange.operation] = report.operations.get(exchange.operation, 0) + 1
+                if error is not None:
+                    report.errors[error] = report.errors.get(error, 0) + 1
+
+    rss_before = _max_rss()
+    cpu_before = _cpu_time()
+    started_at = time.time()
+
+    threads = [threading.Thread(target=work) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    report.elapsed = time.time() - started_at
+    report.cpu_time = _cpu_time() - cpu_before
+    if rss_before is not None:
+        report.memory_growth = _max_rss() - rss_before
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay captured Cielo traffic through python-cielo')
+    parser.add_argument('path', help='capture file written by TrafficRecorder')
+    parser.add_argument('--speed', type=float, help='times faster than recorded, as fast as possible if omitted')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=1, help='replays in a row, to spot memory growth')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.path):
+        parser.error('{0} not found'.format(args.path))
+
+    for i in range(args.repeat):
+        report = replay_traffic(args.path, args.speed, args.concurrency)
+        sys.stdout.write(report.summary() + '\n\n')
+
+
+if __name__ == '__main__':
+    main()
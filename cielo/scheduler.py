@@ -0,0 +1,77 @@
+# coding: utf-8
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import forksafe
+from .constants import INTERACTIVE, TRANSACTIONAL, BACKGROUND, OPERATION_PRIORITIES
+
+__all__ = ['RequestScheduler']
+
+
+class _PriorityClass(object):
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphore = threading.BoundedSemaphore(limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=limit)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.in_flight = 0
+
+
+class RequestScheduler(object):
+    """
+    Bulkheads between request priorities (INTERACTIVE authorizations and
+    tokenizations, TRANSACTIONAL captures and cancelations, BACKGROUND status
+    refreshes). Each priority has its own concurrency limit and its own
+    connection pool, so background work can't take the capacity reserved
+    for customer facing payments.
+
+    Pass it to the requests as ``scheduler``; a request's ``priority``
+    argument overrides the one of its operation.
+    """
+    default_limits = {
+        INTERACTIVE: 16,
+        TRANSACTIONAL: 8,
+        BACKGROUND: 4,
+    }
+
+    def __init__(self, limits=None):
+        class_limits = dict(self.default_limits)
+        class_limits.update(limits or {})
+        self.classes = dict((priority, _PriorityClass(limit)) for priority, limit in class_limits.items())
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        # Pooled connections belong to the parent, the children open their own
+        self.classes = dict((priority, _PriorityClass(priority_class.limit))
+                            for priority, priority_class in self.classes.items())
+        self._lock = threading.Lock()
+
+    def priority_for(self, operation, priority=None):
+        if priority is not None:
+            return priority
+        return OPERATION_PRIORITIES.get(operation, BACKGROUND)
+
+    def in_flight(self, priority):
+        return self.classes[priority].in_flight
+
+    def post(self, url, operation, priority=None, **kwargs):
+        """
+        Posts using the pool of the request's priority, waiting for one of
+        its slots to be free.
+        """
+        priority_class = self.classes[self.priority_for(operation, priority)]
+
+        with priority_class.semaphore:
+            with self._lock:
+                priority_class.in_flight += 1
+            try:
+                return priority_class.session.post(url, **kwargs)
+            finally:
+                with self._lock:
+                    priority_class.in_flight -= 1
@@ -0,0 +1,175 @@
+# coding: utf-8
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from datetime import datetime
+
+from . import forksafe
+from .constants import TERMINAL_STATUSES, TRANSACTION_STATUS
+
+__all__ = ['TransactionStore', 'StoredTransaction', 'OrderIndex']
+
+StoredTransaction = namedtuple(
+    'StoredTransaction', 'transaction_id affiliation_id order_id status total created_at updated_at'
+)
+
+COLUMNS = 'tid, affiliation_id, order_id, status, total, created_at, updated_at'
+
+
+class TransactionStore(object):
+    """
+    Last known state of every transaction, in a SQLite database indexed by
+    tid, order id, status and creation time. Passed to the attempts as
+    ``transaction_store`` it is updated with every response, so questions
+    about known transactions don't need a refresh from Cielo.
+
+    Connections are kept per thread and per process, the database may be
+    shared by every process on the host.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS transactions ('
+            'tid TEXT PRIMARY KEY, affiliation_id TEXT, order_id TEXT, status TEXT, total TEXT, '
+            'created_at TEXT, updated_at REAL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS transactions_order_id ON transactions (order_id)')
+        connection.execute('CREATE INDEX IF NOT EXISTS transactions_status ON transactions (status, created_at)')
+        connection.execute('CREATE INDEX IF NOT EXISTS transactions_created_at ON transactions (created_at)')
+        connection.commit()
+
+    def _connection(self):
+        pid = os.getpid()
+        if getattr(self._local, 'pid', None) != pid:
+            self._local.connection = sqlite3.connect(self.path, timeout=30)
+            self._local.pid = pid
+        return self._local.connection
+
+    def _select(self, where, args):
+        rows = self._connection().execute(
+            'SELECT {0} FROM transactions WHERE {1} ORDER BY created_at'.format(COLUMNS, where), args
+        ).fetchall()
+        return [StoredTransaction(*row) for row in rows]
+
+    def update(self, attempt):
+        self.save(attempt.affiliation_id, attempt.transaction)
+
+    def save(self, affiliation_id, transaction):
+        """
+        Stores a ``transacao`` element as parsed from Cielo's answer. The
+        creation time is the order's ``data-hora``, kept from the first save.
+        """
+        order = transaction.get('dados-pedido') or {}
+        created_at = order.get('data-hora') or datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        row = (order.get('numero'), transaction['status'], order.get('valor'), time.time(), transaction['tid'])
+
+        connection = self._connection()
+        with connection:
+            updated = connection.execute(
+                'UPDATE transactions SET order_id = COALESCE(?, order_id), status = ?, '
+                'total = COALESCE(?, total), updated_at = ? WHERE tid = ?', row
+            ).rowcount
+            if not updated:
+                connection.execute(
+                    'INSERT INTO transactions ({0}) VALUES (?, ?, ?, ?, ?, ?, ?)'.format(COLUMNS),
+                    (transaction['tid'], affiliation_id, row[0], row[1], row[2], created_at[:19], row[3])
+                )
+
+    def get(self, transaction_id):
+        found = self._select('tid = ?', (transaction_id,))
+        return found[0] if found else None
+
+    def by_order(self, order_id, affiliation_id=None):
+        """
+        Transactions of an order, oldest first: an order may have been
+        attempted more than once.
+        """
+        if affiliation_id is None:
+            return self._select('order_id = ?', (order_id,))
+        return self._select('order_id = ? AND affiliation_id = ?', (order_id, affiliation_id))
+
+    def lookup(self, affiliation_id, order_id):
+        """
+        Transaction id of the order's latest transaction, making the store
+        usable as an ``order_index``.
+        """
+        found = self.by_order(order_id, affiliation_id)
+        return found[-1].transaction_id if found else None
+
+    def by_status(self, *statuses):
+        return self._select('status IN ({0})'.format(', '.join('?' * len(statuses))), statuses)
+
+    def non_terminal(self):
+        # Listing the statuses lets the query use the status index, unlike NOT IN
+        return self.by_status(*sorted(status for status in TRANSACTION_STATUS if status not in TERMINAL_STATUSES))
+
+    def authorized_not_captured(self):
+        return self.by_status('4')
+
+    def created_between(self, start, end):
+        """
+        Transactions created from ``start`` (inclusive) to ``end`` (exclusive).
+        """
+        return self._select('created_at >= ? AND created_at < ?', (
+            start.strftime('%Y-%m-%dT%H:%M:%S'), end.strftime('%Y-%m-%dT%H:%M:%S'),
+        ))
+
+    def delete(self, transaction_id):
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM transactions WHERE tid = ?', (transaction_id,))
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM transactions').fetchone()[0]
+
+
+class OrderIndex(object):
+    """
+    In-memory order id to transaction id mapping, passed to the attempts as
+    ``order_index``. Filled from every response, it lets capture, cancel
+    and refresh work from the order id without asking Cielo for the
+    transaction id. Keeps the ``max_size`` most recently used orders.
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        forksafe.register(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def update(self, attempt):
+        order = attempt.transaction.get('dados-pedido') or {}
+        order_id = order.get('numero') or attempt.order_id
+        if order_id:
+            self.add(attempt.affiliation_id, order_id, attempt.transaction_id)
+
+    def add(self, affiliation_id, order_id, transaction_id):
+        key = (affiliation_id, order_id)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = transaction_id
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def lookup(self, affiliation_id, order_id):
+        key = (affiliation_id, order_id)
+        with self._lock:
+            try:
+                transaction_id = self._entries.pop(key)
+            except KeyError:
+                return None
+            self._entries[key] = transaction_id
+            return transaction_id
+
+    def __len__(self):
+        return len(self._entries)
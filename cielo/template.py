@@ -0,0 +1,68 @@
+# coding: utf-8
+import os
+import re
+import threading
+
+from . import forksafe
+
+__all__ = ['Template', 'get_template']
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+_CREDENTIALS = re.compile(r'<dados-ec>.*?</dados-ec>', re.DOTALL)
+
+
+class Template(object):
+    """
+    Request template split around its ``<dados-ec>`` block, so the block
+    rendered with a merchant's credentials can be reused by all of the
+    merchant's requests. Renders exactly as ``text % context`` would.
+    """
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+
+        match = _CREDENTIALS.search(text)
+        if match is not None:
+            self.head, self.credentials, self.tail = text[:match.start()], match.group(0), text[match.end():]
+        else:
+            self.head, self.credentials, self.tail = text, '', ''
+
+    def render_credentials(self, affiliation_id, api_key):
+        return self.credentials % {'affiliation_id': affiliation_id, 'api_key': api_key}
+
+    def render(self, context, credentials=None):
+        if credentials is None:
+            credentials = self.credentials % context
+        return self.head % context + credentials + self.tail % context
+
+
+_templates = {}
+_lock = threading.Lock()
+
+
+@forksafe.register_callback
+def _after_fork():
+    global _lock
+    _lock = threading.Lock()
+
+
+def get_template(name):
+    """
+    Returns the Template in cielo/templates named ``name``, read only once.
+    """
+    try:
+        return _templates[name]
+    except KeyError:
+        pass
+
+    with _lock:
+        if name not in _templates:
+            # Read as bytes: the line endings are sent as they are in the file
+            with open(os.path.join(TEMPLATES_DIR, name), 'rb') as f:
+                text = f.read()
+            if not isinstance(text, str):
+                text = text.decode('latin-1')
+            _templates[name] = Template(name, text)
+        return _templates[name]
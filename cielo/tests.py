@@ -1,9 +1,22 @@
 # -*- coding: utf-8 -*-
+import os
 from os import path
+import csv
+import gc
+import json
+import logging
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from vcr import VCR
 from freezegun import freeze_time
 
+from datetime import date, datetime, timedelta
 from decimal import Decimal
 import requests
 from xml.parsers.expat import ExpatError
@@ -11,11 +24,46 @@ from xml.parsers.expat import ExpatError
 from cielo import *
 from cielo.exceptions import *
 from cielo.constants import *
+from cielo.cache import *
+from cielo.bulk import *
+from cielo.validation import *
+from cielo.ratelimit import *
+from cielo.scheduler import *
+from cielo.concurrency import *
+from cielo.admission import *
+from cielo.pending import *
+from cielo.poller import *
+from cielo.expiry import *
+from cielo.journal import *
+from cielo.journal import HEADER
+from cielo.store import *
+from cielo.diagnostics import *
+from cielo.loadtest import *
+from cielo.replay import *
+from cielo.template import *
+from cielo.breaker import *
+from cielo.merchants import *
+from cielo.workers import *
+from cielo.forksafe import *
+from cielo.lean import *
+from cielo.codec import *
+from cielo.installments import *
+from cielo import template
+from cielo import __main__ as command_line
 
 __all__ = [
     'BuyPageLojaTest', 'BuyPageCieloTest',
     'CancelTransactionTest', 'RefreshTransactionTest',
-    'CreateTokenTest',
+    'CreateTokenTest', 'TokenCacheTest', 'BulkTokenizationTest',
+    'CardValidationTest', 'RateLimiterTest',
+    'RequestSchedulerTest', 'AdaptiveConcurrencyTest',
+    'AdmissionControllerTest', 'PendingAuthorizationTest',
+    'AuthenticationPollerTest', 'CaptureDeadlineTrackerTest',
+    'TransactionJournalTest', 'TransactionStoreTest', 'OrderLookupTest',
+    'SlowRequestLogTest', 'LoadGeneratorTest', 'TrafficReplayTest',
+    'MerchantRegistryTest', 'ShardedWorkerPoolTest', 'ForkSafetyTest',
+    'LazyImportTest', 'CommandLineTest', 'LeanAttemptTest', 'CodecTest',
+    'InstallmentPlannerTest',
 ]
 
 
@@ -1201,6 +1249,30 @@ class CreateTokenTest(FrozenTimeTest):
         self.assertEqual(token.status, '1')
         self.assertTrue('1112' in token.card)
 
+    def test_create_cielo_token_using_cache(self):
+        params = {
+            'affiliation_id': '1006993069',
+            'api_key': '25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+            'card_type': 'visa',
+            'card_number': '4012001037141112',
+            'exp_month': 1,
+            'exp_year': 2010,
+            'card_holders_name': 'JOAO DA SILVA',
+            'sandbox': True,
+            'token_cache': TokenCache('secret'),
+        }
+        with CreateTokenTest.vcr.use_cassette('token_creation_success') as cassette:
+            token = CieloToken(**params)
+            token.create_token()
+
+            cached_token = CieloToken(**params)
+            cached_token.create_token()
+
+        self.assertEqual(cassette.play_count, 1)
+        self.assertEqual(cached_token.token, token.token)
+        self.assertEqual(cached_token.status, '1')
+        self.assertEqual(cached_token.card, token.card)
+
     def test_raises_create_cielo_token(self):
         params = {
             'affiliation_id': '323298379',
@@ -1377,5 +1449,1649 @@ class CreateTokenTest(FrozenTimeTest):
 
         self.assertEquals(TRANSACTION_STATUS[attempt.status], u'Não autorizada')
 
+class TokenCacheTest(unittest.TestCase):
+
+    def test_fingerprint_does_not_contain_card_number(self):
+        fingerprint = card_fingerprint('secret', '4012001037141112', '201001')
+        self.assertFalse('4012001037141112' in fingerprint)
+        self.assertEqual(fingerprint, card_fingerprint('secret', '4012001037141112', '201001'))
+        self.assertNotEqual(fingerprint, card_fingerprint('other', '4012001037141112', '201001'))
+        self.assertNotEqual(fingerprint, card_fingerprint('secret', '4012001037141112', '201002'))
+
+    def test_memory_store_evicts_least_recently_used(self):
+        store = MemoryTokenStore(max_size=2)
+        store.set('a', 1)
+        store.set('b', 2)
+        store.get('a')
+        store.set('c', 3)
+
+        self.assertEqual(store.get('a'), 1)
+        self.assertEqual(store.get('b'), None)
+        self.assertEqual(store.get('c'), 3)
+
+    def test_memory_store_expires_entries(self):
+        store = MemoryTokenStore()
+        store.set('a', 1, ttl=-1)
+        self.assertEqual(store.get('a'), None)
+
+    def test_sqlite_store_is_shared_between_caches(self):
+        directory = tempfile.mkdtemp()
+        try:
+            database = path.join(directory, 'tokens.db')
+            first = TokenCache('secret', store=SQLiteTokenStore(database))
+            second = TokenCache('secret', store=SQLiteTokenStore(database))
+
+            first.set('1006993069', '4012001037141112', '201001', 'TOKEN', '1', '401200******1112')
+            self.assertEqual(
+                second.get('1006993069', '4012001037141112', '201001'),
+                ('TOKEN', '1', '401200******1112')
+            )
+            self.assertEqual(second.get('1001734898', '4012001037141112', '201001'), None)
+
+            second.invalidate('1006993069', '4012001037141112', '201001')
+            first.memory.clear()
+            self.assertEqual(first.get('1006993069', '4012001037141112', '201001'), None)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_stored_entries_keep_their_expiration_in_memory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = TokenCache('secret', store=SQLiteTokenStore(path.join(directory, 'tokens.db')))
+            key = cache.key('1006993069', '4012001037141112', '201001')
+            cache.store.set(key, ('TOKEN', '1', '401200******1112'), ttl=60)
+
+            self.assertEqual(cache.get('1006993069', '4012001037141112', '201001'), ('TOKEN', '1', '401200******1112'))
+            value, expires_at = cache.memory.get_entry(key)
+            self.assertTrue(expires_at <= time.time() + 60)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_sqlite_store_prunes_oldest_entries(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = SQLiteTokenStore(path.join(directory, 'tokens.db'), max_entries=2)
+            store.set('a', ('A', '1', 'a'), ttl=10)
+            store.set('b', ('B', '1', 'b'), ttl=20)
+            store.set('c', ('C', '1', 'c'), ttl=30)
+            store.set('d', ('D', '1', 'd'), ttl=-1)
+            store.prune()
+
+            self.assertEqual(store.get('a'), None)
+            self.assertEqual(store.get('b'), ('B', '1', 'b'))
+            self.assertEqual(store.get('c'), ('C', '1', 'c'))
+        finally:
+            shutil.rmtree(directory)
+
+
+class BulkTokenizationTest(FrozenTimeTest):
+
+    vcr = CreateTokenTest.vcr
+
+    def setUp(self):
+        super(BulkTokenizationTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.output = path.join(self.directory, 'tokens.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(BulkTokenizationTest, self).tearDown()
+
+    def card(self, source_id, **kwargs):
+        card = {
+            'source_id': source_id,
+            'card_type': 'visa',
+            'card_number': '4012001037141112',
+            'exp_month': '1',
+            'exp_year': '2010',
+            'card_holders_name': 'JOAO DA SILVA',
+        }
+        card.update(kwargs)
+        return card
+
+    def tokenize(self, cards):
+        return tokenize_cards(
+            cards, self.output,
+            affiliation_id='1006993069',
+            api_key='25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+            concurrency=2,
+            rate=100,
+            sandbox=True,
+        )
+
+    def test_tokenize_cards(self):
+        cards = [
+            self.card('1'),
+            self.card('2', card_number='4012001037141113'),
+            self.card('3', exp_year='2009'),
+            self.card('4'),
+        ]
+        with BulkTokenizationTest.vcr.use_cassette('token_creation_success') as cassette:
+            result = self.tokenize(cards)
+
+        self.assertEqual(cassette.play_count, 1)
+        self.assertEqual(result.read, 4)
+        self.assertEqual(result.requests, 1)
+        self.assertEqual(result.duplicates, 1)
+        self.assertEqual(result.statuses, {'ok': 2, 'invalid:luhn': 1, 'invalid:expired': 1})
+
+        with open(self.output) as f:
+            rows = sorted(csv.reader(f))
+        self.assertEqual(rows[0], ['1', 'mgbM+Tuo4hmxThAT+xdJ1ibra3jjeQ/mL914D68gbi4=', '401200******1112', 'ok'])
+        self.assertEqual(rows[1], ['2', '', '', 'invalid:luhn'])
+        self.assertEqual(rows[2], ['3', '', '401200******1112', 'invalid:expired'])
+        self.assertEqual(rows[3], ['4', 'mgbM+Tuo4hmxThAT+xdJ1ibra3jjeQ/mL914D68gbi4=', '401200******1112', 'ok'])
+
+    def test_resume_skips_processed_cards(self):
+        self.tokenize([self.card('1', exp_year='2009')])
+        result = self.tokenize([self.card('1', exp_year='2009'), self.card('2', exp_year='2009')])
+
+        self.assertEqual(result.skipped, 1)
+        self.assertEqual(result.statuses, {'invalid:expired': 1})
+        with open(self.output) as f:
+            self.assertEqual(len(list(csv.reader(f))), 3)
+
+    def test_run_batch_reraises_input_errors(self):
+        def items():
+            for i in range(5):
+                yield i
+            raise ValueError('bad input line')
+
+        done = []
+        with self.assertRaises(ValueError):
+            for item, result, error in run_batch(lambda item: item * 2, items(), concurrency=3):
+                done.append(result)
+        self.assertEqual(sorted(done), [0, 2, 4, 6, 8])
+
+
+class CardValidationTest(unittest.TestCase):
+
+    cards = [
+        # card_number, exp_month, exp_year, card_type, expected
+        ('4012001037141112', 1, 2010, VISA, VALID),
+        ('4012001037141112', 1, 10, VISA, VALID),
+        ('4012001037141112', 12, 2009, VISA, VALID),
+        (' 4012001037141112 ', 12, 2009, VISA, VALID),
+        ('5453010000066167', 5, 2018, MASTERCARD, VALID),
+        ('376449047333005', 5, 2018, AMEX, VALID),
+        ('4012001037141112', 11, 2009, VISA, EXPIRED),
+        ('4012001037141112', 1, 9, VISA, INVALID_EXP_YEAR),
+        ('4012001037141112', 1, 201, VISA, INVALID_EXP_YEAR),
+        ('4012001037141112', 1, -5, VISA, INVALID_EXP_YEAR),
+        ('4012001037141112', 13, 2010, VISA, INVALID_EXP_MONTH),
+        ('4012001037141113', 1, 2010, VISA, INVALID_CHECKSUM),
+        ('4012001037141112', 1, 2010, MASTERCARD, INVALID_CARD_TYPE),
+        ('5453010000066167', 1, 2010, 'unknown', INVALID_CARD_TYPE),
+        ('4012-0010-3714-1112', 1, 2010, VISA, INVALID_NUMBER),
+        ('', 1, 2010, VISA, INVALID_NUMBER),
+        ('40120010371411124012', 1, 2010, VISA, INVALID_NUMBER),
+    ]
+    today = date(2009, 12, 14)
+
+    def columns(self):
+        return [list(column) for column in zip(*self.cards)]
+
+    def test_validate_card(self):
+        for card_number, exp_month, exp_year, card_type, expected in self.cards:
+            self.assertEqual(
+                validate_card(card_number, exp_month, exp_year, card_type, today=self.today), expected,
+                card_number
+            )
+
+    def test_validate_cards_without_numpy(self):
+        card_numbers, exp_months, exp_years, card_types, expected = self.columns()
+        result = validate_cards(card_numbers, exp_months, exp_years, card_types, today=self.today, use_numpy=False)
+        self.assertEqual(list(result), expected)
+
+    def test_validate_cards_with_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+
+        card_numbers, exp_months, exp_years, card_types, expected = self.columns()
+        result = validate_cards(
+            numpy.array(card_numbers), numpy.array(exp_months), numpy.array(exp_years), card_types,
+            today=self.today, use_numpy=True
+        )
+        self.assertEqual(result.tolist(), expected)
+
+    def test_validate_cards_without_card_types(self):
+        card_numbers, exp_months, exp_years, card_types, expected = self.columns()
+        result = validate_cards(card_numbers, exp_months, exp_years, today=self.today)
+        self.assertEqual(list(result)[-6:], [INVALID_CHECKSUM, VALID, VALID, INVALID_NUMBER, INVALID_NUMBER, INVALID_NUMBER])
+
+    def test_numpy_agrees_with_pure_python(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+
+        card_numbers = [
+            ' 4012001037141112   x', '4012001037141112' + ' ' * 10, '\t4012001037141112\n', '0' * 19,
+            '0' * 20, '0000004012001037141112', '4012001037141112x', '+4012001037141112', '4 012001037141112',
+            4012001037141112, ' ', '',
+        ]
+        rows = [(card_number, month, year, card_type)
+                for card_number in card_numbers for month in (0, 1, 12, 13) for year in (-5, -999, 9, 10, 99, 2010, 10000)
+                for card_type in (VISA, MASTERCARD)]
+        card_numbers, exp_months, exp_years, card_types = [list(column) for column in zip(*rows)]
+
+        for typed in (card_types, None):
+            expected = validate_cards(card_numbers, exp_months, exp_years, typed, today=self.today, use_numpy=False)
+            result = validate_cards(card_numbers, exp_months, exp_years, typed, today=self.today, use_numpy=True)
+            self.assertEqual(result.tolist(), list(expected))
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_token_bucket_allows_bursts_up_to_capacity(self):
+        bucket = TokenBucket(rate=1, capacity=2)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertEqual(bucket.try_acquire(), 0)
+        self.assertTrue(0 < bucket.try_acquire() <= 1)
+
+    def test_file_token_bucket_is_shared(self):
+        bucket_path = path.join(self.directory, 'bucket')
+        first = FileTokenBucket(bucket_path, rate=0.001, capacity=2)
+        second = FileTokenBucket(bucket_path, rate=0.001, capacity=2)
+
+        self.assertEqual(first.try_acquire(), 0)
+        self.assertEqual(second.try_acquire(), 0)
+        self.assertTrue(first.try_acquire() > 0)
+        self.assertTrue(second.try_acquire() > 0)
+
+    def test_rate_limiter_keeps_a_bucket_per_affiliation_and_operation(self):
+        limiter = RateLimiter({CAPTURE: 0.001, '*': None}, burst=1)
+
+        self.assertEqual(limiter.try_acquire('1006993069', CAPTURE), 0)
+        self.assertTrue(limiter.try_acquire('1006993069', CAPTURE) > 0)
+        self.assertEqual(limiter.try_acquire('1001734898', CAPTURE), 0)
+        self.assertEqual(limiter.bucket('1006993069', STATUS), None)
+        self.assertEqual(limiter.try_acquire('1006993069', STATUS), 0)
+
+    def test_shared_rate_limiter_uses_file_buckets(self):
+        first = RateLimiter(0.001, burst=1, shared_dir=self.directory)
+        second = RateLimiter(0.001, burst=1, shared_dir=self.directory)
+
+        self.assertTrue(isinstance(first.bucket('1006993069', CAPTURE), FileTokenBucket))
+        self.assertEqual(first.try_acquire('1006993069', CAPTURE), 0)
+        self.assertTrue(second.try_acquire('1006993069', CAPTURE) > 0)
+
+    def test_requests_acquire_from_the_rate_limiter(self):
+        limiter = RateLimiter({AUTHORIZATION: 0.001}, burst=1)
+        params = {
+            'affiliation_id': '1006993069',
+            'api_key': '25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+            'card_type': VISA,
+            'total': Decimal('1.00'),
+            'order_id': '7DSD163AHBPL1',
+            'card_number': '4012001037141112',
+            'cvc2': 423,
+            'exp_month': 1,
+            'exp_year': 2010,
+            'card_holders_name': 'JOAO DA SILVA',
+            'installments': 1,
+            'transaction': CASH,
+            'sandbox': True,
+            'rate_limiter': limiter,
+        }
+        with freeze_time("2009-12-14 12:00:01"):
+            attempt = PaymentAttempt(**params)
+            with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+                self.assertTrue(attempt.get_authorized())
+
+            self.assertTrue(limiter.try_acquire('1006993069', AUTHORIZATION) > 0)
+
+
+class RequestSchedulerTest(FrozenTimeTest):
+
+    params = {
+        'affiliation_id': '1006993069',
+        'api_key': '25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+        'card_type': VISA,
+        'total': Decimal('1.00'),
+        'order_id': '7DSD163AHBPL1',
+        'card_number': '4012001037141112',
+        'cvc2': 423,
+        'exp_month': 1,
+        'exp_year': 2010,
+        'card_holders_name': 'JOAO DA SILVA',
+        'installments': 1,
+        'transaction': CASH,
+        'sandbox': True,
+    }
+
+    def test_priority_for_operation(self):
+        scheduler = RequestScheduler()
+        self.assertEqual(scheduler.priority_for(AUTHORIZATION), INTERACTIVE)
+        self.assertEqual(scheduler.priority_for(CAPTURE), TRANSACTIONAL)
+        self.assertEqual(scheduler.priority_for(STATUS), BACKGROUND)
+        self.assertEqual(scheduler.priority_for(AUTHORIZATION, BACKGROUND), BACKGROUND)
+
+    def test_background_work_does_not_block_authorizations(self):
+        scheduler = RequestScheduler({BACKGROUND: 1})
+        attempt = PaymentAttempt(scheduler=scheduler, **self.params)
+
+        # Background capacity exhausted
+        background = scheduler.classes[BACKGROUND].semaphore
+        self.assertTrue(background.acquire(False))
+        try:
+            with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+                self.assertTrue(attempt.get_authorized())
+        finally:
+            background.release()
+
+        self.assertTrue(attempt._authorized)
+        self.assertEqual(scheduler.in_flight(INTERACTIVE), 0)
+
+    def test_request_priority_overrides_operation_priority(self):
+        scheduler = RequestScheduler({BACKGROUND: 1})
+        attempt = PaymentAttempt(scheduler=scheduler, priority=BACKGROUND, **self.params)
+
+        background = scheduler.classes[BACKGROUND].semaphore
+        self.assertTrue(background.acquire(False))
+        released = []
+
+        def release():
+            released.append(True)
+            background.release()
+        threading.Timer(0.05, release).start()
+
+        # Only goes out once the background slot is released
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            self.assertTrue(attempt.get_authorized())
+        self.assertEqual(released, [True])
+
+
+class AdaptiveConcurrencyTest(unittest.TestCase):
+
+    def test_limit_increases_while_in_use(self):
+        changes = []
+        limiter = AdaptiveConcurrencyLimiter(initial=1, latency_target=10, on_change=lambda *args: changes.append(args))
+
+        started_at = limiter.acquire()
+        limiter.release(started_at)
+        self.assertEqual(limiter.metrics()['limit'], 2)
+        self.assertEqual(changes, [(1, 2, 'increase')])
+
+        # Not increased when there are free slots
+        started_at = limiter.acquire()
+        limiter.release(started_at)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_limit_decreases_once_per_round_trip(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=8, min_limit=3)
+        started = [limiter.acquire() for i in range(4)]
+
+        limiter.release(started[0], error=True)
+        self.assertEqual(limiter.limit, 4)
+        limiter.release(started[1], error=True)
+        self.assertEqual(limiter.limit, 4)
+
+        limiter.release(limiter.acquire(), error=True)
+        self.assertEqual(limiter.limit, 3)
+        self.assertEqual([change[1:] for change in limiter.changes], [(8, 4, 'error'), (4, 3, 'error')])
+        self.assertEqual(limiter.metrics()['overloads'], 3)
+
+    def test_slow_requests_decrease_the_limit(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=4, latency_target=1)
+        limiter.release(limiter.acquire() - 5)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_acquire_waits_for_a_free_slot(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=1, latency_target=10)
+        started_at = limiter.acquire()
+        threading.Timer(0.05, limiter.release, (started_at,)).start()
+
+        limiter.acquire()
+        self.assertEqual(limiter.in_flight, 1)
+
+    def test_refresh_transactions_with_adaptive_concurrency(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=1, max_limit=4, latency_target=10)
+        transaction_ids = ['10069930690A31091001', '10069930690F2AE71001']
+
+        with RefreshTransactionTest.vcr.use_cassette('status_for_authorized_transaction'):
+            results = list(refresh_transactions(
+                transaction_ids,
+                affiliation_id='1006993069',
+                api_key='25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+                sandbox=True,
+                concurrency_limiter=limiter,
+            ))
+
+        self.assertEqual(sorted(tid for tid, transaction, error in results), transaction_ids)
+        for tid, transaction, error in results:
+            self.assertEqual(error, None)
+            self.assertEqual(transaction.status, '4')
+        self.assertEqual(limiter.samples, 2)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_overload_errors_are_reported_to_the_limiter(self):
+        limiter = AdaptiveConcurrencyLimiter(initial=4)
+        params = {
+            'affiliation_id': '1006993069',
+            'api_key': '25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+            'card_type': VISA,
+            'total': Decimal('1.00'),
+            'order_id': '7DSD163AHBPL1',
+            'card_number': '4012001037141112',
+            'cvc2': 423,
+            'exp_month': 1,
+            'exp_year': 2010,
+            'card_holders_name': 'JOAO DA SILVA',
+            'installments': 1,
+            'transaction': CASH,
+            'sandbox': True,
+            'concurrency_limiter': limiter,
+        }
+        with freeze_time("2009-12-14 12:00:01"):
+            attempt = PaymentAttempt(**params)
+            with BuyPageLojaTest.vcr.use_cassette('cielo_webservice_error'):
+                self.assertRaises(ExpatError, attempt.get_authorized)
+
+        self.assertEqual(limiter.limit, 2)
+        self.assertEqual(limiter.in_flight, 0)
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def wait_for_queue(self, controller, size):
+        while controller.queued < size:
+            time.sleep(0.001)
+
+    def test_reject_policy(self):
+        controller = AdmissionController(max_in_flight=1, policy=REJECT)
+        controller.acquire(AUTHORIZATION)
+
+        with self.assertRaises(RequestRejectedException) as context:
+            controller.acquire(AUTHORIZATION)
+        self.assertEqual(context.exception.reason, 'in_flight')
+
+        controller.release()
+        controller.acquire(AUTHORIZATION)
+        self.assertEqual(controller.rejected, 1)
+
+    def test_wait_policy_gives_up_after_the_deadline(self):
+        controller = AdmissionController(max_in_flight=1, policy=WAIT, timeout=0.01)
+        controller.acquire(AUTHORIZATION)
+
+        with self.assertRaises(RequestRejectedException) as context:
+            controller.acquire(AUTHORIZATION)
+        self.assertEqual(context.exception.reason, 'deadline')
+        self.assertEqual(controller.queued, 0)
+
+    def test_wait_policy_rejects_when_queue_is_full(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=0, policy=WAIT)
+        controller.acquire(AUTHORIZATION)
+
+        with self.assertRaises(RequestRejectedException) as context:
+            controller.acquire(AUTHORIZATION)
+        self.assertEqual(context.exception.reason, 'queue_full')
+
+    def test_released_slots_go_to_the_highest_priority(self):
+        controller = AdmissionController(max_in_flight=1, policy=WAIT, timeout=5)
+        controller.acquire(AUTHORIZATION)
+        admitted = []
+
+        def request(operation):
+            controller.acquire(operation)
+            admitted.append(operation)
+            controller.release()
+
+        threads = [threading.Thread(target=request, args=(STATUS,))]
+        threads[0].start()
+        self.wait_for_queue(controller, 1)
+        threads.append(threading.Thread(target=request, args=(AUTHORIZATION,)))
+        threads[1].start()
+        self.wait_for_queue(controller, 2)
+
+        controller.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(admitted, [AUTHORIZATION, STATUS])
+        self.assertEqual(controller.in_flight, 0)
+
+    def test_shed_policy_drops_the_lowest_priority(self):
+        controller = AdmissionController(max_in_flight=1, max_queue=1, policy=SHED, timeout=5)
+        controller.acquire(AUTHORIZATION)
+        errors = []
+
+        def refresh():
+            try:
+                controller.acquire(STATUS)
+            except RequestRejectedException as e:
+                errors.append(e.reason)
+
+        thread = threading.Thread(target=refresh)
+        thread.start()
+        self.wait_for_queue(controller, 1)
+
+        # A capture takes the place of the queued refresh
+        capture = threading.Thread(target=controller.acquire, args=(CAPTURE,))
+        capture.start()
+        thread.join()
+        self.assertEqual(errors, ['shed'])
+
+        # But a refresh can't take the place of the capture
+        self.assertRaises(RequestRejectedException, controller.acquire, STATUS)
+
+        controller.release()
+        capture.join()
+        self.assertEqual(controller.in_flight, 1)
+
+    def test_rejected_requests_do_not_reach_cielo(self):
+        controller = AdmissionController(max_in_flight=0, policy=REJECT)
+        attempt = Transaction(
+            affiliation_id='1006993069',
+            api_key='25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+            sandbox=True,
+            admission=controller,
+        )
+
+        with RefreshTransactionTest.vcr.use_cassette('status_for_authorized_transaction') as cassette:
+            self.assertRaises(RequestRejectedException, attempt.refresh, transaction_id='10069930690A31091001')
+        self.assertEqual(cassette.play_count, 0)
+
+
+class SlowPaymentAttempt(PaymentAttempt):
+    """
+    Payment attempt whose requests take ``delay`` seconds longer, or fail
+    with ``error`` once.
+    """
+    delay = 0
+    error = None
+
+    def send(self, url, operation, payload):
+        time.sleep(self.delay)
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return super(SlowPaymentAttempt, self).send(url, operation, payload)
+
+
+class PendingAuthorizationTest(FrozenTimeTest):
+
+    params = {
+        'affiliation_id': '1006993069',
+        'api_key': '25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+        'card_type': VISA,
+        'total': Decimal('1.00'),
+        'order_id': '7DSD163AHBPL1',
+        'card_number': '4012001037141112',
+        'cvc2': 423,
+        'exp_month': 1,
+        'exp_year': 2010,
+        'card_holders_name': 'JOAO DA SILVA',
+        'installments': 1,
+        'transaction': CASH,
+        'sandbox': True,
+    }
+
+    def test_authorization_within_budget(self):
+        attempt = SlowPaymentAttempt(**self.params)
+
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            pending = authorize_within(attempt, budget=5)
+
+        self.assertFalse(pending.pending)
+        self.assertTrue(pending.result())
+        self.assertTrue(attempt._authorized)
+
+    def test_authorization_resolved_in_background(self):
+        attempt = SlowPaymentAttempt(**self.params)
+        attempt.delay = 0.1
+        resolved = []
+
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            pending = authorize_within(attempt, budget=0.001, callback=resolved.append)
+            self.assertTrue(pending.pending)
+            self.assertRaises(RuntimeError, pending.result, 0)
+
+            self.assertTrue(pending.result(timeout=5))
+
+        self.assertEqual(resolved, [pending])
+        self.assertTrue(attempt._authorized)
+
+    def test_lost_answer_is_looked_up_by_tid(self):
+        attempt = SlowPaymentAttempt(**dict(self.params, order_id='7DSD163AHREF1'))
+        with RefreshTransactionTest.vcr.use_cassette('authorization_success'):
+            attempt.get_authorized()
+
+        # Authorized again, but the answer is lost on the way back
+        attempt.error = requests.exceptions.Timeout()
+        with RefreshTransactionTest.vcr.use_cassette('status_for_authorized_transaction'):
+            pending = authorize_within(attempt, budget=5, poll_interval=0)
+            self.assertTrue(pending.result(timeout=5))
+
+        self.assertEqual(attempt.status, '4')
+
+    def test_authorization_errors(self):
+        attempt = SlowPaymentAttempt(**self.params)
+        attempt.error = requests.exceptions.Timeout()
+
+        pending = authorize_within(attempt, budget=5, max_polls=0)
+        self.assertTrue(isinstance(pending.exception(), requests.exceptions.Timeout))
+        self.assertRaises(requests.exceptions.Timeout, pending.result)
+
+        attempt = SlowPaymentAttempt(**dict(self.params, api_key='25fbb99741c739dd84d', order_id='7DSD163AHBPL8'))
+        with BuyPageLojaTest.vcr.use_cassette('authorization_bad_api_key'):
+            pending = authorize_within(attempt, budget=5)
+            self.assertRaises(CieloException, pending.result, 5)
+
+    def test_requests_never_sent_resolve_at_once(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        breaker.record(failed=True)
+        attempts = [
+            PaymentAttempt(admission=AdmissionController(max_in_flight=0, policy=REJECT), **self.params),
+            PaymentAttempt(circuit_breaker=breaker, **self.params),
+        ]
+
+        for attempt, exception in zip(attempts, [RequestRejectedException, CircuitOpenException]):
+            pending = authorize_within(attempt, budget=5, poll_interval=60)
+            self.assertFalse(pending.pending)
+            self.assertTrue(isinstance(pending.exception(), exception))
+
+
+class AuthenticationPollerTest(FrozenTimeTest):
+
+    params = {
+        'affiliation_id': '1001734898',
+        'api_key': 'e84827130b9837473681c2787007da5914d6359947015a5cdb2b8843db0fa832',
+        'card_type': VISA,
+        'total': Decimal('1.00'),
+        'order_id': '7DSD163AHBPC3',
+        'description': 'Transacao teste BuyPage Cielo',
+        'url_redirect': 'http://localhost:7777/orders/7DSD163AHBPC3/',
+        'installments': 1,
+        'transaction': CASH,
+        'sandbox': True,
+    }
+
+    def test_polls_until_a_final_status(self):
+        changes = []
+        poller = AuthenticationPoller(
+            initial_delay=10, backoff=2, on_change=lambda attempt, old, new: changes.append((old, new))
+        )
+        attempt = BuyPageCieloAttempt(**self.params)
+        with BuyPageCieloTest.vcr.use_cassette('authorization_request'):
+            attempt.get_authorized()
+
+        now = time.time()
+        poller.track(attempt)
+        self.assertTrue(attempt.transaction_id in poller)
+        self.assertEqual(poller.next_due(), 10)
+        self.assertEqual(poller.poll_due(now + 9), 0)
+
+        with BuyPageCieloTest.vcr.use_cassette('authorization_request_being_processed'):
+            self.assertEqual(poller.poll_due(now + 10), 1)
+        self.assertEqual(changes, [('0', '1')])
+        self.assertEqual(len(poller), 1)
+
+        # Backing off, next poll 20 seconds later
+        self.assertEqual(poller.poll_due(now + 29), 0)
+        with BuyPageCieloTest.vcr.use_cassette('authorization_ok'):
+            self.assertEqual(poller.poll_due(now + 30), 1)
+        self.assertEqual(changes, [('0', '1'), ('1', '4')])
+        self.assertEqual(len(poller), 0)
+        self.assertEqual(poller.next_due(), None)
+        poller.stop()
+
+    def test_untracked_and_expired_transactions(self):
+        changes = []
+
+        def on_change(attempt, old, new):
+            changes.append((old, new))
+            if new is None:
+                # Called without the poller's lock
+                poller.untrack(attempt.transaction_id)
+
+        poller = AuthenticationPoller(timeout=0, on_change=on_change)
+        attempt = BuyPageCieloAttempt(**self.params)
+        with BuyPageCieloTest.vcr.use_cassette('authorization_request'):
+            attempt.get_authorized()
+
+        poller.track(attempt, delay=0)
+        poller.untrack(attempt.transaction_id)
+        self.assertEqual(poller.poll_due(), 0)
+
+        poller.track(attempt, delay=0)
+        with BuyPageCieloTest.vcr.use_cassette('authorization_request_being_processed'):
+            self.assertEqual(poller.poll_due(), 1)
+        self.assertEqual(changes, [('0', '1'), ('1', None)])
+        self.assertEqual(len(poller), 0)
+        poller.stop()
+
+    def test_failed_polls_are_retried(self):
+        errors = []
+        poller = AuthenticationPoller(initial_delay=0, on_error=lambda attempt, error: errors.append(error))
+        attempt = Transaction(affiliation_id='1', api_key='2', sandbox=True)
+        attempt.transaction_id = '10017348980735A61001'
+        attempt.url = 'http://localhost:1/'
+
+        poller.track(attempt)
+        self.assertEqual(poller.poll_due(), 1)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(poller), 1)
+        poller.stop()
+
+    def test_failing_callbacks_do_not_stop_polling(self):
+        def on_error(attempt, error):
+            raise RuntimeError('callback failed')
+
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('cielo.poller')
+        logger.addHandler(handler)
+        logger.propagate = False
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(setattr, logger, 'propagate', True)
+
+        poller = AuthenticationPoller(initial_delay=0, on_error=on_error)
+        for transaction_id in ('10017348980735A61001', '10017348980735A61002'):
+            attempt = Transaction(affiliation_id='1', api_key='2', sandbox=True)
+            attempt.transaction_id = transaction_id
+            attempt.url = 'http://localhost:1/'
+            poller.track(attempt)
+
+        now = time.time()
+        self.assertEqual(poller.poll_due(now), 2)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(len(poller), 2)
+        self.assertEqual(poller.poll_due(now + poller.max_delay), 2)
+        poller.stop()
+
+    def test_untracked_entries_do_not_pile_up(self):
+        poller = AuthenticationPoller()
+        for i in range(100):
+            attempt = Transaction(affiliation_id='1', api_key='2', sandbox=True)
+            attempt.transaction_id = 'TID{0}'.format(i)
+            poller.track(attempt)
+            if i % 10:
+                poller.untrack(attempt.transaction_id)
+
+        self.assertEqual(len(poller), 10)
+        self.assertTrue(len(poller._heap) <= 2 * 10 + 33)
+
+
+class CaptureDeadlineTrackerTest(FrozenTimeTest):
+
+    params = {
+        'affiliation_id': '1006993069',
+        'api_key': '25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+        'card_type': VISA,
+        'total': Decimal('1.00'),
+        'order_id': '7DSD163AHBPL3',
+        'card_number': '4012001037141112',
+        'cvc2': 423,
+        'exp_month': 1,
+        'exp_year': 2010,
+        'card_holders_name': 'JOAO DA SILVA',
+        'installments': 1,
+        'transaction': CASH,
+        'sandbox': True,
+    }
+
+    def test_due_captures_by_deadline(self):
+        tracker = CaptureDeadlineTracker()
+        now = datetime(2009, 12, 14, 12)
+        for i in (5, 1, 3, 2, 4):
+            tracker.add('TID{0}'.format(i), '1006993069', now + timedelta(hours=i))
+        tracker.discard('TID2')
+
+        due = tracker.due_within(timedelta(hours=3), now)
+        self.assertEqual([pending.transaction_id for pending in due], ['TID1', 'TID3'])
+        self.assertEqual(len(tracker), 4)
+        self.assertEqual(tracker.expired(now + timedelta(hours=1)), due[:1])
+
+        due = tracker.pop_due(timedelta(hours=4), now)
+        self.assertEqual([pending.transaction_id for pending in due], ['TID1', 'TID3', 'TID4'])
+        self.assertEqual(len(tracker), 1)
+        self.assertTrue('TID5' in tracker)
+        self.assertEqual(tracker.pop_due(timedelta(hours=4), now), [])
+
+    def test_discarded_captures_do_not_pile_up(self):
+        tracker = CaptureDeadlineTracker()
+        now = datetime(2009, 12, 14, 12)
+        for i in range(1000):
+            tracker.add('TID{0}'.format(i), '1006993069', now + timedelta(minutes=i))
+            if i % 100:
+                tracker.discard('TID{0}'.format(i))
+
+        self.assertEqual(len(tracker), 10)
+        self.assertTrue(len(tracker._heap) <= 2 * 10 + 33)
+        due = tracker.pop_due(timedelta(days=1), now)
+        self.assertEqual([pending.transaction_id for pending in due], ['TID{0}'.format(i) for i in range(0, 1000, 100)])
+
+    def test_authorizations_are_tracked_until_captured(self):
+        tracker = CaptureDeadlineTracker()
+        attempt = PaymentAttempt(capture_tracker=tracker, **self.params)
+
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            attempt.get_authorized()
+
+        # Deadline counted from the authorization time reported by Cielo
+        authorized_at = datetime(2014, 2, 25, 16, 34, 24)
+        self.assertTrue(attempt.transaction_id in tracker)
+        self.assertEqual(tracker.due_within(timedelta(days=4, hours=23), authorized_at), [])
+        pending = tracker.due_within(timedelta(days=5), authorized_at)[0]
+        self.assertEqual(pending.order_id, '7DSD163AHBPL3')
+        self.assertEqual(pending.deadline, authorized_at + timedelta(days=5))
+
+        with BuyPageLojaTest.vcr.use_cassette('capture_success'):
+            attempt.capture()
+        self.assertEqual(len(tracker), 0)
+
+    def test_capture_due(self):
+        tracker = CaptureDeadlineTracker()
+        attempt = PaymentAttempt(capture_tracker=tracker, **self.params)
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            attempt.get_authorized()
+
+        with BuyPageLojaTest.vcr.use_cassette('capture_success'):
+            results = list(tracker.capture_due(
+                timedelta(days=2), {'1006993069': self.params['api_key']}, now=datetime(2014, 3, 1), sandbox=True
+            ))
+
+        self.assertEqual(len(results), 1)
+        pending, transaction, error = results[0]
+        self.assertEqual(error, None)
+        self.assertEqual(transaction.transaction_id, attempt.transaction_id)
+        self.assertTrue(transaction._captured)
+        self.assertEqual(len(tracker), 0)
+
+
+class TransactionJournalTest(FrozenTimeTest):
+
+    params = dict(CaptureDeadlineTrackerTest.params)
+
+    def setUp(self):
+        super(TransactionJournalTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = path.join(self.directory, 'cielo.journal')
+        self.journal = TransactionJournal(self.path)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+        super(TransactionJournalTest, self).tearDown()
+
+    def test_answered_operations_are_not_in_flight(self):
+        attempt = PaymentAttempt(journal=self.journal, **self.params)
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            attempt.get_authorized()
+        self.journal.flush()
+
+        records = list(scan_journal(self.path))
+        self.assertEqual([kind for kind, op_id, offset, size in records], [INTENT, OUTCOME])
+        self.assertEqual(records[0][1], records[1][1])
+        self.assertEqual(recover_journal(self.path), [])
+
+    def test_unanswered_operations_are_in_flight(self):
+        attempt = SlowPaymentAttempt(journal=self.journal, **self.params)
+        attempt.error = requests.exceptions.Timeout()
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            self.assertRaises(requests.exceptions.Timeout, attempt.get_authorized)
+
+        entries = recover_journal(self.path)
+        self.assertEqual(len(entries), 1)
+        record = entries[0].record
+        self.assertEqual(record['operation'], AUTHORIZATION)
+        self.assertEqual(record['order_id'], '7DSD163AHBPL3')
+        self.assertTrue('401200******1112' in record['payload'])
+        self.assertFalse('4012001037141112' in record['payload'])
+        self.assertFalse(self.params['api_key'] in record['payload'])
+
+    def test_requests_turned_away_are_not_journaled(self):
+        breaker = CircuitBreaker(failure_threshold=1)
+        breaker.record(failed=True)
+        for i in range(3):
+            attempt = PaymentAttempt(journal=self.journal, circuit_breaker=breaker, **self.params)
+            self.assertRaises(CircuitOpenException, attempt.get_authorized)
+
+        self.journal.flush()
+        self.assertEqual(recover_journal(self.path), [])
+
+    def test_torn_record_is_ignored(self):
+        first = self.journal.intent(AUTHORIZATION, '1006993069', '<requisicao/>')
+        self.journal.intent(CAPTURE, '1006993069', '<requisicao/>')
+        self.journal.flush()
+
+        with open(self.path, 'r+b') as f:
+            f.truncate(path.getsize(self.path) - 3)
+        self.assertEqual([entry.op_id for entry in recover_journal(self.path)], [first])
+
+    def test_torn_record_followed_by_more_appends(self):
+        first = self.journal.intent(AUTHORIZATION, '1006993069', '<requisicao/>')
+        self.journal.close()
+
+        data = b'{"operation":"captura","payload":"<requisicao/>"}'
+        with open(self.path, 'ab') as f:
+            f.write(HEADER.pack(len(data), 0, INTENT, 1) + data[:10])
+
+        # The next process starts later, with other op ids
+        self.freezer.stop()
+        self.freezer = freeze_time('2009-12-14 12:00:02')
+        self.freezer.start()
+        self.journal = TransactionJournal(self.path)
+        second = self.journal.intent(CAPTURE, '1006993069', '<requisicao/>')
+        third = self.journal.intent(CAPTURE, '1006993069', '<requisicao/>')
+        self.assertEqual([entry.op_id for entry in recover_journal(self.path)], [first, second, third])
+
+    def test_compact(self):
+        for i in range(10):
+            op_id = self.journal.intent(CAPTURE, '1006993069', '<requisicao/>', transaction_id=str(i))
+            if i % 3:
+                self.journal.outcome(op_id, status='6')
+
+        self.assertEqual(self.journal.compact(), 4)
+        self.journal.outcome(op_id, status='6')
+        self.journal.flush()
+
+        entries = recover_journal(self.path)
+        self.assertEqual([entry.record['transaction_id'] for entry in entries], ['0', '3', '6'])
+
+
+class TransactionStoreTest(FrozenTimeTest):
+
+    params = dict(CaptureDeadlineTrackerTest.params, order_id='7DSD163AHREF1')
+
+    def setUp(self):
+        super(TransactionStoreTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.store = TransactionStore(path.join(self.directory, 'transactions.db'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TransactionStoreTest, self).tearDown()
+
+    def test_authorized_transaction_is_stored(self):
+        attempt = PaymentAttempt(transaction_store=self.store, **self.params)
+        with RefreshTransactionTest.vcr.use_cassette('authorization_success'):
+            attempt.get_authorized()
+
+        stored = self.store.get(attempt.transaction_id)
+        self.assertEqual(stored.order_id, '7DSD163AHREF1')
+        self.assertEqual(stored.affiliation_id, '1006993069')
+        self.assertEqual(stored.status, '4')
+        self.assertEqual(stored.total, '100')
+        self.assertEqual(self.store.by_order('7DSD163AHREF1'), [stored])
+        self.assertEqual(self.store.by_order('7DSD163AHREF1', '1006993068'), [])
+        self.assertEqual(self.store.authorized_not_captured(), [stored])
+        self.assertEqual(self.store.non_terminal(), [stored])
+
+        created_at = datetime.strptime(stored.created_at, '%Y-%m-%dT%H:%M:%S')
+        self.assertEqual(self.store.created_between(created_at, created_at + timedelta(seconds=1)), [stored])
+        self.assertEqual(self.store.created_between(created_at + timedelta(seconds=1), datetime.now()), [])
+
+        with RefreshTransactionTest.vcr.use_cassette('status_for_authorized_transaction'):
+            attempt.refresh()
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(self.store.get(attempt.transaction_id).created_at, stored.created_at)
+
+    def test_captured_transaction_is_terminal(self):
+        params = dict(self.params, order_id='7DSD163AHREF2', capture=True)
+        attempt = PaymentAttempt(transaction_store=self.store, **params)
+        with RefreshTransactionTest.vcr.use_cassette('authorization_with_capture_success'):
+            attempt.get_authorized()
+
+        self.assertEqual(self.store.get(attempt.transaction_id).status, '6')
+        self.assertEqual(self.store.by_status('6')[0].transaction_id, attempt.transaction_id)
+        self.assertEqual(self.store.non_terminal(), [])
+        self.assertEqual(self.store.authorized_not_captured(), [])
+
+
+class CannedResponse(object):
+
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+
+class OrderLookupAttempt(SlowPaymentAttempt):
+    """
+    Payment attempt answering status requests by order id locally.
+    """
+    status_by_order = (
+        '<?xml version="1.0" encoding="ISO-8859-1"?>'
+        '<transacao versao="1.3.0" id="1" xmlns="http://ecommerce.cbmp.com.br">'
+        '<tid>10069930690009F2A001</tid>'
+        '<dados-pedido><numero>%(order_id)s</numero><valor>100</valor></dados-pedido>'
+        '<status>4</status></transacao>'
+    )
+
+    def send(self, url, operation, payload):
+        if '<numero-pedido>' in payload:
+            self.status_requests = getattr(self, 'status_requests', 0) + 1
+            return CannedResponse(self.status_by_order % self.__dict__)
+        return super(OrderLookupAttempt, self).send(url, operation, payload)
+
+
+class OrderLookupTest(FrozenTimeTest):
+
+    params = dict(CaptureDeadlineTrackerTest.params, order_id='7DSD163AHREF1')
+
+    def test_order_index_is_filled_from_authorizations(self):
+        index = OrderIndex()
+        attempt = PaymentAttempt(order_index=index, **self.params)
+        with RefreshTransactionTest.vcr.use_cassette('authorization_success'):
+            attempt.get_authorized()
+        self.assertEqual(index.lookup('1006993069', '7DSD163AHREF1'), attempt.transaction_id)
+
+        transaction = Transaction(
+            affiliation_id='1006993069', api_key=self.params['api_key'],
+            order_id='7DSD163AHREF1', order_index=index, sandbox=True,
+        )
+        with RefreshTransactionTest.vcr.use_cassette('status_for_authorized_transaction') as cassette:
+            transaction.refresh()
+            self.assertEqual(cassette.play_count, 1)
+
+        self.assertEqual(transaction.transaction_id, attempt.transaction_id)
+        self.assertEqual(transaction.status, '4')
+
+    def test_transaction_store_as_order_index(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = TransactionStore(path.join(directory, 'transactions.db'))
+            attempt = PaymentAttempt(transaction_store=store, **self.params)
+            with RefreshTransactionTest.vcr.use_cassette('authorization_success'):
+                attempt.get_authorized()
+            self.assertEqual(store.lookup('1006993069', '7DSD163AHREF1'), attempt.transaction_id)
+            self.assertEqual(store.lookup('1006993069', '7DSD163AHREF2'), None)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_refresh_by_order(self):
+        index = OrderIndex()
+        attempt = OrderLookupAttempt(order_index=index, **dict(self.params, order_id='7DSD163AHREF9'))
+        attempt.refresh()
+
+        self.assertEqual(attempt.status_requests, 1)
+        self.assertEqual(attempt.transaction_id, '10069930690009F2A001')
+        self.assertTrue(attempt._authorized)
+        self.assertEqual(index.lookup('1006993069', '7DSD163AHREF9'), '10069930690009F2A001')
+
+        transaction = Transaction(affiliation_id='1006993069', api_key=self.params['api_key'], sandbox=True)
+        self.assertRaises(TypeError, transaction.refresh)
+
+    def test_lost_answer_is_looked_up_by_order(self):
+        attempt = OrderLookupAttempt(**dict(self.params, order_id='7DSD163AHREF9'))
+        attempt.error = requests.exceptions.Timeout()
+
+        pending = authorize_within(attempt, budget=5, poll_interval=0)
+        self.assertTrue(pending.result(timeout=5))
+        self.assertEqual(attempt.transaction_id, '10069930690009F2A001')
+        self.assertEqual(attempt.status, '4')
+
+
+class SlowRequestLogTest(FrozenTimeTest):
+
+    params = CaptureDeadlineTrackerTest.params
+
+    def test_slow_requests_are_kept(self):
+        request_log = SlowRequestLog(threshold=0)
+        attempt = PaymentAttempt(request_log=request_log, **self.params)
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            attempt.get_authorized()
+
+        entry, = request_log.slowest()
+        self.assertEqual(sorted(entry['phases']), sorted(PHASES))
+        self.assertEqual(entry['operation'], AUTHORIZATION)
+        self.assertEqual(entry['http_status'], 200)
+        self.assertEqual(entry['error'], None)
+        self.assertTrue('401200******1112' in entry['payload'])
+        self.assertFalse(self.params['api_key'] in entry['payload'])
+        self.assertEqual(request_log.failures(), [])
+        self.assertEqual(request_log.slowest(CAPTURE), [])
+
+    def test_fast_requests_are_skipped(self):
+        request_log = SlowRequestLog(threshold=1)
+        attempt = PaymentAttempt(request_log=request_log, **self.params)
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            attempt.get_authorized()
+        self.assertEqual(request_log.dump(), '')
+
+    def test_failed_requests_are_kept(self):
+        request_log = SlowRequestLog(failed=2)
+
+        attempt = PaymentAttempt(request_log=request_log, **dict(self.params, api_key='25fbb99741c739dd84d', order_id='7DSD163AHBPL8'))
+        with BuyPageLojaTest.vcr.use_cassette('authorization_bad_api_key'):
+            self.assertRaises(CieloException, attempt.get_authorized)
+
+        for i in range(2):
+            attempt = SlowPaymentAttempt(request_log=request_log, **self.params)
+            attempt.error = requests.exceptions.Timeout()
+            self.assertRaises(requests.exceptions.Timeout, attempt.get_authorized)
+
+        failures = request_log.failures()
+        self.assertEqual(len(failures), 2)
+        self.assertEqual(failures[0]['http_status'], None)
+        self.assertTrue('Timeout' in failures[0]['exception'])
+        self.assertEqual(request_log.slowest(), [])
+
+        request_log = SlowRequestLog()
+        attempt = PaymentAttempt(request_log=request_log, **dict(self.params, api_key='25fbb99741c739dd84d', order_id='7DSD163AHBPL8'))
+        with BuyPageLojaTest.vcr.use_cassette('authorization_bad_api_key'):
+            self.assertRaises(CieloException, attempt.get_authorized)
+
+        dumped = [json.loads(line) for line in request_log.dump().splitlines()]
+        self.assertEqual(len(dumped), 1)
+        self.assertEqual(dumped[0]['kind'], 'failed')
+        self.assertEqual(dumped[0]['error'], attempt.error_id)
+
+
+class LoadGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stand_in = StandInServer().start()
+
+    def tearDown(self):
+        self.stand_in.stop()
+
+    def test_stand_in_answers_the_client(self):
+        params = dict(CaptureDeadlineTrackerTest.params, url=self.stand_in.url, exp_year=date.today().year + 1)
+        attempt = PaymentAttempt(**params)
+        attempt.get_authorized()
+        self.assertTrue(attempt._authorized)
+
+        attempt.capture()
+        self.assertTrue(attempt._captured)
+
+    def test_run_load(self):
+        for mode in MODES:
+            report = run_load(self.stand_in.url, rate=100, duration=0.2, mode=mode, concurrency=2, seed=1)
+            self.assertEqual(report.requests, 20)
+            self.assertEqual(report.errors, {})
+            self.assertEqual(sum(report.operations.values()), 20)
+            self.assertTrue(report.percentiles()['p50'] <= report.percentiles()['max'])
+            self.assertTrue('{0} mode'.format(mode) in report.summary())
+
+        self.assertRaises(ValueError, run_load, self.stand_in.url, 10, 1, mode='async')
+
+
+class TrafficReplayTest(FrozenTimeTest):
+
+    params = CaptureDeadlineTrackerTest.params
+    token_params = {
+        'affiliation_id': '1006993069',
+        'api_key': '25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+        'card_type': 'visa',
+        'card_number': '4012001037141112',
+        'exp_month': 1,
+        'exp_year': 2010,
+        'card_holders_name': 'JOAO DA SILVA',
+        'sandbox': True,
+    }
+
+    def setUp(self):
+        super(TrafficReplayTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = path.join(self.directory, 'traffic.capture')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(TrafficReplayTest, self).tearDown()
+
+    def record(self):
+        recorder = TrafficRecorder(self.path)
+        attempt = PaymentAttempt(traffic_recorder=recorder, **self.params)
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            attempt.get_authorized()
+        with BuyPageLojaTest.vcr.use_cassette('capture_success'):
+            attempt.capture()
+
+        token = CieloToken(traffic_recorder=recorder, **self.token_params)
+        with CreateTokenTest.vcr.use_cassette('token_creation_success'):
+            token.create_token()
+
+        cancelled = PaymentAttempt(traffic_recorder=recorder, **dict(self.params, order_id='7DSD163AHCAN1'))
+        with CancelTransactionTest.vcr.use_cassette('authorization_success'):
+            cancelled.get_authorized()
+        with CancelTransactionTest.vcr.use_cassette('cancel_authorized_transaction'):
+            cancelled.cancel(amount=cancelled.total)
+
+        recorder.close()
+        return attempt, token
+
+    def test_capture_is_redacted(self):
+        attempt, token = self.record()
+        exchanges = list(read_traffic(self.path))
+
+        self.assertEqual([exchange.operation for exchange in exchanges],
+                         [AUTHORIZATION, CAPTURE, TOKENIZATION, AUTHORIZATION, CANCELATION])
+        self.assertEqual([exchange.status_code for exchange in exchanges], [200] * 5)
+        captured = b''.join(exchange.request.encode('utf-8') + exchange.response for exchange in exchanges)
+        self.assertFalse(b'4012001037141112' in captured)
+        self.assertFalse(self.params['api_key'].encode('ascii') in captured)
+        self.assertFalse(token.token.encode('ascii') in captured)
+        self.assertTrue(attempt.transaction_id.encode('ascii') in exchanges[1].response)
+
+    def test_replay(self):
+        self.record()
+        with open(self.path, 'ab') as f:
+            f.write(b'torn')
+
+        report = replay_traffic(self.path)
+        self.assertEqual(report.requests, 5)
+        self.assertEqual(report.errors, {})
+        self.assertEqual(report.operations, {AUTHORIZATION: 2, CAPTURE: 1, TOKENIZATION: 1, CANCELATION: 1})
+
+
+class MerchantRegistryTest(FrozenTimeTest):
+
+    def setUp(self):
+        super(MerchantRegistryTest, self).setUp()
+        self.params = dict(CaptureDeadlineTrackerTest.params)
+        self.registry = MerchantRegistry(sandbox=True)
+        self.merchant = self.registry.register(self.params.pop('affiliation_id'), self.params.pop('api_key'))
+
+    def test_templates_render_as_before(self):
+        context = dict(
+            (name, name.upper()) for name in re.findall(r'%\((\w+)\)s', ''.join(
+                get_template(name).text for name in TEMPLATE_OPERATIONS
+            ))
+        )
+        context.update(affiliation_id='1006993069', api_key='KEY')
+        for name in TEMPLATE_OPERATIONS:
+            template = get_template(name)
+            self.assertTrue(get_template(name) is template)
+            self.assertTrue('<numero>1006993069</numero>' in self.merchant.credentials(name).replace('KEY', ''))
+            self.assertEqual(template.render(context), template.text % context)
+
+    def test_requests_use_the_merchant(self):
+        self.assertTrue('1006993069' in self.registry)
+        self.assertTrue(self.registry['1006993069'] is self.merchant)
+        self.assertEqual(self.registry.get('1006993068'), None)
+        self.assertEqual(len(self.registry), 1)
+
+        attempt = self.merchant.create(PaymentAttempt, **self.params)
+        self.assertEqual(attempt.affiliation_id, '1006993069')
+        self.assertTrue(attempt.circuit_breaker is self.merchant.circuit_breaker)
+
+        # Same payload as with the credentials given to the attempt, or the cassette wouldn't match
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            attempt.get_authorized()
+        with BuyPageLojaTest.vcr.use_cassette('capture_success'):
+            self.merchant.transaction().capture(transaction_id=attempt.transaction_id)
+
+    def test_circuit_breaker(self):
+        merchant = self.registry.register('1006993069', CaptureDeadlineTrackerTest.params['api_key'],
+                                          failure_threshold=2, reset_timeout=30)
+        for i in range(2):
+            attempt = merchant.create(SlowPaymentAttempt, **self.params)
+            attempt.error = requests.exceptions.ConnectionError()
+            self.assertRaises(requests.exceptions.ConnectionError, attempt.get_authorized)
+        self.assertEqual(merchant.circuit_breaker.state, OPEN)
+
+        attempt = merchant.create(PaymentAttempt, **self.params)
+        self.assertRaises(CircuitOpenException, attempt.get_authorized)
+
+        # Once the timeout is over a request goes through and closes the circuit
+        merchant.circuit_breaker.opened_at -= 30
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            attempt.get_authorized()
+        self.assertEqual(merchant.circuit_breaker.state, CLOSED)
+
+
+class ShardedWorkerPoolTest(unittest.TestCase):
+
+    api_keys = {'1006993069': 'A' * 64, '1001734898': 'B' * 64, '1001734899': 'C' * 64}
+
+    def setUp(self):
+        self.stand_in = StandInServer().start()
+
+    def tearDown(self):
+        self.stand_in.stop()
+
+    def test_items_are_run_by_merchant_shards(self):
+        items = [(CAPTURE, '1006993069', '1006993069{0:010d}'.format(i), '1.00') for i in range(20)]
+        items += [(REFRESH, '1001734898', '1001734898{0:010d}'.format(i)) for i in range(5)]
+        items += [(CHARGE, '1001734899', 'ORDER{0}'.format(i), '10.00', 'TOKEN', VISA) for i in range(5)]
+        progress = []
+
+        with ShardedWorkerPool(self.api_keys, processes=2, threads=2, url=self.stand_in.url) as pool:
+            results = list(pool.run(items, progress=lambda done, total: progress.append((done, total))))
+
+        self.assertEqual(len(results), 30)
+        self.assertEqual(progress[-1], (30, 30))
+        self.assertEqual(pool.totals()['items'], 30)
+        self.assertEqual(pool.totals()['errors'], 0)
+
+        statuses = dict((result.kind, result.status) for result in results)
+        self.assertEqual(statuses, {CAPTURE: '6', REFRESH: '4', CHARGE: '6'})
+        charges = [result for result in results if result.kind == CHARGE]
+        self.assertTrue(all(result.transaction_id for result in charges))
+
+    def test_merchants_take_turns(self):
+        items = [(REFRESH, '1006993069', 'A{0}'.format(i)) for i in range(30)]
+        items += [(REFRESH, '1001734898', 'B{0}'.format(i)) for i in range(4)]
+
+        with ShardedWorkerPool(self.api_keys, processes=1, threads=1, chunk_size=2, prefetch=1,
+                               url=self.stand_in.url) as pool:
+            results = list(pool.run(items))
+            self.assertRaises(KeyError, list, pool.run([(REFRESH, '1', 'X')]))
+
+        merchants = [result.affiliation_id for result in results]
+        self.assertEqual(merchants.count('1001734898'), 4)
+        self.assertTrue(len(merchants) - merchants[::-1].index('1001734898') <= 8)
+
+    def test_dead_workers_are_reported(self):
+        with ShardedWorkerPool(self.api_keys, processes=1, poll_interval=0.05, url=self.stand_in.url) as pool:
+            pool._workers[0].terminate()
+            pool._workers[0].join()
+            self.assertRaises(RuntimeError, list, pool.run([(REFRESH, '1006993069', 'A')]))
+
+
+@unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork')
+class ForkSafetyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = TransactionJournal(path.join(self.directory, 'cielo.journal'), commit_interval=0)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.directory)
+        if hasattr(gc, 'unfreeze'):
+            gc.unfreeze()
+
+    def in_child(self, func):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if not pid:
+            try:
+                after_fork()
+                os.write(write_fd, json.dumps(func()).encode('utf-8'))
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as f:
+            result = f.read()
+        os.waitpid(pid, 0)
+        return json.loads(result.decode('utf-8'))
+
+    def test_children_reset_connections_and_locks(self):
+        scheduler = RequestScheduler()
+        limiter = AdaptiveConcurrencyLimiter(initial=1)
+        limiter.acquire()
+        breaker = CircuitBreaker()
+        breaker._lock.acquire()
+        sessions = [id(priority_class.session) for priority_class in scheduler.classes.values()]
+
+        def child():
+            breaker.allow()
+            return {
+                'sessions': [id(priority_class.session) for priority_class in scheduler.classes.values()],
+                'in_flight': limiter.in_flight,
+            }
+
+        result = self.in_child(child)
+        breaker._lock.release()
+        self.assertEqual(result['in_flight'], 0)
+        self.assertFalse(set(result['sessions']) & set(sessions))
+        self.assertEqual(limiter.in_flight, 1)
+
+    def test_children_reset_the_poller(self):
+        poller = AuthenticationPoller()
+        poller.start()
+        poller._lock.acquire()
+
+        def child():
+            return {'next_due': poller.next_due(), 'running': poller._thread is not None}
+
+        result = self.in_child(child)
+        poller._lock.release()
+        poller.stop()
+        self.assertEqual(result, {'next_due': None, 'running': False})
+
+    def test_children_share_the_journal(self):
+        child_op_id = self.in_child(lambda: self.journal.intent(CAPTURE, '1006993069', '<tid>1</tid>'))
+        op_id = self.journal.intent(CAPTURE, '1006993069', '<tid>2</tid>')
+
+        entries = recover_journal(self.journal.path)
+        self.assertEqual([entry.op_id for entry in entries], [child_op_id, op_id])
+        self.assertNotEqual(child_op_id >> 48, op_id >> 48)
+
+    def test_warmup(self):
+        registry = MerchantRegistry(sandbox=True)
+        merchant = registry.register('1006993069', 'A' * 64)
+        warmup(registry)
+        self.assertEqual(set(merchant._credentials), set(TEMPLATE_OPERATIONS))
+        self.assertTrue(set(TEMPLATE_OPERATIONS) <= set(template._templates))
+
+
+class LazyImportTest(unittest.TestCase):
+
+    def test_import_does_not_load_the_transport(self):
+        code = 'import sys, cielo; print(sorted(set(["requests", "xmltodict"]) & set(sys.modules)))'
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=path.dirname(path.dirname(path.abspath(__file__))))
+        self.assertEqual(output.decode('utf-8').strip(), '[]')
+
+
+class CommandLineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stand_in = StandInServer().start()
+        self.directory = tempfile.mkdtemp()
+        self.input = path.join(self.directory, 'tids.csv')
+        self.output = path.join(self.directory, 'results.jsonl')
+        with open(self.input, 'w') as f:
+            f.write('tid,amount\n')
+            for i in range(5):
+                f.write('1006993069{0:010d},1.00\n'.format(i))
+
+    def tearDown(self):
+        self.stand_in.stop()
+        shutil.rmtree(self.directory)
+
+    def run_command(self, *args):
+        summary_path = path.join(self.directory, 'summary.txt')
+        with open(summary_path, 'w') as summary:
+            status = command_line.main([
+                args[0], self.input, '--affiliation-id', '1006993069', '--api-key', 'A' * 64,
+                '--url', self.stand_in.url, '--output', self.output, '--concurrency', '2',
+            ] + list(args[1:]), stderr=summary)
+        with open(summary_path) as summary:
+            self.summary = summary.read()
+        return status
+
+    def results(self):
+        with open(self.output) as f:
+            return [json.loads(line) for line in f]
+
+    def test_results_are_streamed_per_line(self):
+        self.assertEqual(self.run_command('cancel', '--rate', '1000'), 0)
+        results = sorted(self.results(), key=lambda result: result['line'])
+        self.assertEqual([result['line'] for result in results], [1, 2, 3, 4, 5])
+        self.assertEqual(set(result['status'] for result in results), set(['9']))
+        self.assertEqual(results[0]['tid'], '10069930690000000000')
+        self.assertTrue(re.match(r'5 cancel in [0-9.]+s, 0 skipped: ok=5\n\Z', self.summary), self.summary)
+
+    def test_resume_skips_processed_lines(self):
+        self.assertEqual(self.run_command('capture'), 0)
+        with open(self.output) as f:
+            lines = f.readlines()
+        with open(self.output, 'w') as f:
+            f.writelines(lines[:2] + [lines[2][:10]])
+
+        self.assertEqual(self.run_command('capture', '--resume'), 0)
+        self.assertTrue(', 2 skipped: ok=3' in self.summary, self.summary)
+        self.assertEqual(sorted(result['line'] for result in self.results()), [1, 2, 3, 4, 5])
+        self.assertEqual(len(self.results()), 5)
+
+    def test_failures_are_reported(self):
+        with open(self.input, 'w') as f:
+            f.write('{"tid": "10069930690000000001"}\n{"tid": "10069930690000000002", "amount": "x"}\n')
+            f.write('{"tid": "10069930690000000003", \n{"tid": "10069930690000000004", "amount": "1.00"}\n')
+        self.assertEqual(self.run_command('cancel'), 1)
+        errors = dict((result['line'], result.get('error')) for result in self.results())
+        self.assertEqual(errors, {1: 'KeyError', 2: 'InvalidOperation', 3: 'ValueError', 4: None})
+        self.assertTrue(self.summary.endswith(
+            ' error:InvalidOperation=1, error:KeyError=1, error:ValueError=1, ok=1\n'
+        ), self.summary)
+
+
+class LeanAttemptTest(FrozenTimeTest):
+
+    params = {
+        'affiliation_id': '1006993069',
+        'api_key': '25fbb99741c739dd84d7b06ec78c9bac718838630f30b112d033ce2e621b34f3',
+        'card_type': VISA,
+        'total': Decimal('1.00'),
+        'order_id': '7DSD163AHBPL3',
+        'card_number': '4012001037141112',
+        'cvc2': 423,
+        'exp_month': 1,
+        'exp_year': 2010,
+        'card_holders_name': 'JOAO DA SILVA',
+        'installments': 1,
+        'transaction': CASH,
+        'sandbox': True,
+    }
+
+    def test_card_data_and_responses_are_discarded(self):
+        attempt = LeanPaymentAttempt(**self.params)
+        self.assertFalse(hasattr(attempt, '__dict__'))
+
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            self.assertTrue(attempt.get_authorized())
+
+        self.assertTrue(attempt._authorized)
+        self.assertEqual(attempt.status, '4')
+        self.assertTrue(attempt.transaction_id)
+        self.assertEqual(attempt.expiration, '201001')
+        for name in ('card_number', 'cvc2', 'card_holders_name'):
+            self.assertFalse(hasattr(attempt, name))
+        self.assertEqual(attempt.cielo_response, None)
+        self.assertEqual(attempt.transaction, None)
+        self.assertRaises(ValueError, attempt.get_authorized)
+
+        with BuyPageLojaTest.vcr.use_cassette('capture_success'):
+            self.assertTrue(attempt.capture())
+        self.assertTrue(attempt._captured)
+
+    def test_trackers_see_the_response(self):
+        order_index = OrderIndex()
+        attempt = LeanPaymentAttempt(order_index=order_index, **self.params)
+        with BuyPageLojaTest.vcr.use_cassette('authorization_success'):
+            attempt.get_authorized()
+        self.assertEqual(order_index.lookup('1006993069', attempt.order_id), attempt.transaction_id)
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_specs_round_trip(self):
+        specs = [
+            RequestSpec(AUTHORIZATION, '1006993069', order_id=u'PEDIDO-Ç1', amount=Decimal('10.50'), token='TOKEN',
+                        card_type=VISA, transaction_type=INSTALLMENT_STORE, installments=3, capture=True),
+            RequestSpec(CANCELATION, '1006993069', transaction_id='10069930690000000001', amount=Decimal('0.01')),
+            RequestSpec(STATUS, '1006993069', transaction_id='10069930690000000002'),
+        ]
+        for spec in specs:
+            self.assertEqual(decode_spec(encode_spec(spec)), spec)
+        self.assertEqual(decode_specs(encode_specs(specs)), specs)
+        self.assertEqual(decode_specs(encode_specs([])), [])
+
+    def test_results_round_trip(self):
+        results = [
+            TransactionResult(CAPTURE, '1006993069', '10069930690000000001', 'ORDER', '6', None, Decimal('1.00')),
+            TransactionResult(STATUS, '1006993069', None, None, None, '099'),
+        ]
+        data = encode_results(results)
+        self.assertEqual(decode_results(data), results)
+        self.assertEqual(len(encode_result(results[0])), 56)
+        self.assertRaises(ValueError, decode_results, b'\x02' + data[1:])
+
+    def test_execute(self):
+        with StandInServer() as stand_in:
+            kwargs = {'api_key': 'A' * 64, 'url': stand_in.url}
+            authorized = execute(RequestSpec(AUTHORIZATION, '1006993069', order_id='ORDER', amount=Decimal('1.00'),
+                                             token='TOKEN', card_type=VISA, capture=True), **kwargs)
+            cancelled = execute(RequestSpec(CANCELATION, '1006993069', transaction_id=authorized.transaction_id,
+                                            amount=Decimal('1.00')), **kwargs)
+
+        self.assertEqual(authorized.status, '6')
+        self.assertEqual(authorized.amount, Decimal('1.00'))
+        self.assertEqual(decode_result(encode_result(cancelled)), cancelled)
+        self.assertEqual(cancelled.status, '9')
+
+
+class InstallmentPlannerTest(unittest.TestCase):
+
+    def test_interest_free_installments_add_up_to_the_total(self):
+        planner = InstallmentPlanner(InstallmentRules(min_installment=Decimal('10.00')))
+        plan = planner.plan(Decimal('100.00'), VISA)
+
+        self.assertEqual([option.installments for option in plan], list(range(1, 11)))
+        self.assertEqual(plan[0], InstallmentOption(1, CASH, Decimal('100.00'), Decimal('100.00'),
+                                                    Decimal('100.00'), Decimal('0')))
+        self.assertEqual(plan[2].installment, Decimal('33.33'))
+        self.assertEqual(plan[2].first_installment, Decimal('33.34'))
+        for option in plan:
+            self.assertEqual(option.first_installment + option.installment * (option.installments - 1), option.total)
+            self.assertEqual(option.total, Decimal('100.00'))
+
+    def test_interest_beyond_the_interest_free_installments(self):
+        rules = InstallmentRules(min_installment=Decimal('5.00'), interest_free=3, monthly_interest=Decimal('0.0199'))
+        plan = InstallmentPlanner(rules).plan(Decimal('1000.00'), MASTERCARD)
+
+        self.assertEqual(len(plan), 12)
+        self.assertEqual(plan[2].total, Decimal('1000.00'))
+        self.assertEqual(plan[3].installment, Decimal('262.56'))
+        self.assertEqual(plan[3].total, Decimal('1050.24'))
+        self.assertEqual(plan[3].monthly_interest, Decimal('0.0199'))
+        self.assertEqual(plan[11].installment, Decimal('94.50'))
+
+    def test_installments_financed_by_cielo(self):
+        rules = InstallmentRules(transaction_type=INSTALLMENT_CIELO, interest_free=1, monthly_interest=Decimal('0.02'))
+        plan = InstallmentPlanner(rules).plan(Decimal('60.00'), VISA)
+
+        self.assertEqual([option.transaction_type for option in plan], [CASH] + [INSTALLMENT_CIELO] * 11)
+        self.assertEqual(plan[5].total, Decimal('60.00'))
+
+    def test_card_type_limits(self):
+        rules = InstallmentRules(max_installments=10, card_type_limits={DINERS: 6, DISCOVER: 1})
+        table = InstallmentPlanner(rules).table(Decimal('500.00'))
+
+        self.assertEqual(sorted(table), sorted(card_type for card_type, name in CARD_TYPE_C))
+        self.assertEqual(len(table[VISA]), 10)
+        self.assertEqual(len(table[DINERS]), 6)
+        self.assertEqual(len(table[DISCOVER]), 1)
+        self.assertRaises(ValueError, InstallmentRules, max_installments=13)
+        self.assertRaises(ValueError, InstallmentRules, interest_free=0)
+        self.assertRaises(ValueError, InstallmentRules, max_installments=6, interest_free=7)
+
+    def test_plans_are_cached(self):
+        planner = InstallmentPlanner(cache_size=2)
+
+        self.assertTrue(planner.table(Decimal('20')) is planner.table(Decimal('20.00')))
+        self.assertTrue(planner.plan(Decimal('20.00'), VISA) is planner.plan(Decimal('20.00'), MASTERCARD))
+        planner.table(Decimal('30.00'))
+        planner.table(Decimal('40.00'))
+        self.assertEqual(list(planner._tables), [Decimal('30.00'), Decimal('40.00')])
+
+    def test_options_are_valid_attempts(self):
+        planner = InstallmentPlanner(InstallmentRules(interest_free=2, monthly_interest=Decimal('0.01')))
+
+        for option in planner.plan(Decimal('123.45'), VISA):
+            attempt = PaymentAttempt(
+                affiliation_id='1006993069', api_key='A' * 64, card_type=VISA, order_id='ORDER',
+                card_number='4012001037141112', cvc2=423, exp_month=1, exp_year=2030,
+                card_holders_name='JOAO DA SILVA', **option.attempt_kwargs()
+            )
+            self.assertEqual(attempt.installments, option.installments)
+        self.assertEqual(planner.validate(Decimal('123.45'), VISA, 1, CASH).total, Decimal('123.45'))
+        self.assertRaises(ValueError, planner.validate, Decimal('123.45'), VISA, 1, INSTALLMENT_STORE)
+        self.assertRaises(ValueError, planner.validate, Decimal('10.00'), VISA, 12)
+
+
 if __name__ == '__main__':
     unittest.main()
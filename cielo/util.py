@@ -1,7 +1,14 @@
 # -*- coding: utf-8 -*-
+import re
 from decimal import Decimal
 
-__all__ = ['moneyfmt', ]
+__all__ = ['moneyfmt', 'luhn_valid', 'truncate_card', 'redact_payload']
+
+try:
+    string_types = basestring
+except NameError:  # Python 3
+    string_types = str
+
 
 def moneyfmt(value, places=2, curr='', sep=',', dp='.',
              pos='', neg='-', trailneg=''):
@@ -29,13 +36,13 @@ def moneyfmt(value, places=2, curr='', sep=',', dp='.',
     '<0.02>'
 
     """
-    if isinstance(value, basestring):
+    if isinstance(value, string_types):
         value = Decimal(value) ** -places
 
     q = Decimal(10) ** -places      # 2 places --> '0.01'
     sign, digits, exp = value.quantize(q).as_tuple()
     result = []
-    digits = map(str, digits)
+    digits = list(map(str, digits))
     build, next = result.append, digits.pop
     if sign:
         build(trailneg)
@@ -54,3 +61,56 @@ def moneyfmt(value, places=2, curr='', sep=',', dp='.',
     build(curr)
     build(neg if sign else pos)
     return ''.join(reversed(result))
+
+
+def luhn_valid(card_number):
+    """Check the card number against the Luhn (mod 10) checksum.
+
+    >>> luhn_valid('4012001037141112')
+    True
+    >>> luhn_valid('4012001037141113')
+    False
+
+    """
+    digits = str(card_number)
+    if not digits.isdigit():
+        return False
+
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        digit = int(digit)
+        if i % 2:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return total % 10 == 0
+
+
+def truncate_card(card_number):
+    """Mask a card number the way Cielo does, keeping the BIN and last 4 digits.
+
+    >>> truncate_card('4012001037141112')
+    '401200******1112'
+
+    """
+    card_number = str(card_number)
+    return card_number[:6] + '*' * (len(card_number) - 10) + card_number[-4:]
+
+
+_SECRET_TAGS = re.compile(r'<(chave|codigo-seguranca|token|codigo-token)>[^<]*</\1>')
+_CARD_NUMBER = re.compile(r'(<dados-portador>\s*<numero>)([^<]*)(</numero>)')
+
+
+def redact_payload(payload):
+    """Hide the api key, security code, tokens and card number of a request or response.
+
+    >>> redact_payload('<dados-portador><numero>4012001037141112</numero><codigo-seguranca>423</codigo-seguranca>')
+    '<dados-portador><numero>401200******1112</numero><codigo-seguranca>***</codigo-seguranca>'
+
+    """
+    if isinstance(payload, bytes) and not isinstance(payload, str):
+        # Python 3 response content
+        return redact_payload(payload.decode('latin-1')).encode('latin-1')
+    payload = _SECRET_TAGS.sub(lambda match: '<{0}>***</{0}>'.format(match.group(1)), payload)
+    return _CARD_NUMBER.sub(lambda match: match.group(1) + truncate_card(match.group(2)) + match.group(3), payload)
@@ -0,0 +1,164 @@
+# coding: utf-8
+import re
+from array import array
+from datetime import date
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .constants import CARD_NUMBER_RULES
+
+__all__ = [
+    'validate_card', 'validate_cards', 'VALIDATION_ERRORS',
+    'VALID', 'INVALID_NUMBER', 'INVALID_CHECKSUM', 'INVALID_CARD_TYPE',
+    'INVALID_EXP_YEAR', 'INVALID_EXP_MONTH', 'EXPIRED',
+]
+
+# Result codes, a row gets the first failing check in this order
+VALID, INVALID_NUMBER, INVALID_CHECKSUM, INVALID_CARD_TYPE, INVALID_EXP_YEAR, INVALID_EXP_MONTH, EXPIRED = range(7)
+VALIDATION_ERRORS = {
+    VALID: u'Válido',
+    INVALID_NUMBER: u'Número do cartão inválido',
+    INVALID_CHECKSUM: u'Dígito verificador inválido',
+    INVALID_CARD_TYPE: u'Número incompatível com a bandeira',
+    INVALID_EXP_YEAR: u'Ano de vencimento deve ter 2 ou 4 dígitos',
+    INVALID_EXP_MONTH: u'Mês de vencimento inválido',
+    EXPIRED: u'Cartão vencido',
+}
+
+MAX_CARD_LENGTH = 19
+CARD_NUMBER = re.compile(r'[0-9]{1,%d}\Z' % MAX_CARD_LENGTH)
+
+
+def _matches_card_type(card_number, card_type):
+    try:
+        lengths, ranges = CARD_NUMBER_RULES[card_type]
+    except KeyError:
+        return False
+
+    if len(card_number) not in lengths:
+        return False
+    for low, high in ranges:
+        if low <= card_number[:len(low)] <= high:
+            return True
+    return False
+
+
+def validate_card(card_number, exp_month, exp_year, card_type=None, today=None):
+    """
+    Returns the result code for a single card. Expiration follows
+    WithCardData.validate: 2 digit years are in the 2000s and a card is
+    valid until the end of its expiration month.
+    """
+    card_number = str(card_number).strip()
+    if not CARD_NUMBER.match(card_number):
+        return INVALID_NUMBER
+
+    total = 0
+    for i, digit in enumerate(reversed(card_number)):
+        digit = int(digit)
+        if i % 2:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    if total % 10:
+        return INVALID_CHECKSUM
+
+    if card_type is not None and not _matches_card_type(card_number, card_type):
+        return INVALID_CARD_TYPE
+
+    exp_year = int(exp_year)
+    if 10 <= exp_year <= 99:
+        exp_year += 2000
+    elif not 1000 <= exp_year <= 9999:
+        return INVALID_EXP_YEAR
+
+    exp_month = int(exp_month)
+    if not 1 <= exp_month <= 12:
+        return INVALID_EXP_MONTH
+
+    today = today or date.today()
+    if (exp_year, exp_month) < (today.year, today.month):
+        return EXPIRED
+
+    return VALID
+
+
+def _validate_cards_numpy(card_numbers, exp_months, exp_years, card_types, today):
+    # As wide as the longest number, so none is cut short before its length is checked
+    numbers = numpy.char.strip(numpy.asarray(card_numbers, dtype='U'))
+    lengths = numpy.char.str_len(numbers)
+    result = numpy.zeros(len(numbers), dtype=numpy.int8)
+    too_long = lengths > MAX_CARD_LENGTH
+    numbers = numpy.where(too_long, u'', numbers).astype('U%d' % MAX_CARD_LENGTH)
+
+    # Right aligned matrix of code points, the '0' padding doesn't change the checksum
+    padded = numpy.char.rjust(numbers, MAX_CARD_LENGTH, u'0')
+    digits = numpy.frombuffer(padded.tobytes(), dtype=numpy.uint32).reshape(-1, MAX_CARD_LENGTH)
+    digits = digits.astype(numpy.int64) - ord('0')
+
+    invalid_number = ((digits < 0) | (digits > 9)).any(axis=1) | (lengths == 0) | too_long
+    digits[invalid_number] = 0
+
+    doubled = digits[:, -2::-2] * 2
+    doubled[doubled > 9] -= 9
+    checksum = (digits[:, ::-2].sum(axis=1) + doubled.sum(axis=1)) % 10
+
+    failures = [(INVALID_NUMBER, invalid_number), (INVALID_CHECKSUM, checksum != 0)]
+
+    if card_types is not None:
+        card_types = numpy.asarray(card_types)
+        matches = numpy.zeros(len(numbers), dtype=bool)
+        for card_type in numpy.unique(card_types):
+            rows = card_types == card_type
+            lengths_allowed, ranges = CARD_NUMBER_RULES.get(card_type, ((), ()))
+            type_matches = numpy.zeros(len(numbers), dtype=bool)
+            for low, high in ranges:
+                prefixes = numbers.astype('U%d' % len(low))
+                type_matches |= (prefixes >= u'{0}'.format(low)) & (prefixes <= u'{0}'.format(high))
+            matches |= rows & type_matches & numpy.isin(lengths, lengths_allowed)
+        failures.append((INVALID_CARD_TYPE, ~matches))
+
+    years = numpy.asarray(exp_years, dtype=numpy.int64)
+    months = numpy.asarray(exp_months, dtype=numpy.int64)
+    two_digits = (years >= 10) & (years <= 99)
+    four_digits = (years >= 1000) & (years <= 9999)
+    years = numpy.where(two_digits, years + 2000, years)
+    invalid_month = (months < 1) | (months > 12)
+
+    failures.append((INVALID_EXP_YEAR, ~(two_digits | four_digits)))
+    failures.append((INVALID_EXP_MONTH, invalid_month))
+    failures.append((EXPIRED, years * 12 + months < today.year * 12 + today.month))
+
+    # Apply the checks backwards so the first failing one wins
+    for code, failed in reversed(failures):
+        result[failed] = code
+    return result
+
+
+def validate_cards(card_numbers, exp_months, exp_years, card_types=None, today=None, use_numpy=None):
+    """
+    Validates columns of card data (one sequence per field) without building
+    a PaymentAttempt per card, returning one result code per row (see
+    VALIDATION_ERRORS). Uses NumPy when installed, giving a numpy int8 array,
+    otherwise checks each row with validate_card into an ``array('b')``.
+
+    ``card_types`` is optional; when given, the card number length and BIN
+    must agree with it.
+    """
+    today = today or date.today()
+    if use_numpy is None:
+        use_numpy = numpy is not None
+
+    if use_numpy:
+        return _validate_cards_numpy(card_numbers, exp_months, exp_years, card_types, today)
+
+    if card_types is None:
+        card_types = [None] * len(card_numbers)
+    return array('b', [
+        validate_card(card_number, exp_month, exp_year, card_type, today)
+        for card_number, exp_month, exp_year, card_type in zip(card_numbers, exp_months, exp_years, card_types)
+    ])
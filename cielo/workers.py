@@ -0,0 +1,203 @@
+# coding: utf-8
+import multiprocessing
+import zlib
+from collections import namedtuple, OrderedDict, deque
+from decimal import Decimal
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+from .bulk import run_batch
+from .loadtest import _cpu_time
+from .main import TokenPaymentAttempt
+from .merchants import MerchantRegistry
+
+__all__ = ['ShardedWorkerPool', 'WorkItem', 'WorkResult', 'CAPTURE', 'CANCEL', 'REFRESH', 'CHARGE']
+
+# Work kinds: ``reference`` is the tid, except for CHARGE (an authorization
+# with a token, for billing) where it is the order id
+CAPTURE, CANCEL, REFRESH, CHARGE = 'capture', 'cancel', 'refresh', 'charge'
+
+WorkItem = namedtuple('WorkItem', 'kind affiliation_id reference amount token card_type')
+WorkItem.__new__.__defaults__ = (None, None, None)
+
+WorkResult = namedtuple('WorkResult', 'kind affiliation_id reference transaction_id status error')
+
+
+def _run_item(registry, item):
+    merchant = registry[item.affiliation_id]
+    amount = Decimal(item.amount) if item.amount is not None else None
+
+    if item.kind == CHARGE:
+        attempt = merchant.create(TokenPaymentAttempt, order_id=item.reference, total=amount,
+                                  token=item.token, card_type=item.card_type, capture=True)
+        attempt.get_authorized()
+        return attempt
+
+    transaction = merchant.transaction()
+    if item.kind == CAPTURE:
+        transaction.capture(transaction_id=item.reference)
+    elif item.kind == CANCEL:
+        transaction.cancel(transaction_id=item.reference, amount=amount)
+    elif item.kind == REFRESH:
+        transaction.refresh(transaction_id=item.reference)
+    else:
+        raise ValueError('unknown work kind {0}'.format(item.kind))
+    return transaction
+
+
+def _work(shard, tasks, results, api_keys, threads, request_kwargs):
+    registry = MerchantRegistry(**request_kwargs)
+    for affiliation_id, api_key in api_keys.items():
+        registry.register(affiliation_id, api_key)
+
+    while True:
+        chunk = tasks.get()
+        if chunk is None:
+            return
+
+        started_at = _cpu_time()
+        done = []
+        for item, request, error in run_batch(lambda item: _run_item(registry, item), chunk, threads):
+            if error is not None:
+                done.append(WorkResult(item.kind, item.affiliation_id, item.reference, None, None,
+                                       getattr(error, 'id', None) or error.__class__.__name__))
+            else:
+                done.append(WorkResult(item.kind, item.affiliation_id, item.reference,
+                                       request.transaction_id, request.status, None))
+        results.put((shard, done, _cpu_time() - started_at))
+
+
+class ShardedWorkerPool(object):
+    """
+    Runs batch work (WorkItems) on ``processes`` worker processes, each with
+    ``threads`` threads. Every affiliation id is pinned to one process,
+    which keeps that merchant's pools, rate limit and circuit breaker (see
+    Merchant). ``api_keys`` maps the affiliation ids to their api keys and
+    is sent once to each process; other keyword arguments configure the
+    merchants.
+
+    Within a process merchants take turns, ``chunk_size`` items at a time,
+    so a large merchant can't hold back the small ones sharing its process.
+    Only ``prefetch`` chunks are queued per process to keep the turns fair.
+    Items and results cross processes as small tuples. While waiting for
+    results the worker processes are checked every ``poll_interval``
+    seconds: run() raises RuntimeError if one of them died.
+    """
+
+    def __init__(self, api_keys, processes=None, threads=4, chunk_size=16, prefetch=2, poll_interval=1,
+                 **request_kwargs):
+        self.api_keys = api_keys
+        self.processes = processes or multiprocessing.cpu_count()
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.prefetch = prefetch
+        self.poll_interval = poll_interval
+        self.request_kwargs = request_kwargs
+
+        self.metrics = {}
+        self._workers = []
+        self._tasks = []
+        self._results = None
+
+    def shard(self, affiliation_id):
+        return zlib.crc32(str(affiliation_id).encode('utf-8')) % self.processes
+
+    def start(self):
+        self._results = multiprocessing.Queue()
+        for shard in range(self.processes):
+            tasks = multiprocessing.Queue()
+            api_keys = dict(
+                (affiliation_id, api_key) for affiliation_id, api_key in self.api_keys.items()
+                if self.shard(affiliation_id) == shard
+            )
+            worker = multiprocessing.Process(
+                target=_work, args=(shard, tasks, self._results, api_keys, self.threads, self.request_kwargs)
+            )
+            worker.daemon = True
+            worker.start()
+            self._tasks.append(tasks)
+            self._workers.append(worker)
+        return self
+
+    def close(self):
+        for tasks in self._tasks:
+            tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._tasks = []
+        self._workers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _next_results(self):
+        while True:
+            try:
+                return self._results.get(timeout=self.poll_interval)
+            except Empty:
+                for worker in self._workers:
+                    if not worker.is_alive():
+                        raise RuntimeError(
+                            'worker process {0} exited with code {1}'.format(worker.pid, worker.exitcode)
+                        )
+
+    def _next_chunk(self, merchants):
+        affiliation_id, items = merchants.popitem(last=False)
+        chunk = [items.popleft() for i in range(min(self.chunk_size, len(items)))]
+        if items:
+            merchants[affiliation_id] = items
+        return chunk
+
+    def run(self, items, progress=None):
+        """
+        Yields a WorkResult per item, in completion order. ``progress(done,
+        total)`` is called as results arrive; ``metrics`` holds the items,
+        errors and CPU time of each process, merged as they report.
+        """
+        if not self._workers:
+            raise RuntimeError('pool not started')
+
+        pending = [OrderedDict() for shard in range(self.processes)]
+        total = 0
+        for item in items:
+            item = WorkItem(*item)
+            if item.affiliation_id not in self.api_keys:
+                raise KeyError(u'unknown affiliation_id {0}'.format(item.affiliation_id))
+            pending[self.shard(item.affiliation_id)].setdefault(item.affiliation_id, deque()).append(item)
+            total += 1
+
+        self.metrics = dict(
+            (shard, {'items': 0, 'errors': 0, 'cpu_time': 0.0}) for shard in range(self.processes)
+        )
+        queued = [0] * self.processes
+        done = 0
+        while done < total:
+            for shard in range(self.processes):
+                while queued[shard] < self.prefetch and pending[shard]:
+                    self._tasks[shard].put(self._next_chunk(pending[shard]))
+                    queued[shard] += 1
+
+            shard, results, cpu_time = self._next_results()
+            queued[shard] -= 1
+            metrics = self.metrics[shard]
+            metrics['items'] += len(results)
+            metrics['errors'] += sum(1 for result in results if result.error is not None)
+            metrics['cpu_time'] += cpu_time
+
+            for result in results:
+                done += 1
+                if progress is not None:
+                    progress(done, total)
+                yield result
+
+    def totals(self):
+        return dict(
+            (name, sum(metrics[name] for metrics in self.metrics.values()))
+            for name in ('items', 'errors', 'cpu_time')
+        )
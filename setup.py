@@ -14,6 +14,9 @@ setup(
     long_description=readme,
     classifiers=[
         'Programming Language :: Python',
+        'Programming Language :: Python :: 2',
+        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
         'Topic :: Software Development :: Libraries :: Python Modules',
     ],
     keywords='cielo e-commerce',
@@ -24,7 +27,7 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     zip_safe=False,
-    install_requires=['requests==1.2.3', 'xmltodict==0.8.1'],
+    install_requires=['requests>=1.2.3', 'xmltodict>=0.8.1'],
     tests_require=['vcrpy==0.3.3', 'freezegun==0.1.8'],
     test_suite='cielo.tests',
 )